@@ -25,6 +25,9 @@ def print_args_summary(args):
     summary += "Number of chains: %s\n" % args.chain
     if args.chain > 1 and args.opencl:
         summary += "Distribute chains across multiple OpenCL devices: %s\n" % args.distributed_chains
+    if args.opencl: summary += "Shard observations across multiple OpenCL devices: %s\n" % args.shard_data
+    if args.kernel == 'categorical' and not args.opencl:
+        summary += "Compress identical observations into patterns: %s\n" % args.compress_patterns
     print(summary, file=sys.stderr)
 
 parser = argparse.ArgumentParser(description="""
@@ -42,6 +45,8 @@ parser.add_argument('--output_to_file', action='store_true', help="Write posteri
 parser.add_argument('--output_to_stdout', action='store_true', help="Write posterior samples to standard output (i.e., your screen). Default behavior is not keeping records of posterior samples")
 parser.add_argument('--chain', '-c', type=int, default=1, help='The number of chains to run. Default is 1.')
 parser.add_argument('--distributed_chains', action='store_true', default=False, help="If there are multiple OpenCL devices, distribute chains across them. Default is no. Will not distribute to CPUs if GPU is specified in opencl_device, and vice versa")
+parser.add_argument('--compress_patterns', action='store_true', default=False, help="Sample identical observations together as one weighted pattern. Supported by the categorical kernel without OpenCL only. Default is no.")
+parser.add_argument('--shard_data', action='store_true', default=False, help="Split the observations of each chain across all OpenCL devices selected by opencl_device (e.g., every GPU with --opencl_device gpu). Currently supported by the gaussian kernel only. Default is no.")
 
 # parse and print out the arguments
 args = parser.parse_args()
@@ -56,9 +61,11 @@ output_path = os.path.dirname(os.path.realpath(args.data_file)) + '/'
 if args.kernel == 'gaussian':
     c = crp.gaussian.CollapsedGibbs(cl_mode = args.opencl,
                                     cl_device = args.opencl_device,
-                                    record_best = args.output_mode == 'best')
+                                    record_best = args.output_mode == 'best',
+                                    multi_device = args.shard_data)
 elif args.kernel == 'categorical':
-    c = crp.categorical.CollapsedGibbs(cl_mode = args.opencl, cl_device = args.opencl_device)
+    c = crp.categorical.CollapsedGibbs(cl_mode = args.opencl, cl_device = args.opencl_device,
+                                       compress_patterns = args.compress_patterns)
 
 c.read_csv(args.data_file)
 c.set_sampling_params(niter = args.iter, burnin = args.burnin)
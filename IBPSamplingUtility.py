@@ -25,6 +25,10 @@ def print_args_summary(args):
     summary += "Number of chains: %s\n" % args.chain
     if args.chain > 1 and args.opencl:
         summary += "Distribute chains across multiple OpenCL devices: %s\n" % args.distributed_chains
+    if args.kernel == 'noisyor' and not args.opencl:
+        summary += "Keep a compact bit-packed state: %s\n" % args.compact
+        summary += "Number of data-parallel worker processes: %s\n" % (args.workers or 'none')
+        if args.remote_workers: summary += "Number of remote worker processes: %d\n" % args.remote_workers
     print(summary, file=sys.stderr)
 
 parser = argparse.ArgumentParser(description="""
@@ -33,7 +37,7 @@ Please contact Ting Qian <ting_qian@brown.edu> for questions and feedback.
 """)
 parser.add_argument('--opencl', action='store_true', help='Use OpenCL acceleration')
 parser.add_argument('--opencl_device', choices=['ask', 'gpu', 'cpu'], default='ask', help='The device to use OpenCL acceleration on. Default behavior is asking the user (i.e., you).')
-parser.add_argument('--data_file', type=str, required=True)
+parser.add_argument('--data_file', type=str)
 parser.add_argument('--kernel', choices=['noisyor', 'noisyortwoy-uniform', 'noisyortwoy-biased'], 
                     default='noisyor', help='The likelihood function of each feature. Default is noisyor for binary images.')
 parser.add_argument('--iter', '-t', type=int, default=10000, help='The number of iterations the sampler should run')
@@ -42,49 +46,70 @@ parser.add_argument('--output_to_file', action='store_true', help="Write posteri
 parser.add_argument('--output_to_stdout', action='store_true', help="Write posterior samples to standard output (i.e., your screen). Default behavior is not keeping records of posterior samples")
 parser.add_argument('--output_mode', choices=['best', 'all'], default='best', help='Output mode. Default is keeping only the sample that yields the highest logliklihood of data. The other option is to keep all samples.')
 parser.add_argument('--chain', '-c', type=int, default=1, help='The number of chains to run. Default is 1.')
+parser.add_argument('--compact', action='store_true', default=False, help="Keep the images bit-packed and the feature images and ownership as uint8 to save memory. Supported by the noisyor kernel without OpenCL only. Default is no.")
+parser.add_argument('--workers', type=int, default=0, help="Split the images across this many worker processes that sweep their rows in parallel. Supported by the noisyor kernel without OpenCL only. Default is a single process.")
+parser.add_argument('--remote_workers', type=int, default=0, help="Also wait for this many worker processes on other machines, started with --worker_of, to join the ones given by --workers. Default is none.")
+parser.add_argument('--listen', type=str, default='0.0.0.0:0', help="The HOST:PORT to wait for remote workers at. Default is any free port on all interfaces.")
+parser.add_argument('--authkey', type=str, default=None, help="The key, in hex, that remote workers must present. Default is a random key, which is printed.")
+parser.add_argument('--worker_of', type=str, default=None, help="Run as a remote worker of the sampler waiting at HOST:PORT, with the key given by --authkey, instead of sampling.")
 parser.add_argument('--distributed_chains', action='store_true', default=False, help="If there are multiple OpenCL devices, distribute chains across them. Default is no. Will not distribute to CPUs if GPU is specified in opencl_device, and vice versa")
 
-# parse and print out the arguments
-args = parser.parse_args()
+if __name__ == '__main__':
+    # parse and print out the arguments
+    args = parser.parse_args()
 
-# check for imcompatibilities
-if args.output_mode == 'all' and args.output_to_stdout:
-    print('Recording all samples is chosen, but printing to screen is also selected. This is not recommended.', file=sys.stderr)
-    sys.exit(0)
+    # run as a worker of a sampler on another machine
+    if args.worker_of is not None:
+        if args.authkey is None: parser.error('--worker_of needs the --authkey of the sampler')
+        host, port = args.worker_of.rsplit(':', 1)
+        ibp.parallel.remote_worker((host, int(port)), args.authkey.decode('hex'))
+        sys.exit(0)
+    if args.data_file is None: parser.error('--data_file is required')
 
+    # check for imcompatibilities
+    if args.output_mode == 'all' and args.output_to_stdout:
+        print('Recording all samples is chosen, but printing to screen is also selected. This is not recommended.', file=sys.stderr)
+        sys.exit(0)
 
-print_args_summary(args)
 
-# parse the name of the input file and set up output file path
-if type(args.data_file) is str:
-    input_filename, _ = os.path.splitext(os.path.basename(args.data_file))
-output_path = os.path.dirname(os.path.realpath(args.data_file)) + '/'
+    print_args_summary(args)
 
-# set up the sampler
-if args.kernel == 'noisyor':
-    c = ibp.noisyor.Gibbs(cl_mode = args.opencl, cl_device = args.opencl_device,
-                          record_best = args.output_mode == 'best')
-elif args.kernel == 'noisyortwoy-uniform':
-    c = ibp.noisyortwoy.UniformGibbs(cl_mode = args.opencl, cl_device = args.opencl_device)
-elif args.kernel == 'noisyortwoy-biased':
-    c = ibp.noisyortwoy.BiasedGibbs(cl_mode = args.opencl, cl_device = args.opencl_device)
+    # parse the name of the input file and set up output file path
+    if type(args.data_file) is str:
+        input_filename, _ = os.path.splitext(os.path.basename(args.data_file))
+    output_path = os.path.dirname(os.path.realpath(args.data_file)) + '/'
 
-c.read_csv(args.data_file)
-c.set_sampling_params(niter = args.iter, burnin = args.burnin)
+    # set up the sampler
+    if args.kernel == 'noisyor' and args.workers + args.remote_workers > 0 and not args.opencl:
+        host, port = args.listen.rsplit(':', 1)
+        c = ibp.parallel.ParallelGibbs(num_workers = args.workers, record_best = args.output_mode == 'best',
+                                       compact = args.compact, num_remote = args.remote_workers,
+                                       address = (host, int(port)),
+                                       authkey = args.authkey.decode('hex') if args.authkey else None)
+    elif args.kernel == 'noisyor':
+        c = ibp.noisyor.Gibbs(cl_mode = args.opencl, cl_device = args.opencl_device,
+                              record_best = args.output_mode == 'best', compact = args.compact)
+    elif args.kernel == 'noisyortwoy-uniform':
+        c = ibp.noisyortwoy.UniformGibbs(cl_mode = args.opencl, cl_device = args.opencl_device)
+    elif args.kernel == 'noisyortwoy-biased':
+        c = ibp.noisyortwoy.BiasedGibbs(cl_mode = args.opencl, cl_device = args.opencl_device)
 
-# run the sample through multiple chains
-for chain in xrange(args.chain):
-    # set up the output file
-    if args.output_to_file: 
-        if args.opencl:
-            sample_dest = output_path + input_filename + '-%d-%s-chain-%d-cl/' % (args.iter - args.burnin, args.kernel, chain + 1)
+    c.read_csv(args.data_file)
+    c.set_sampling_params(niter = args.iter, burnin = args.burnin)
+
+    # run the sample through multiple chains
+    for chain in xrange(args.chain):
+        # set up the output file
+        if args.output_to_file: 
+            if args.opencl:
+                sample_dest = output_path + input_filename + '-%d-%s-chain-%d-cl/' % (args.iter - args.burnin, args.kernel, chain + 1)
+            else:
+                sample_dest = output_path + input_filename + '-%d-%s-chain-%d-nocl/' % (args.iter - args.burnin, args.kernel, chain + 1)
+        elif args.output_to_stdout:
+            sample_dest = sys.stdout
         else:
-            sample_dest = output_path + input_filename + '-%d-%s-chain-%d-nocl/' % (args.iter - args.burnin, args.kernel, chain + 1)
-    elif args.output_to_stdout:
-        sample_dest = sys.stdout
-    else:
-        sample_dest = None
+            sample_dest = None
 
-    print("Chain %d running, please wait ..." % (chain + 1), file=sys.stderr)
-    gpu_time, total_time, common_clusters = c.do_inference(output_file = sample_dest)
-    print("Chain %d finished. OpenCL device time: %f; Total_time: %f seconds\n" % (chain + 1, gpu_time, total_time), file=sys.stderr)
+        print("Chain %d running, please wait ..." % (chain + 1), file=sys.stderr)
+        gpu_time, total_time, common_clusters = c.do_inference(output_file = sample_dest)
+        print("Chain %d finished. OpenCL device time: %f; Total_time: %f seconds\n" % (chain + 1, gpu_time, total_time), file=sys.stderr)
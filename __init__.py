@@ -1,4 +1,11 @@
 from base.sampler import *
 from base.predictor import *
+from base.noisyor import NoisyOrLikelihood, NoisyOrSampler, score_sample
+from base.packed import PackedRows, feature_counts
+from base.images import read_images
+from base.features import FeatureState
+from base.samples import SampleArchive, save_samples
+from base.cache import LRUCache
+from base.server import PredictionServer, PredictionClient
 
 __VERSION__ = '0.01'
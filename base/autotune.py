@@ -0,0 +1,116 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+from __future__ import print_function
+import sys, os, os.path, json
+from fractions import gcd
+from time import time
+
+def round_up_pow2(x):
+    """Round a positive integer up to the nearest power of two.
+    """
+    p = 1
+    while p < x: p *= 2
+    return p
+
+def local_size_candidates(device, global_shape, preferred_multiple):
+    """List the work-group shapes worth timing for a kernel launched over
+    global_shape: None (let the driver decide), the gcd rule of thumb, and
+    power-of-two shapes that evenly divide global_shape and whose total size
+    is a multiple of the kernel's preferred work-group size multiple.
+    """
+    candidates = [None, tuple(gcd(_, preferred_multiple) for _ in global_shape)]
+    max_size = device.max_work_group_size
+    max_items = device.max_work_item_sizes
+    # power-of-two divisors of each dimension
+    divisors = []
+    for dim, extent in enumerate(global_shape):
+        divisors.append([2 ** p for p in xrange(12)
+                         if 2 ** p <= min(extent, max_items[dim]) and extent % 2 ** p == 0])
+    shapes = [()]
+    for dim_divisors in divisors:
+        shapes = [_ + (d,) for _ in shapes for d in dim_divisors]
+    for shape in shapes:
+        size = reduce(lambda a, b: a * b, shape, 1)
+        if size <= max_size and size % preferred_multiple == 0 and shape not in candidates:
+            candidates.append(shape)
+    return candidates
+
+class KernelTuner(object):
+    """Times the eligible variants of a sampling step (alternative kernels,
+    work-group shapes) on the device the first time a problem size is seen,
+    and keeps the fastest one in an on-disk cache so that later runs pick it
+    without timing anything.
+    """
+
+    def __init__(self, cache_path = None, repeat = 3):
+        """Initialize the tuner.
+        @param cache_path: Location of the tuning cache. Default is ~/.mpbnp/kernel_tuning.json
+        @param repeat: Number of timed launches per candidate
+        """
+        if cache_path is None:
+            cache_path = os.path.join(os.path.expanduser('~'), '.mpbnp', 'kernel_tuning.json')
+        self.cache_path = cache_path
+        self.repeat = repeat
+        self.enabled = True
+        self.tuning_time = 0. # seconds spent timing candidates
+        self.cache = {}
+        try: self.cache = json.load(open(self.cache_path))
+        except (IOError, ValueError): pass
+
+    def problem_key(self, device, step, shape, exact):
+        """Build the cache key of a step on a device. Unless exact is set, the
+        problem dimensions are rounded up to powers of two so that nearby sizes
+        (e.g., a changing number of clusters) share a tuning result.
+        """
+        if not exact: shape = [round_up_pow2(_) for _ in shape]
+        return '|'.join([device.platform.name.strip(), device.name.strip(), device.driver_version.strip(),
+                         step, 'x'.join([str(int(_)) for _ in shape])])
+
+    def choose(self, device, step, shape, candidates, run, default, exact = False):
+        """Return the fastest of candidates for step at problem size shape. On a
+        cache miss, every candidate is passed to run() once as a warm-up and then
+        self.repeat times to be timed; run() must block until the device is done.
+        Candidates that fail to launch are skipped. If tuning is disabled, default
+        is returned.
+        @param exact: Key the cache on exact dimensions (needed for work-group shapes)
+        """
+        import pyopencl as cl
+        if not self.enabled: return default
+
+        key = self.problem_key(device, step, shape, exact)
+        normalized = [json.loads(json.dumps(_)) for _ in candidates]
+        if key in self.cache and self.cache[key] in normalized:
+            return candidates[normalized.index(self.cache[key])]
+
+        tuning_start = time()
+        best, best_time = default, None
+        for candidate in candidates:
+            try:
+                run(candidate)
+                a_time = time()
+                for _ in xrange(self.repeat): run(candidate)
+                elapsed = time() - a_time
+            except cl.Error:
+                continue
+            if best_time is None or elapsed < best_time:
+                best, best_time = candidate, elapsed
+
+        self.tuning_time += time() - tuning_start
+        print('Tuned %s for size %s: %s' % (step, 'x'.join([str(int(_)) for _ in shape]), best), file=sys.stderr)
+        self.cache[key] = json.loads(json.dumps(best))
+        self.save()
+        return best
+
+    def save(self):
+        """Write the tuning cache to disk.
+        """
+        try:
+            cache_dir = os.path.dirname(self.cache_path)
+            if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+            temp_path = self.cache_path + '.%d' % os.getpid()
+            with open(temp_path, 'w') as cache_file:
+                json.dump(self.cache, cache_file, indent = 1, sort_keys = True)
+            os.rename(temp_path, self.cache_path)
+        except (IOError, OSError):
+            print('Unable to write the kernel tuning cache to %s' % self.cache_path, file=sys.stderr)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+from __future__ import print_function
+import collections
+
+class LRUCache(object):
+    """A dictionary that holds values up to a total size in bytes, given for
+    each value when it is put in, and drops the least recently used values to
+    make room for new ones.
+    """
+
+    def __init__(self, max_bytes):
+        """Initialize the cache.
+        @param max_bytes: The most bytes the values may take together
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = collections.OrderedDict() # key -> (value, size), least recently used first
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """Return the value under key and mark it as the most recently used,
+        or None if it is not in the cache.
+        """
+        if key not in self.entries: return None
+        entry = self.entries.pop(key)
+        self.entries[key] = entry
+        return entry[0]
+
+    def put(self, key, value, nbytes):
+        """Store a value of nbytes bytes under key. Return False without storing
+        it if it is larger than the whole cache.
+        """
+        if key in self.entries: self.nbytes -= self.entries.pop(key)[1]
+        if nbytes > self.max_bytes: return False
+        while self.nbytes + nbytes > self.max_bytes:
+            self.nbytes -= self.entries.popitem(last = False)[1][1]
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        return True
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
@@ -0,0 +1,97 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+from __future__ import print_function
+import numpy as np
+
+class FeatureState(object):
+    """The arrays of a sampler state that have one slice per feature, such as
+    Y, Z, F and R, kept together in buffers with room for more features than
+    are in use. Indexing by name returns a view of the K features in use, so
+    samplers read and write the state in place. New features are appended
+    into the spare room, which doubles when it runs out, and deleted features
+    are swapped with the last one in use, so neither births nor deaths copy
+    the features that stay.
+
+    The slices past K are kept zero, which lets callers append features that
+    are mostly zero by writing only their nonzero entries.
+    """
+
+    def __init__(self, arrays, capacity = None):
+        """Copy the initial state into new buffers.
+        @param arrays: A list of (name, array, axis) triples, where axis is the
+                       feature axis of the array; all arrays have the same
+                       number of features
+        @param capacity: The initial number of features there is room for
+        """
+        self.k = arrays[0][1].shape[arrays[0][2]]
+        self.capacity = max(capacity or 0, 2 * self.k, 1)
+        self.axes, self.buffers = {}, {}
+        for name, array, axis in arrays:
+            assert(array.shape[axis] == self.k)
+            shape = list(array.shape)
+            shape[axis] = self.capacity
+            self.axes[name] = axis
+            self.buffers[name] = np.zeros(shape, dtype = array.dtype)
+        self.load(**dict((name, array) for name, array, _ in arrays))
+
+    def _slice(self, name, features):
+        return (slice(None),) * self.axes[name] + (features,)
+
+    def __getitem__(self, name):
+        return self.buffers[name][self._slice(name, slice(0, self.k))]
+
+    def copy(self, *names):
+        """Return copies of the named arrays, e.g. to store as a sample.
+        """
+        return tuple(self[name].copy() for name in names)
+
+    def load(self, **arrays):
+        """Replace the state with the given arrays, which may have a different
+        number of features.
+        """
+        k = arrays.values()[0].shape[self.axes[arrays.keys()[0]]]
+        self.reserve(k)
+        for name, buf in self.buffers.items():
+            buf[self._slice(name, slice(0, max(k, self.k)))] = 0
+            buf[self._slice(name, slice(0, k))] = arrays[name]
+        self.k = k
+
+    def reserve(self, k):
+        """Make room for k features, at least doubling the capacity if needed.
+        """
+        if k <= self.capacity: return
+        self.capacity = max(k, 2 * self.capacity)
+        for name, buf in self.buffers.items():
+            shape = list(buf.shape)
+            shape[self.axes[name]] = self.capacity
+            grown = np.zeros(shape, dtype = buf.dtype)
+            grown[self._slice(name, slice(0, self.k))] = self[name]
+            self.buffers[name] = grown
+
+    def append(self, k_new, **blocks):
+        """Add k_new features after the ones in use and return their index
+        range. Arrays without a block keep zeros for the new features.
+        @param blocks: name=array pairs with k_new slices along the feature axis
+        """
+        self.reserve(self.k + k_new)
+        new = slice(self.k, self.k + k_new)
+        for name, block in blocks.items():
+            self.buffers[name][self._slice(name, new)] = block
+        self.k += k_new
+        return new
+
+    def remove(self, features):
+        """Delete features by moving the last feature in use into each of
+        their places, which reorders the features that stay.
+        @param features: Indices or a boolean mask of the features to delete
+        """
+        features = np.asarray(features)
+        if features.dtype == np.bool_: features = np.where(features)[0]
+        for kth in np.sort(features)[::-1]:
+            last = self.k - 1
+            for name, buf in self.buffers.items():
+                if kth != last:
+                    buf[self._slice(name, kth)] = buf[self._slice(name, last)]
+                buf[self._slice(name, last)] = 0
+            self.k -= 1
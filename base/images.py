@@ -0,0 +1,133 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+from __future__ import print_function
+import numpy as np
+import sys, os, os.path, gzip, mimetypes
+from packed import PackedRows
+
+FORMAT_ERROR = 'The sampler does not understand the format of the data. Did you forget to specify image width in the data file?'
+
+def _parse_chunk(lines, width, d, first_row):
+    """Convert the lines of a chunk of binary images to a uint8 array. When
+    every pixel is a single digit, the pixels of all lines are read straight
+    from the characters at even offsets; other lines are split on commas.
+    """
+    rests = []
+    for i, line in enumerate(lines):
+        img_w, _, rest = line.rstrip('\r\n').partition(',')
+        if int(img_w) != width:
+            raise Exception('Image %d has width %s instead of %d' % (first_row + i, img_w, width))
+        if len(rest) != 2 * d - 1:
+            rest = rest.split(',')
+            if len(rest) != d:
+                raise Exception('Image %d has %d pixels instead of %d' % (first_row + i, len(rest), d))
+            rest = ','.join([str(int(_)) for _ in rest])
+            if len(rest) != 2 * d - 1:
+                raise Exception('Image %d is not binary' % (first_row + i))
+        rests.append(rest)
+    chunk = np.frombuffer(','.join(rests)[::2], dtype=np.uint8).reshape((len(lines), d)) - ord('0')
+    if chunk.size > 0 and chunk.max() > 1:
+        raise Exception('The images from row %d on are not binary' % first_row)
+    return chunk
+
+def _cache_stamp(filepath, header):
+    """The size and modification time of a data file, and whether its first
+    line was read as a header, which a cache must match to be used.
+    """
+    stat = os.stat(filepath)
+    return np.array([stat.st_size, stat.st_mtime, header], dtype=np.float64)
+
+def read_images(filepath, header = True, rows = None, packed = False, cache = True, chunk_size = 4096):
+    """Read binary images from a csv file in which each row is the width of the
+    image followed by its flattened pixels. The width is parsed from the first
+    image and every image is checked against it. The file is read in chunks of
+    rows straight into a uint8 array, or into bit-packed rows if packed is set.
+
+    A full read writes a cache of the packed images next to the data file
+    (<filepath>.cache.npz), which later reads with the same header setting
+    use as long as the size and modification time of the data file have not
+    changed since. An edit that keeps the size of the file within the
+    timestamp resolution of the file system goes unnoticed; read with
+    cache = False after such edits.
+
+    Blank lines are skipped and are not images.
+
+    @param rows: Indices of the images to read, in the order they are wanted;
+                 the rest of the file is skipped without being parsed
+    @param packed: Return the images as PackedRows instead of a uint8 array
+    @param cache: Read from and write to the binary cache
+    @return: The images and the image width
+    """
+    cache_path = filepath + '.cache.npz'
+    if cache and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if np.array_equal(cached['stamp'], _cache_stamp(filepath, header)):
+            bits, shape = cached['bits'], tuple(cached['shape'])
+            if rows is not None:
+                rows = np.asarray(rows, dtype=np.int64)
+                if rows.size > 0 and rows.max() >= shape[0]:
+                    raise Exception('The data file has fewer than %d images' % (rows.max() + 1))
+                bits = bits[rows]
+                shape = (bits.shape[0], shape[1])
+            images = PackedRows.from_bits(bits, shape)
+            return (images if packed else images[:]), int(cached['width'])
+
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+        wanted = np.unique(rows)
+        keep = np.zeros(wanted[-1] + 1 if wanted.size > 0 else 0, dtype=np.bool_)
+        keep[wanted] = True
+
+    filetype, encoding = mimetypes.guess_type(filepath)
+    if encoding == 'gzip':
+        csvfile = gzip.open(filepath, 'r')
+    else:
+        csvfile = open(filepath, 'r')
+    if header: csvfile.readline()
+
+    width, d = None, None
+    chunks, lines = [], []
+    first_row = 0
+    i = -1 # the index of the image on the current line
+    for line in csvfile:
+        if not line.strip(): continue
+        i += 1
+        if rows is not None:
+            if i >= keep.shape[0]: break
+            if not keep[i]: continue
+        if width is None:
+            fields = line.rstrip('\r\n').split(',')
+            width, d = int(fields[0]), len(fields) - 1
+            if width <= 0 or d == 0 or d % width != 0:
+                raise Exception(FORMAT_ERROR)
+        lines.append(line)
+        if len(lines) == chunk_size:
+            chunk = _parse_chunk(lines, width, d, first_row)
+            chunks.append(np.packbits(chunk, axis = 1) if packed else chunk)
+            first_row += len(lines)
+            lines = []
+    csvfile.close()
+    if width is None:
+        raise Exception(FORMAT_ERROR)
+    if lines:
+        chunk = _parse_chunk(lines, width, d, first_row)
+        chunks.append(np.packbits(chunk, axis = 1) if packed else chunk)
+    images = np.vstack(chunks)
+
+    if rows is not None:
+        if first_row + len(lines) < wanted.size:
+            raise Exception('The data file has fewer than %d images' % (wanted[-1] + 1))
+        images = images[np.searchsorted(wanted, rows)]
+    elif cache:
+        bits = images if packed else np.packbits(images, axis = 1)
+        try:
+            with open(cache_path + '.tmp', 'wb') as f:
+                np.savez(f, bits = bits, shape = np.array([bits.shape[0], d]), width = width,
+                         stamp = _cache_stamp(filepath, header))
+            os.rename(cache_path + '.tmp', cache_path)
+        except (IOError, OSError) as e:
+            print('Could not write the image cache %s: %s' % (cache_path, e), file=sys.stderr)
+
+    if packed: images = PackedRows.from_bits(images, (images.shape[0], d))
+    return images, width
@@ -0,0 +1,324 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+from __future__ import print_function
+import numpy as np
+import hashlib, random
+from scipy.stats import poisson
+from scipy.special import logsumexp
+from cache import LRUCache
+
+def score_sample(cur_y, lam, epislon, noisyor, obs):
+    """Return the log scores of the test cases obs under one sample of Y and
+    the lambda and epislon that go with it, for the noisy-or predictors.
+    """
+    return noisyor.marginal_logliks(obs, cur_y, lam, epislon)
+
+class NoisyOrSampler(object):
+    """Metropolis-Hastings moves on lambda and epislon, shared by the noisy-or
+    samplers, which keep a NoisyOrLikelihood in self.noisyor.
+    """
+
+    def _sample_lam(self, hist):
+        """Resample the value of lambda.
+        @param hist: The (observed value, count) histogram of the current sample
+        """
+        self._sample_param('lam', hist)
+
+    def _sample_epislon(self, hist):
+        """Resample the value of epislon.
+        @param hist: The (observed value, count) histogram of the current sample
+        """
+        self._sample_param('epislon', hist)
+
+    def _sample_param(self, name, hist):
+        """Propose a new value of the named parameter from its Beta(1, 1) prior
+        and accept it with the Barker probability.
+        """
+        old_loglik = self.noisyor.count_loglik(hist, self.lam, self.epislon)
+        old_value = getattr(self, name)
+        setattr(self, name, np.random.beta(1,1))
+        new_loglik = self.noisyor.count_loglik(hist, self.lam, self.epislon)
+        with np.errstate(over = 'ignore'):
+            move_prob = 1 / (1 + np.exp(old_loglik - new_loglik))
+        if random.random() >= move_prob:
+            setattr(self, name, old_value)
+
+class NoisyOrLikelihood(object):
+    """The noisy-or loglikelihood of binary pixels, tabulated by the number of
+    active features that have a pixel on. A pixel with count c is off with
+    probability (1 - lambda)^c * (1 - epislon), so for given lambda and epislon
+    the loglikelihood of every pixel is a lookup into a (2, max count + 1)
+    table indexed by (observed value, count). The table is only rebuilt when
+    lambda or epislon changes or a larger count shows up.
+    """
+
+    def __init__(self, max_count = 16, cache_bytes = 2 ** 28):
+        """Initialize the tables.
+        @param max_count: Initial largest tabulated count; grows as needed
+        @param cache_bytes: The most memory the patterns that marginal_logliks()
+                            keeps between calls may take
+        """
+        self.max_count = max_count
+        self.lam, self.epislon = None, None
+        self.table = None
+        self.max_exact = 16 # most features whose on/off patterns marginal_loglik() enumerates
+        self.mc_samples = 65536 # most particles it uses for more features than that
+        self.mc_replicas = 4 # independent estimates it averages and judges the error by
+        self.mc_tolerance = 0.01 # relative standard error at which it stops
+        self.max_fallback = 24 # most features it enumerates instead when the estimate misses mc_tolerance
+        self.block_size = 4096 # patterns evaluated at once
+        self.chunk_size = 2 ** 22 # most (test image, pattern) pairs marginal_logliks() scores at once
+        self.cache = LRUCache(cache_bytes)
+
+    def tables(self, lam, epislon, max_count = 0):
+        """Return the (2, max count + 1) table of loglikelihoods, where row 0
+        is for pixels that are off and row 1 for pixels that are on.
+        """
+        if max_count > self.max_count:
+            self.max_count = max(max_count, 2 * self.max_count)
+            self.table = None
+        if self.table is None or lam != self.lam or epislon != self.epislon:
+            self.lam, self.epislon = lam, epislon
+            with np.errstate(divide = 'ignore'):
+                not_on_p = np.power(1. - lam, np.arange(self.max_count + 1)) * (1. - epislon)
+                self.table = np.log(np.vstack((not_on_p, 1. - not_on_p)))
+        return self.table
+
+    def loglik(self, obs, counts, lam, epislon):
+        """Return the loglikelihood of each pixel of obs given the counts of
+        active features that have it on. obs and counts are broadcast together.
+        """
+        obs, counts = np.asarray(obs), np.asarray(counts)
+        if obs.dtype.kind not in 'iu': obs = obs.astype(np.int64)
+        max_count = counts.max() if counts.size > 0 else 0
+        return self.tables(lam, epislon, max_count)[obs, counts]
+
+    def count_histogram(self, obs, counts, width = None):
+        """Return the (2, max count + 1) histogram of (observed value, count)
+        pairs over all pixels. The noisy-or loglikelihood of the data depends
+        on the data only through this histogram.
+        @param width: The number of count columns, to add up histograms of chunks
+        """
+        counts = np.asarray(counts).astype(np.int64, copy = False).ravel()
+        if width is None: width = counts.max() + 1 if counts.size > 0 else 1
+        cells = np.asarray(obs).astype(np.int64, copy = False).ravel() * width + counts
+        return np.bincount(cells, minlength = 2 * width).reshape((2, width))
+
+    def count_loglik(self, hist, lam, epislon):
+        """Return the loglikelihood of the data summarized by a histogram from
+        count_histogram(), in time proportional to the largest count.
+        """
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            not_on_p = np.power(1. - lam, np.arange(hist.shape[1])) * (1. - epislon)
+            logp = np.log(np.vstack((not_on_p, 1. - not_on_p)))
+            return np.where(hist > 0, hist * logp, 0.).sum()
+
+    def marginal_loglik(self, obs, cur_y, lam, epislon, log_on = None, log_off = None,
+                        novel = None, novel_rate = None, return_error = False):
+        """Return the log of the sum over the on/off patterns z of the features cur_y of
+        p(z) * p(obs | z), enumerated up to max_exact features and estimated beyond.
+        @param obs: One binary image
+        @param log_on, log_off: The log prior probabilities of each feature being on and off
+        @param novel: Mask of the features whose count takes the Poisson prior
+        @param return_error: Also return the estimated standard error of the log, 0 if exact
+        """
+        k = cur_y.shape[0]
+        if log_on is None: log_on, log_off = np.zeros(k), np.zeros(k)
+        if novel is None: novel = np.zeros(k, dtype=np.bool_)
+        on = np.asarray(obs) == 1
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            off_pixels = cur_y[:,~on].sum(axis = 1)
+            log_on = log_on + np.where(off_pixels > 0, off_pixels * np.log(1. - lam), 0.)
+            loglik = (~on).sum() * np.log(1. - epislon)
+            free = ~(cur_y[:,on].any(axis = 1) | novel)
+            loglik += np.logaddexp(log_off[free], log_on[free]).sum()
+
+        # the features that cover none of the pixels that are on are summed out above
+        idx = np.where(~free)[0]
+        args = (cur_y[idx][:,on], log_on[idx], log_off[idx], novel[idx], novel_rate, lam, epislon)
+        if idx.shape[0] <= self.max_exact:
+            sum_loglik, error = self._exact_loglik(*args), 0.
+        else:
+            sum_loglik, error = self._sampled_loglik(*args)
+        if return_error: return loglik + sum_loglik, error
+        return loglik + sum_loglik
+
+    def marginal_logliks(self, obs, cur_y, lam, epislon, log_on = None, log_off = None,
+                         novel = None, novel_rate = None):
+        """Return marginal_loglik() of every image in obs. Up to max_exact
+        features, the patterns are enumerated once for all images, and the
+        loglikelihoods of a block of patterns for all images come from two
+        matrix products in log space: one of the pixels that are on with the
+        loglikelihoods of the counts of the patterns, and one of the number of
+        pixels that are off under each feature with the patterns, as each such
+        pixel contributes log(1 - lambda) per feature that covers it. Images
+        are scored in chunks of at most chunk_size (image, pattern) pairs.
+        With more features the images are scored one at a time.
+        """
+        obs = np.asarray(obs)
+        k = cur_y.shape[0]
+        if k > self.max_exact:
+            return np.array([self.marginal_loglik(_, cur_y, lam, epislon, log_on, log_off, novel, novel_rate)
+                             for _ in obs])
+
+        on = (obs == 1).astype(np.float64)
+        off_cover = (1. - on).dot(cur_y.T) # pixels that are off and covered by each feature
+        with np.errstate(divide = 'ignore'):
+            log_not_lam, log_not_eps = np.log(1. - lam), np.log(1. - epislon)
+        loglik = np.empty(obs.shape[0])
+        loglik.fill(-np.inf)
+        for bits, on_loglik, logp in self.pattern_blocks(cur_y, lam, epislon, log_on, log_off, novel, novel_rate):
+            rows = max(1, self.chunk_size // bits.shape[1])
+            for start in xrange(0, obs.shape[0], rows):
+                chunk = slice(start, start + rows)
+                covered = off_cover[chunk].dot(bits)
+                with np.errstate(invalid = 'ignore'):
+                    block_loglik = on[chunk].dot(on_loglik) + np.where(covered > 0, covered * log_not_lam, 0.)
+                loglik[chunk] = np.logaddexp(loglik[chunk], logsumexp(block_loglik + logp, axis = 1))
+        return loglik + (1. - on).sum(axis = 1) * log_not_eps
+
+    def pattern_blocks(self, cur_y, lam, epislon, log_on = None, log_off = None,
+                       novel = None, novel_rate = None):
+        """Return the on/off patterns of the features cur_y in blocks, as
+        (bits, on_loglik, logp) triples: the (K, patterns) bits of the
+        patterns, the (D, patterns) loglikelihoods of each pixel being on
+        under each pattern, and the log prior of each pattern.
+
+        None of these depend on the images being scored, so they are kept in
+        the cache under the content of cur_y and the parameters, and samples
+        that are equal, as when a chain sticks, share them. Patterns that take
+        more memory than the cache are computed one block at a time instead.
+        """
+        k, d = cur_y.shape
+        if log_on is None: log_on, log_off = np.zeros(k), np.zeros(k)
+        if novel is None: novel = np.zeros(k, dtype=np.bool_)
+        key = tuple(hashlib.sha1(np.ascontiguousarray(_)).hexdigest() for _ in (cur_y, log_on, log_off, novel))
+        key += (cur_y.shape, cur_y.dtype.str, lam, epislon, novel_rate)
+        blocks = self.cache.get(key)
+        if blocks is not None: return blocks
+
+        table = self.tables(lam, epislon, k)[1]
+        size = max(1, min(2 ** k, self.chunk_size // max(d, 1)))
+        def block(start):
+            codes = np.arange(start, min(start + size, 2 ** k))
+            bits = (codes[:,np.newaxis] >> np.arange(k)) & 1
+            logp = np.where(bits == 1, log_on, log_off).sum(axis = 1)
+            if novel.any():
+                num_novel = bits[:,novel].sum(axis = 1)
+                logp += np.where(num_novel > 0, poisson.logpmf(num_novel, novel_rate), 0.)
+            return bits.T.astype(np.float64), np.ascontiguousarray(table[bits.dot(cur_y)].T), logp
+        blocks = (block(_) for _ in xrange(0, 2 ** k, size))
+        nbytes = 2 ** k * (k + d + 1) * 8
+        if nbytes > self.cache.max_bytes: return blocks
+        blocks = list(blocks)
+        self.cache.put(key, blocks, nbytes)
+        return blocks
+
+    def _pattern_loglik(self, bits, y_on, log_on, log_off, novel, novel_rate, lam, epislon):
+        """Return log p(z) + the loglikelihood of the pixels that are on for
+        each pattern z in the rows of bits.
+        """
+        logp = np.where(bits == 1, log_on, log_off).sum(axis = 1)
+        logp += self.tables(lam, epislon, y_on.shape[0])[1][bits.dot(y_on)].sum(axis = 1)
+        if novel.any():
+            num_novel = bits[:,novel].sum(axis = 1)
+            logp += np.where(num_novel > 0, poisson.logpmf(num_novel, novel_rate), 0.)
+        return logp
+
+    def _exact_loglik(self, y_on, *args):
+        m = y_on.shape[0]
+        sums = []
+        for start in xrange(0, 2 ** m, self.block_size):
+            codes = np.arange(start, min(start + self.block_size, 2 ** m))
+            bits = (codes[:,np.newaxis] >> np.arange(m)) & 1
+            logp = self._pattern_loglik(bits, y_on, *args)
+            sums.append(np.logaddexp.reduce(logp))
+        return np.logaddexp.reduce(sums)
+
+    def _sampled_loglik(self, y_on, log_on, log_off, novel, novel_rate, lam, epislon):
+        """Return the mean of mc_replicas runs of _smc_loglik() and its relative standard error, or
+        the exact sum if they disagree even with mc_samples particles and there are few enough features.
+        """
+        particles = max(1, min(self.block_size, self.mc_samples) // self.mc_replicas)
+        # the first run starts _on_probabilities() from the prior, the others at random
+        while True:
+            logliks = np.array([self._smc_loglik(particles, y_on, log_on, log_off, novel, novel_rate, lam, epislon, _ > 0)
+                                for _ in xrange(self.mc_replicas)])
+            loglik = logsumexp(logliks) - np.log(self.mc_replicas)
+            if np.isinf(loglik):
+                rel_se = np.inf
+                break
+            rel_se = np.exp(logliks - loglik).std(ddof = 1) / np.sqrt(self.mc_replicas)
+            if rel_se < self.mc_tolerance: return loglik, rel_se
+            if 2 * particles * self.mc_replicas > self.mc_samples: break
+            particles *= 2
+        if y_on.shape[0] <= self.max_fallback:
+            return self._exact_loglik(y_on, log_on, log_off, novel, novel_rate, lam, epislon), 0.
+        return loglik, rel_se
+
+    def _smc_loglik(self, particles, y_on, log_on, log_off, novel, novel_rate, lam, epislon, restart = False):
+        """Estimate the log of the sum over patterns with a sequential Monte Carlo
+        sampler that decides the features one at a time, looking ahead with _on_probabilities().
+        @param restart: Start _on_probabilities() from random probabilities rather than the prior
+        """
+        m, d = y_on.shape
+        q = self._on_probabilities(y_on, log_on, log_off, lam, epislon, restart)
+        with np.errstate(divide = 'ignore'):
+            # the probability of no feature after the kth turning each pixel on
+            later = np.exp(np.vstack((np.cumsum((y_on * np.log(1. - q * lam)[:,np.newaxis])[::-1], axis = 0)[::-1],
+                                      np.zeros(d))))
+            novel_logp = np.zeros(m + 2)
+            if novel.any(): novel_logp[1:] = poisson.logpmf(np.arange(1, m + 2), novel_rate)
+        # the probability of a pixel being off by the count of features decided on
+        off_p = (1. - epislon) * np.power(1. - lam, np.arange(m + 1))
+
+        total_logp = np.logaddexp(log_on, log_off)
+        with np.errstate(divide = 'ignore'):
+            loglik = total_logp.sum() + np.log1p(-off_p[0] * later[0]).sum()
+        counts = np.zeros((particles, d), dtype=np.int64)
+        num_novel = np.zeros(particles, dtype=np.int64)
+        for k in xrange(m):
+            pixels = y_on[k] == 1
+            pixel_off_p = off_p[counts[:,pixels]]
+            with np.errstate(divide = 'ignore'):
+                before = np.log1p(-pixel_off_p * later[k][pixels])
+                on_logp = (np.log1p(-pixel_off_p * (1. - lam) * later[k + 1][pixels]) - before).sum(axis = 1)
+                off_logp = (np.log1p(-pixel_off_p * later[k + 1][pixels]) - before).sum(axis = 1)
+            on_logp += log_on[k] - total_logp[k]
+            off_logp += log_off[k] - total_logp[k]
+            if novel[k]: on_logp += novel_logp[num_novel + 1] - novel_logp[num_novel]
+            logp = np.logaddexp(off_logp, on_logp)
+            loglik += logsumexp(logp) - np.log(particles)
+            if np.isinf(loglik): return loglik
+
+            # systematic resampling by the weights of the step
+            weights = np.exp(logp - logp.max()).cumsum()
+            picks = np.searchsorted(weights, (np.random.random() + np.arange(particles)) * (weights[-1] / particles))
+            picks = np.minimum(picks, particles - 1)
+            counts, num_novel, on_logp, logp = counts[picks], num_novel[picks], on_logp[picks], logp[picks]
+            z = np.random.random(particles) < np.exp(on_logp - logp)
+            counts[z] += y_on[k]
+            num_novel[z] += novel[k]
+        return loglik
+
+    def _on_probabilities(self, y_on, log_on, log_off, lam, epislon, restart = False, sweeps = 10):
+        """Return an approximation of the posterior probability of each
+        feature being on: a fixed point of setting each in turn to its
+        probability given the pixels that are on, with the others on
+        independently with their current probabilities.
+        """
+        with np.errstate(divide = 'ignore', over = 'ignore'):
+            q = np.random.random(y_on.shape[0]) if restart else 1. / (1. + np.exp(log_off - log_on))
+            log_miss = y_on * np.log(1. - q * lam)[:,np.newaxis] # log p(pixel not caused) per feature
+            total_miss = log_miss.sum(axis = 0)
+            for _ in xrange(sweeps):
+                for k in xrange(y_on.shape[0]):
+                    pixels = y_on[k] == 1
+                    others = np.minimum(total_miss[pixels] - log_miss[k,pixels], 0.)
+                    gain = (np.log1p(-(1. - epislon) * (1. - lam) * np.exp(others)) -
+                            np.log1p(-(1. - epislon) * np.exp(others))).sum()
+                    q[k] = 1. / (1. + np.exp(log_off[k] - log_on[k] - gain))
+                    total_miss[pixels] = others + np.log(1. - q[k] * lam)
+                    log_miss[k,pixels] = total_miss[pixels] - others
+        return q
@@ -0,0 +1,58 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+from __future__ import print_function
+import numpy as np
+import scipy.sparse
+
+def count_dtype(max_count):
+    """Return the smallest unsigned integer type that holds counts up to max_count.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_count <= np.iinfo(dtype).max: return dtype
+    return np.uint64
+
+def feature_counts(cur_z, cur_y):
+    """Return Z * Y, the number of active features that have each pixel of each
+    data point on, as a product of Z in CSR form with the dense feature images.
+    Only the features a data point owns are visited, and the counts are kept in
+    the smallest type that can hold the number of features.
+    @param cur_z: Z as a dense matrix, or already in CSR form
+    """
+    dtype = count_dtype(cur_z.shape[1])
+    return np.asarray(scipy.sparse.csr_matrix(cur_z, dtype = dtype).dot(cur_y.astype(dtype, copy = False)))
+
+class PackedRows(object):
+    """A binary matrix with every row packed into bits, eight values to a byte.
+    Indexing selects rows as it would on a NumPy array and returns them
+    unpacked as uint8, so code that reads the data a few rows at a time does
+    not need to know about the packing.
+    """
+
+    def __init__(self, dense):
+        """Pack a dense binary matrix.
+        @param dense: A matrix of 0s and 1s
+        """
+        dense = np.asarray(dense)
+        self.shape = dense.shape
+        self.packed = np.packbits(dense != 0, axis = -1)
+
+    @classmethod
+    def from_bits(cls, bits, shape):
+        """Wrap rows that are already packed with np.packbits.
+        @param bits: The packed rows
+        @param shape: The shape of the unpacked matrix
+        """
+        rows = cls.__new__(cls)
+        rows.shape, rows.packed = tuple(shape), bits
+        return rows
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def __getitem__(self, rows):
+        return np.unpackbits(self.packed[rows], axis = -1)[...,:self.shape[-1]]
@@ -4,9 +4,18 @@
 from __future__ import print_function
 import pyopencl as cl, numpy as np
 import pyopencl.array
-import sys, copy, random, math, csv, gzip, mimetypes, os.path
+import sys, copy, random, math, csv, gzip, mimetypes, os.path, multiprocessing
 import cPickle
 from time import time
+from samples import SampleArchive
+
+def _init_pool_worker():
+    # reseed every worker so that they do not draw the same random numbers
+    np.random.seed()
+
+def _run_pool_task(args):
+    func, samples, shared_args = args
+    return [func(*(tuple(_) + shared_args)) for _ in samples]
 
 def lognormalize(x):
     # adapt it to numpypy
@@ -51,6 +60,8 @@ class BasePredictor(object):
         self.cl_mode = cl_mode
         self.obs = []
         self.samples = {}
+        self.num_workers = 1 # processes map_samples() spreads samples over
+        self.pool = None # the pool of those processes, started by the first map_samples() that needs it
         
     def read_test_csv(self, filepath, header = True):
         """Read test data from a csv file.
@@ -94,7 +105,58 @@ class BasePredictor(object):
         """
         self.samples = cPickle.load(open(file_path))
         return True
+
+    def read_samples_npz(self, var_name, file_path):
+        """Open the samples of a variable in a .npz archive written by a
+        sampler in 'all' mode. The samples are read lazily through memory
+        maps, only once they are selected and used.
+        """
+        self.samples[var_name] = SampleArchive(file_path)
+        return True
         
+    def select_samples(self, var_name, thining = 0, burnin = 0, use_iter = None):
+        """Return the samples of a variable that are used for prediction: those
+        after burn-in, every thining-th of them, or only the one at use_iter.
+        """
+        if use_iter is not None: return [self.samples[var_name][use_iter]]
+        return self.samples[var_name][burnin::max(thining, 1)]
+
+    def select_params(self, names, num_samples, thining = 0, burnin = 0, use_iter = None):
+        """Return the values of the named hyperparameters for each selected
+        sample: those kept with the samples if the sampler resampled them, or
+        else the predictor's own.
+        """
+        return zip(*[[float(_) for _ in self.select_samples(name, thining, burnin, use_iter)]
+                     if name in self.samples else [getattr(self, name)] * num_samples for name in names])
+
+    def map_samples(self, func, samples, shared_args = ()):
+        """Return [func(*(_ + shared_args)) for _ in samples], computed by a pool
+        of num_workers processes if there are more than one. The pool is kept
+        for later calls until close() is called. func must be a function at
+        the top level of a module, and it and its arguments picklable, so that
+        the workers need not be forked; the samples are split into one run of
+        consecutive samples per worker, and shared_args are sent once with
+        each run rather than with every sample.
+        """
+        shared_args = tuple(shared_args)
+        if self.num_workers <= 1 or len(samples) <= 1: return [func(*(tuple(_) + shared_args)) for _ in samples]
+        if self.pool is not None and self.pool_size != self.num_workers: self.close()
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.num_workers, initializer = _init_pool_worker)
+            self.pool_size = self.num_workers
+        bounds = np.linspace(0, len(samples), min(self.num_workers, len(samples)) + 1).astype(int)
+        runs = self.pool.map(_run_pool_task, [(func, samples[start:end], shared_args)
+                                              for start, end in zip(bounds[:-1], bounds[1:])], chunksize = 1)
+        return [_ for run in runs for _ in run]
+
+    def close(self):
+        """Stop the worker processes of map_samples(), if any.
+        """
+        if self.pool is None: return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
     def predict(self, thining = 0, burnin = 0, use_iter=None, output_file = None):
         """Predict the test cases
         """
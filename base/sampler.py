@@ -5,6 +5,9 @@ from __future__ import print_function
 import numpy as np
 import sys, copy, random, math, csv, gzip, mimetypes, os.path
 from time import time
+from fractions import gcd
+from scipy.stats import poisson
+from autotune import KernelTuner, local_size_candidates, round_up_pow2
 
 def smallest_unused_label(int_labels):
     
@@ -35,6 +38,57 @@ def sample(a, p):
             return a[i]
     return a[i]
 
+def sample_rows(a, logp):
+    """Sample one element of a for each row of unnormalized log probabilities
+    logp, using the CDF of every row at once.
+    """
+    cdf = np.cumsum(np.exp(logp - logp.max(axis = 1)[:,np.newaxis]), axis = 1)
+    r = np.random.random(logp.shape[0]) * cdf[:,-1]
+    return a[np.minimum((cdf < r[:,np.newaxis]).sum(axis = 1), len(a) - 1)]
+
+def multinomial_rows(n, p):
+    """Draw a multinomial sample of n[i] trials for each row of probabilities p,
+    as a sequence of binomial draws conditional on the preceding columns.
+    """
+    draws = np.zeros(p.shape, dtype=np.int64)
+    remaining = np.array(n, dtype=np.int64)
+    rest = np.ones(p.shape[0])
+    for k in xrange(p.shape[1] - 1):
+        draws[:,k] = np.random.binomial(remaining, np.clip(p[:,k] / np.maximum(rest, 1e-300), 0, 1))
+        remaining -= draws[:,k]
+        rest -= p[:,k]
+    draws[:,-1] = remaining
+    return draws
+
+def ibp_logprior_z(cur_z, alpha):
+    """Return the IBP log prior of a feature ownership matrix, with rows taken
+    in order. A feature that earlier rows own m times is owned by row n with
+    probability m / (n + 1); the features a row owns first are counted as a
+    Poisson(alpha / (n + 1)) draw whenever there are any.
+    """
+    if cur_z.shape[0] == 0: return 0.
+    denom = np.arange(1, cur_z.shape[0] + 1, dtype=np.float64)
+    m = cur_z.cumsum(axis = 0) - cur_z # owners of each feature among the preceding rows
+    seen = m > 0
+    p = m / denom[:,np.newaxis]
+    with np.errstate(divide = 'ignore'):
+        log_prior = np.log(np.where(cur_z == 1, p, 1 - p)[seen]).sum()
+    num_novel = ((cur_z == 1) & ~seen).sum(axis = 1)
+    novel_rows = num_novel > 0
+    return log_prior + poisson.logpmf(num_novel[novel_rows], alpha / denom[novel_rows]).sum()
+
+def ibp_predictive_prior(cur_z, alpha):
+    """Return the IBP prior of the feature ownership of a new data point given
+    a sample of Z, as the log probabilities of owning and of not owning each
+    feature, a mask of the features nobody owns and the Poisson rate of the
+    number of those the new data point owns.
+    """
+    m = cur_z.sum(axis = 0) / float(cur_z.shape[0])
+    novel = m == 0
+    with np.errstate(divide = 'ignore'):
+        log_on, log_off = np.log(np.where(novel, 1., m)), np.log(np.where(novel, 1., 1. - m))
+    return log_on, log_off, novel, alpha / float(cur_z.shape[0])
+
 def print_matrix_in_row(npmat, file_dest):
     """Print a matrix in a row.
     """
@@ -69,17 +123,24 @@ class BaseSampler(object):
             self.queue = cl.CommandQueue(self.ctx)
             self.mem_pool = cl.tools.MemoryPool(cl.tools.ImmediateAllocator(self.queue)) 
             self.mf = cl.mem_flags
-            self.device = self.ctx.get_info(cl.context_info.DEVICES)[0]
+            self.devices = self.ctx.get_info(cl.context_info.DEVICES)
+            self.device = self.devices[0]
             self.device_type = self.device.type
             self.device_compute_units = self.device.max_compute_units
-            
+            self.tuner = KernelTuner()
+
         self.cl_mode = cl_mode
+        self.shards = [] # (device, queue, start, end) per device in data-parallel mode
+        self.shard_busy_time = []
+        self.shard_wall_time = 0
         self.obs = []
         self.niter = 1000
         self.thining = 1
         self.burnin = 0
         self.N = 0 # number of data points
         self.best_sample = (None, None) # (sample, loglikelihood)
+        self.sampled_params = [] # names of hyperparameters that may be resampled along with the samples
+        self.best_params = {} # their values when the best sample was saved
         self.record_best = record_best
         self.best_diff = []
         self.no_improv = 0
@@ -113,19 +174,77 @@ class BaseSampler(object):
     def set_sampling_params(self, niter = 1000, thining = 1, burnin = 0):
         self.niter, self.thining, self.burnin = niter, thining, burnin
 
+    def device_clock(self):
+        """Return the time in seconds on a clock that stands still while the
+        tuner times candidates, so that tuning does not count toward gpu_time.
+        """
+        return time() - (self.tuner.tuning_time if self.cl_mode else 0.)
+
+    def tuned_local_size(self, step, global_shape, preferred_multiple, launch):
+        """Pick the work-group shape of a kernel launched over global_shape.
+        The rule of thumb is the gcd of each dimension with the kernel's preferred
+        work-group size multiple; the tuner replaces it with the fastest shape it
+        has timed on this device. launch(local_size) must enqueue the kernel on
+        buffers that can safely be overwritten and return its event.
+        """
+        default = tuple(gcd(_, preferred_multiple) for _ in global_shape)
+        return self.tuner.choose(self.device, step, global_shape,
+                                 local_size_candidates(self.device, global_shape, preferred_multiple),
+                                 lambda local_size: launch(local_size).wait(), default, exact = True)
+
+    def init_shards(self, data_size):
+        """Split data_size observations into contiguous slices, one per OpenCL
+        device in the context, sized in proportion to the number of compute units
+        of each device. Every device gets its own profiling command queue.
+        """
+        import pyopencl as cl
+        weights = np.array([_.max_compute_units for _ in self.devices], dtype=np.float64)
+        bounds = np.round(np.cumsum(weights) / weights.sum() * data_size).astype(np.int32)
+        self.shards = []
+        start = 0
+        for device, end in zip(self.devices, bounds):
+            if end == start: continue
+            queue = cl.CommandQueue(self.ctx, device = device,
+                                    properties = cl.command_queue_properties.PROFILING_ENABLE)
+            self.shards.append((device, queue, start, end))
+            start = end
+        self.shard_busy_time = [0.] * len(self.shards)
+        self.shard_wall_time = 0
+        return self.shards
+
+    def record_shard_events(self, shard_index, events):
+        """Add the execution time of the given (finished) profiled events to the
+        busy time of a shard's device.
+        """
+        for e in events:
+            self.shard_busy_time[shard_index] += (e.profile.end - e.profile.start) * 1e-9
+
+    def shard_utilization(self):
+        """Return (device name, number of observations, busy seconds, utilization)
+        for each shard, where utilization is the fraction of the data-parallel
+        wall time that the device spent executing kernels.
+        """
+        report = []
+        for (device, _, start, end), busy in zip(self.shards, self.shard_busy_time):
+            util = busy / self.shard_wall_time if self.shard_wall_time > 0 else 0.
+            report.append((device.name.strip(), end - start, busy, util))
+        return report
+
     def do_inference(self, output_file = None):
         """Perform inference. This method does nothing in the base class.
         """
         return
 
-    def auto_save_sample(self, sample):
+    def auto_save_sample(self, sample, logprob = None):
         """Save the given sample as the best sample if it yields
         a larger log-likelihood of data than the current best.
+        @param logprob: The log probability of the sample if it is already known
         """
-        new_logprob = self._logprob(sample)
+        new_logprob = self._logprob(sample) if logprob is None else logprob
         # if there's no best sample recorded yet
         if self.best_sample[0] is None and self.best_sample[1] is None:
             self.best_sample = (sample, new_logprob)
+            self.best_params = dict((_, getattr(self, _)) for _ in self.sampled_params)
             print('Initial sample generated, loglik: {0}'.format(new_logprob), file=sys.stderr)
             return
 
@@ -134,12 +253,25 @@ class BaseSampler(object):
             self.no_improv = 0
             self.best_diff.append(new_logprob - self.best_sample[1])
             self.best_sample = (copy.deepcopy(sample), new_logprob)
+            self.best_params = dict((_, getattr(self, _)) for _ in self.sampled_params)
             print('New best sample found, loglik: {0}'.format(new_logprob), file=sys.stderr)
             return True
         else:
             self.no_improv += 1
             return False
 
+    def restore_best_params(self):
+        """Set the sampled hyperparameters back to their values for the best
+        sample, when the sampler goes back to it.
+        """
+        for name, value in self.best_params.items(): setattr(self, name, value)
+
+    def record_params(self):
+        """Keep the current values of the sampled hyperparameters with the
+        sample that is being kept, in self.samples.
+        """
+        for name in self.sampled_params: self.samples.setdefault(name, []).append(getattr(self, name))
+
     def no_improvement(self, threshold=500):
         if len(self.best_diff) == 0: return False
         if self.no_improv > threshold or np.mean(self.best_diff[-threshold:]) < 1:
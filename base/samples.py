@@ -0,0 +1,78 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+from __future__ import print_function
+import numpy as np
+import struct, zipfile
+
+def save_samples(file_path, samples, dtype = None):
+    """Write a list of samples of one variable, which may differ in shape, to
+    an uncompressed .npz archive with one member per sample, in order, so that
+    SampleArchive can memory-map them.
+    @param dtype: The type to store the samples as, e.g. uint8 for binary ones
+    """
+    np.savez(file_path, *[np.asarray(_, dtype = dtype) for _ in samples])
+
+class SampleArchive(object):
+    """The samples of one variable in a .npz archive written by save_samples(),
+    read lazily. Opening the archive only reads its table of contents; each
+    sample is a read-only memory map of its member, located when the sample is
+    first indexed. Members that are compressed are read into memory instead.
+
+    Indexing with an integer returns a sample and indexing with a slice
+    returns another lazy SampleArchive, so burn-in, thinning and use_iter
+    selection never touch the samples that are left out.
+    """
+
+    def __init__(self, file_path, members = None):
+        """Open an archive.
+        @param members: The names of the samples to present, in order; all
+                        of them by default
+        """
+        self.file_path = file_path
+        self.zip = zipfile.ZipFile(file_path)
+        if members is None:
+            members = sorted([_ for _ in self.zip.namelist() if _.startswith('arr_')],
+                             key = lambda _: int(_[4:-4]))
+        self.members = members
+        self.located = {}
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            archive = SampleArchive.__new__(SampleArchive)
+            archive.file_path, archive.zip, archive.located = self.file_path, self.zip, self.located
+            archive.members = self.members[i]
+            return archive
+        return self._read(self.members[i])
+
+    def _read(self, member):
+        info = self.zip.getinfo(member)
+        if info.compress_type != zipfile.ZIP_STORED:
+            return np.lib.format.read_array(self.zip.open(member))
+        if member not in self.located: self.located[member] = self._locate(info)
+        offset, shape, fortran, dtype = self.located[member]
+        if np.prod(shape) == 0: return np.empty(shape, dtype = dtype)
+        return np.memmap(self.file_path, dtype = dtype, mode = 'r', offset = offset, shape = shape,
+                         order = 'F' if fortran else 'C')
+
+    def _locate(self, info):
+        """Return the file offset, shape, order and type of the data of a stored
+        member, from its local zip header and its .npy header.
+        """
+        with open(self.file_path, 'rb') as f:
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            return f.tell(), shape, fortran, dtype
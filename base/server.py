@@ -0,0 +1,204 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+from __future__ import print_function
+import numpy as np
+import sys, os, threading, collections, Queue
+from multiprocessing.connection import Listener, Client, deliver_challenge, answer_challenge, AuthenticationError
+from time import time
+
+class PredictionServer(object):
+    """Serve the score() of a predictor whose samples are already loaded to
+    clients on this machine, over a socket (an (host, port) address) or a
+    Unix socket or named pipe (a path).
+
+    Every connection is read by its own thread, which checks the requests and
+    queues them. The serving loop takes the first waiting request and, for up
+    to max_delay seconds after it, any others that come in with test cases of
+    the same shape, up to max_batch test cases in all, and scores them
+    together in a single call to score(obs = ...). The predictor must return
+    the scores with the test cases along the last axis, as the IBP predictors
+    (one row per sample) and the CRP predictors (one score per test case) do.
+    Each client gets back its share of the scores. If a batch fails, its
+    requests are scored one at a time, so that only the bad ones get the error.
+
+    Requests and replies are pickled, so clients must present authkey, which
+    is random unless given. Pass the server's authkey to its clients.
+    """
+
+    def __init__(self, predictor, address = ('localhost', 0), authkey = None,
+                 max_batch = 4096, max_delay = 0.0005, case_shape = None, score_args = None):
+        """Start listening.
+        @param address: Where to listen; by default a free port on localhost
+        @param authkey: The key clients must present; by default 16 random bytes
+        @param max_batch: The most test cases scored at once
+        @param max_delay: The most seconds a request waits for others to join it;
+                          with 0 a batch holds the requests that came in while
+                          the last one was scored
+        @param case_shape: The shape of one test case, e.g. (D,) for images of D
+                           pixels, to check requests against; a request may then
+                           also be a single test case
+        @param score_args: Other keyword arguments of score(), e.g. the samples
+                           the IBP predictors should score with
+        """
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.case_shape = None if case_shape is None else tuple(case_shape)
+        self.score_args = score_args or {}
+        self.authkey = authkey or os.urandom(16)
+        # clients are authenticated by the thread that reads their requests, so
+        # that the acceptor is never held up by a slow one
+        self.listener = Listener(address, backlog = 64)
+        self.address = self.listener.address
+        self.requests = Queue.Queue() # (connection, send lock, request id, test cases)
+        self.deferred = collections.deque() # requests of another shape than the last batch
+        self.running = False
+
+    def serve_forever(self):
+        """Accept connections and score their requests until shutdown().
+        """
+        self.running = True
+        acceptor = threading.Thread(target = self._accept)
+        acceptor.daemon = True
+        acceptor.start()
+        while self.running:
+            request = self.deferred.popleft() if self.deferred else self.requests.get()
+            if request is None: break
+            batch = [request]
+            num_obs = request[3].shape[0]
+            shape = request[3].shape[1:]
+            # deferred requests are older than any in the queue
+            for request in list(self.deferred):
+                if num_obs >= self.max_batch: break
+                if request[3].shape[1:] == shape:
+                    self.deferred.remove(request)
+                    batch.append(request)
+                    num_obs += request[3].shape[0]
+            deadline = time() + self.max_delay
+            while num_obs < self.max_batch:
+                try:
+                    request = self.requests.get(timeout = max(0., deadline - time()))
+                except Queue.Empty:
+                    break
+                if request is None:
+                    self.running = False
+                    break
+                if request[3].shape[1:] != shape:
+                    self.deferred.append(request)
+                    continue
+                batch.append(request)
+                num_obs += request[3].shape[0]
+            self._score_batch(batch)
+
+    def shutdown(self):
+        """Stop serving; requests that have not been scored get no reply.
+        """
+        self.running = False
+        self.requests.put(None)
+        self.listener.close()
+
+    def _score_batch(self, batch):
+        """Score the test cases of a batch of requests together and send every
+        request its share of the scores. If that fails, score the requests one
+        at a time and send those that fail their error.
+        """
+        try:
+            scores = self.predictor.score(obs = np.concatenate([_[3] for _ in batch]), **self.score_args)
+            bounds = np.cumsum([0] + [_[3].shape[0] for _ in batch])
+            if np.shape(scores)[-1:] != (bounds[-1],):
+                raise ValueError('score() returned scores of shape %s for %d test cases' %
+                                 (np.shape(scores), bounds[-1]))
+        except Exception as e:
+            if len(batch) == 1:
+                print('Could not score a request: %s' % e, file=sys.stderr)
+                self._reply(batch[0], e)
+            else:
+                for request in batch: self._score_batch([request])
+            return
+        for request, start, end in zip(batch, bounds[:-1], bounds[1:]):
+            self._reply(request, scores[...,start:end])
+
+    def _reply(self, request, reply):
+        conn, lock, request_id, _ = request
+        try:
+            with lock: conn.send((request_id, reply))
+        except (IOError, EOFError):
+            pass # the client went away
+
+    def _accept(self):
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if not self.running: break
+                continue
+            reader = threading.Thread(target = self._read_requests, args = (conn,))
+            reader.daemon = True
+            reader.start()
+
+    def _read_requests(self, conn):
+        """Authenticate a connection and queue the requests that come in on it;
+        answer those that are not arrays of test cases with the error right away.
+        """
+        try:
+            deliver_challenge(conn, self.authkey)
+            answer_challenge(conn, self.authkey)
+        except (AuthenticationError, IOError, EOFError):
+            conn.close()
+            return
+        lock = threading.Lock()
+        while True:
+            try:
+                request_id, obs = conn.recv()
+            except (IOError, EOFError):
+                break
+            except Exception as e:
+                request_id, obs = None, e # not a (request id, test cases) pair
+            try:
+                obs = self._check_request(obs)
+            except ValueError as e:
+                self._reply((conn, lock, request_id, None), e)
+                continue
+            self.requests.put((conn, lock, request_id, obs))
+        conn.close()
+
+    def _check_request(self, obs):
+        """Return the test cases of a request as an array of one or more test
+        cases, or raise a ValueError if they are not.
+        """
+        if isinstance(obs, Exception): raise ValueError('Bad request: %s' % obs)
+        obs = np.asarray(obs)
+        if obs.dtype.kind not in 'biufSU':
+            raise ValueError('Test cases must be numbers or strings, not %s' % obs.dtype)
+        if self.case_shape is not None:
+            if obs.shape == self.case_shape: obs = obs[np.newaxis]
+            if obs.shape[1:] != self.case_shape:
+                raise ValueError('Test cases must have shape %s, not %s' % (self.case_shape, obs.shape[1:]))
+        if obs.ndim == 0 or obs.shape[0] == 0: raise ValueError('The request has no test cases')
+        return obs
+
+class PredictionClient(object):
+    """A connection to a PredictionServer.
+    """
+
+    def __init__(self, address, authkey):
+        """Connect to a server.
+        @param authkey: The authkey of the server
+        """
+        self.conn = Client(address, authkey = authkey)
+        self.request_id = 0
+
+    def score(self, obs):
+        """Return the log scores of the test cases in obs, as the predictor's
+        score() would.
+        """
+        self.request_id += 1
+        self.conn.send((self.request_id, np.asarray(obs)))
+        request_id, reply = self.conn.recv()
+        assert(request_id == self.request_id)
+        if isinstance(reply, Exception): raise reply
+        return reply
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python2
+#-*-coding: utf-8 -*-
+
+from __future__ import print_function
+import argparse, sys, os, os.path, tempfile
+pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
+sys.path.append(pkg_dir)
+
+from MPBNP import crp
+import numpy as np
+from datetime import datetime
+
+parser = argparse.ArgumentParser(description="""
+Time the sharded Gaussian CRP sampler on the first 1, 2, ... of the OpenCL devices selected
+by --opencl_device, to measure how a chain's sweep time scales with the number of devices.
+""")
+parser.add_argument('--iter', '-t', type=int, default=100, help='The number of iterations the sampler should run')
+parser.add_argument('--dim', '-d', type=int, default=2, help='The dimension of multivariate normals')
+parser.add_argument('--cluster_num', type=int, default=10, help='The number of clusters (for generating data)')
+parser.add_argument('--data_size', type=int, nargs='+', default=[10000, 100000, 1000000],
+                    help='The numbers of observations to time')
+parser.add_argument('--opencl_device', choices=['gpu', 'cpu'], default='gpu', help='The type of devices to shard across')
+parser.add_argument('--repeat', type=int, default=1, help='The number of times this test should be run.')
+args = parser.parse_args()
+
+c = crp.gaussian.CollapsedGibbs(cl_mode = True, cl_device = args.opencl_device, record_best = False,
+                                multi_device = True)
+all_devices = c.devices
+print('Devices:', ', '.join([_.name.strip() for _ in all_devices]), file=sys.stderr)
+
+print('timestamp,data.size,dimension,n.iter,no.devices,gpu_time,total_time,speedup,min.utilization')
+for r in xrange(args.repeat):
+    timestamp = str(datetime.now()).split('.')[0]
+    for data_size in args.data_size:
+        means = np.arange(args.cluster_num)[np.random.randint(0, args.cluster_num, data_size)] * 10.
+        data = np.random.normal(means[:,np.newaxis], 1., (data_size, args.dim))
+        init_labels = np.random.randint(0, 5, data_size)
+        # read through a file, which also sets up the priors
+        fd, path = tempfile.mkstemp(suffix = '.csv')
+        np.savetxt(path, data, delimiter = ',', header = ','.join(['x%d' % _ for _ in xrange(args.dim)]), comments = '')
+        os.close(fd)
+        c.obs = []
+        c.read_csv(path)
+        os.remove(path)
+
+        base_time = None
+        for num_devices in xrange(1, len(all_devices) + 1):
+            c.devices = all_devices[:num_devices]
+            c.set_sampling_params(niter = args.iter)
+            c.gpu_time, c.total_time = 0, 0
+            gpu_time, total_time, _ = c.cl_infer_sharded(init_labels.copy())
+            if base_time is None: base_time = total_time
+            utilization = min([_[3] for _ in c.shard_utilization()])
+            print('%s,%d,%d,%d,%d,%f,%f,%f,%f' % (timestamp, data_size, args.dim, args.iter, num_devices,
+                                                  gpu_time, total_time, base_time / total_time, utilization))
+            sys.stdout.flush()
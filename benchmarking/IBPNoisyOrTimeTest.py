@@ -0,0 +1,106 @@
+#!/usr/bin/env python2
+#-*-coding: utf-8 -*-
+
+from __future__ import print_function
+import argparse, sys, os.path
+pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
+sys.path.append(pkg_dir)
+
+from MPBNP import ibp, PackedRows, FeatureState
+import numpy as np
+from time import time
+from datetime import datetime
+
+def print_args_summary(args):
+    summary = "Running the sampler with the following arguments:\n"
+    summary += "Data files: %s\n" % ', '.join(args.data_file)
+    summary += "Numbers of images: %s\n" % ', '.join([str(_) for _ in args.sizes])
+    summary += "Number of features: %d\n" % args.k
+    summary += "Number of iterations: %d\n" % args.iter
+    summary += "Time the cell-by-cell reference updates: %s\n" % args.reference
+    summary += "Use the compact state representation: %s\n" % args.compact
+    summary += "Write output to a log file: %s\n" % args.output_to_file
+    print(summary, file=sys.stderr)
+
+def reference_sweep(sampler, cur_y, cur_z):
+    """One Y and one Z step evaluated cell by cell with _loglik_nth, the way
+    the sampler did before the count-based updates. Only the likelihood
+    evaluations are timed; nothing is resampled.
+    """
+    for row in xrange(cur_y.shape[0]):
+        affected_data_index = np.where(cur_z[:,row] == 1)
+        for col in xrange(cur_y.shape[1]):
+            old_value = cur_y[row, col]
+            cur_y[row, col] = 1
+            sampler._loglik_nth(cur_y, cur_z, n = affected_data_index)
+            cur_y[row, col] = 0
+            sampler._loglik_nth(cur_y, cur_z, n = affected_data_index)
+            cur_y[row, col] = old_value
+    for row in xrange(cur_z.shape[0]):
+        for col in xrange(cur_z.shape[1]):
+            old_value = cur_z[row, col]
+            cur_z[row, col] = 1
+            sampler._loglik_nth(cur_y, cur_z, n = row)
+            cur_z[row, col] = 0
+            sampler._loglik_nth(cur_y, cur_z, n = row)
+            cur_z[row, col] = old_value
+
+parser = argparse.ArgumentParser(description="""
+A test unit for assessing the time per sweep of the Y and Z updates of the IBP noisy-or sampler without OpenCL.
+""")
+parser.add_argument('--data_file', type=str, nargs='+',
+                    default=[pkg_dir + 'MPBNP/data/noisyor-image-n128.csv',
+                             pkg_dir + 'MPBNP/data/MNIST/train-images-binary-n2000.csv.gz'])
+parser.add_argument('--sizes', type=int, nargs='+', default=[8, 32, 128, 512, 2000], help='Numbers of images (taken from the top of each data file)')
+parser.add_argument('--k', type=int, default=10, help='The number of features')
+parser.add_argument('--iter', '-t', type=int, default=5, help='The number of sweeps timed per size')
+parser.add_argument('--reference', action='store_true', help='Also time one cell-by-cell reference sweep (slow)')
+parser.add_argument('--compact', action='store_true', help='Keep the images bit-packed and Y and Z as uint8')
+parser.add_argument('--output_to_file', action='store_true', help="Write to a log file in the current directory if turned on")
+
+args = parser.parse_args()
+print_args_summary(args)
+
+if args.output_to_file is False:
+    file_dest = sys.stdout
+else:
+    file_dest = open('ibp-noisyor-k%d-t%d.csv' % (args.k, args.iter), 'w')
+
+print('timestamp,data.file,n.images,n.pixels,n.features,n.iter,compact,obs.bytes,y.time,z.time,reference.time', file=file_dest)
+
+timestamp = str(datetime.now()).split('.')[0]
+for data_file in args.data_file:
+    sampler = ibp.noisyor.Gibbs(cl_mode = False, record_best = False, init_k = args.k)
+    sampler.read_csv(data_file)
+    sampler.compact = args.compact
+    all_obs = sampler.obs
+    for data_size in args.sizes:
+        if data_size > all_obs.shape[0]: continue
+        print('Run timestamp: %s Testing %s with %d images' % (timestamp, data_file, data_size), file=sys.stderr)
+        sampler.obs, sampler.N = all_obs[:data_size], data_size
+        cur_y = np.random.randint(0, 2, (args.k, sampler.d))
+        cur_z = np.random.randint(0, 2, (data_size, args.k))
+        if args.compact:
+            sampler.obs = PackedRows(sampler.obs)
+            cur_y, cur_z = cur_y.astype(np.uint8), cur_z.astype(np.uint8)
+
+        y_time, z_time = 0, 0
+        for i in xrange(args.iter):
+            a_time = time()
+            sampler._infer_y(cur_y, cur_z)
+            y_time += time() - a_time
+            a_time = time()
+            sampler._infer_z(FeatureState([('y', cur_y, 0), ('z', cur_z, 1)]))
+            z_time += time() - a_time
+
+        ref_time = ''
+        if args.reference:
+            a_time = time()
+            reference_sweep(sampler, np.copy(cur_y), np.copy(cur_z))
+            ref_time = '%f' % (time() - a_time)
+
+        print('%s,%s,%d,%d,%d,%d,%s,%d,%f,%f,%s' % (timestamp, os.path.basename(data_file), data_size, sampler.d, args.k,
+                                                    args.iter, args.compact, sampler.obs.nbytes,
+                                                    y_time / args.iter, z_time / args.iter, ref_time),
+              file = file_dest)
+    if file_dest is not sys.stdout: file_dest.flush()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python2
+#-*-coding: utf-8 -*-
+
+from __future__ import print_function
+import argparse, sys, os.path
+pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
+sys.path.append(pkg_dir)
+
+from MPBNP import ibp, FeatureState, read_images
+import numpy as np
+from time import time
+from datetime import datetime
+
+def print_args_summary(args):
+    summary = "Running the sampler with the following arguments:\n"
+    summary += "Data files: %s\n" % ', '.join(args.data_file)
+    summary += "Numbers of images: %s\n" % ', '.join([str(_) for _ in args.sizes])
+    summary += "Number of features: %d\n" % args.k
+    summary += "Number of iterations: %d\n" % args.iter
+    summary += "Time the whole-matrix prior sums: %s\n" % args.reference
+    summary += "Write output to a log file: %s\n" % args.output_to_file
+    print(summary, file=sys.stderr)
+
+def reference_prior_sweep(cur_z, cur_f):
+    """The priors of one F sweep summed over the whole of Z and F for every
+    row and cell, the way the sampler did before it kept running counts.
+    Only the sums are timed; nothing is resampled.
+    """
+    for row in xrange(cur_f.shape[0]):
+        m_minus = cur_z.sum(axis = 0) - cur_z
+        for col in xrange(cur_f.shape[1]):
+            [((cur_f == 1).sum() - int(cur_f[row,col] == 1) + .0001) / ((cur_f > 0).sum() - int(cur_f[row,col] > 0) + .0002),
+             ((cur_f == 2).sum() - int(cur_f[row,col] == 2) + .0001) / ((cur_f > 0).sum() - int(cur_f[row,col] > 0) + .0002)]
+
+parser = argparse.ArgumentParser(description="""
+A test unit for assessing how the time per sweep of the F and Y updates of the two-Y noisy-or sampler scales with the number of images.
+""")
+parser.add_argument('--data_file', type=str, nargs='+',
+                    default=[pkg_dir + 'MPBNP/data/noisyor-image-n128.csv',
+                             pkg_dir + 'MPBNP/data/MNIST/train-images-binary-n2000.csv.gz'])
+parser.add_argument('--sizes', type=int, nargs='+', default=[8, 32, 128, 512, 2000], help='Numbers of images (taken from the top of each data file)')
+parser.add_argument('--k', type=int, default=10, help='The number of features')
+parser.add_argument('--iter', '-t', type=int, default=3, help='The number of sweeps timed per size')
+parser.add_argument('--reference', action='store_true', help='Also time the priors of one sweep summed over the whole matrices (slow)')
+parser.add_argument('--output_to_file', action='store_true', help="Write to a log file in the current directory if turned on")
+
+args = parser.parse_args()
+print_args_summary(args)
+
+if args.output_to_file is False:
+    file_dest = sys.stdout
+else:
+    file_dest = open('ibp-noisyortwoy-k%d-t%d.csv' % (args.k, args.iter), 'w')
+
+print('timestamp,data.file,n.images,n.pixels,n.features,n.iter,f.time,y.time,reference.time', file=file_dest)
+
+timestamp = str(datetime.now()).split('.')[0]
+for data_file in args.data_file:
+    all_obs, _ = read_images(data_file)
+    # no births, so that every sweep works on k features
+    sampler = ibp.noisyortwoy.BiasedGibbs(cl_mode = False, alpha = 0., init_k = args.k)
+    for data_size in args.sizes:
+        if data_size > all_obs.shape[0]: continue
+        print('Run timestamp: %s Testing %s with %d images' % (timestamp, data_file, data_size), file=sys.stderr)
+        sampler.obs, sampler.n, sampler.d = all_obs[:data_size], data_size, all_obs.shape[1]
+        cur_y = np.random.randint(0, 2, (2, args.k, sampler.d))
+        cur_f = np.random.randint(0, 3, (data_size, args.k))
+        cur_z = (cur_f > 0).astype(np.int32)
+        state = FeatureState([('y', cur_y, 1), ('z', cur_z, 1), ('f', cur_f, 1)])
+
+        f_time, y_time = 0, 0
+        for i in xrange(args.iter):
+            a_time = time()
+            sampler._infer_f(state)
+            f_time += time() - a_time
+            a_time = time()
+            state['y'][:] = sampler._infer_y(state['y'], state['z'], state['f'])
+            y_time += time() - a_time
+
+        ref_time = ''
+        if args.reference:
+            a_time = time()
+            reference_prior_sweep(state['z'], state['f'])
+            ref_time = '%f' % (time() - a_time)
+
+        print('%s,%s,%d,%d,%d,%d,%f,%f,%s' % (timestamp, os.path.basename(data_file), data_size, sampler.d, args.k,
+                                              args.iter, f_time / args.iter, y_time / args.iter, ref_time),
+              file = file_dest)
+    if file_dest is not sys.stdout: file_dest.flush()
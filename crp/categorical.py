@@ -6,17 +6,34 @@ pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
 sys.path.append(pkg_dir)
 
 import pyopencl.array
+from scipy.special import logsumexp
 from collections import Counter
 from MPBNP import *
 
 np.set_printoptions(suppress=True)
 
+def category_counts(labels, codes, size, num_of_values, weights = None):
+    """Count, for every label value below size, the observations with that
+    label taking each value in each dimension, as a (size, D, V) array.
+    codes are the observations coded as indices into the support of each dimension.
+    @param weights: Multiplicity of each observation. Default is 1
+    """
+    dim = codes.shape[1]
+    flat_index = (labels[:,np.newaxis] * dim + np.arange(dim)) * num_of_values + codes
+    if weights is not None: weights = np.repeat(weights, dim)
+    counts = np.bincount(flat_index.ravel(), weights = weights, minlength = size * dim * num_of_values)
+    return counts.astype(np.int64).reshape((size, dim, num_of_values))
+
 class CollapsedGibbs(BaseSampler):
 
-    def __init__(self, cl_mode = True, inference_mode = True, alpha = 1.0, cl_device = None):
+    def __init__(self, cl_mode = True, inference_mode = True, alpha = 1.0, cl_device = None,
+                 compress_patterns = False):
         """Initialize the class.
+        @param compress_patterns: Sample identical observations as one weighted pattern (without OpenCL only)
         """
-        BaseSampler.__init__(self, cl_mode, inference_mode, cl_device)
+        BaseSampler.__init__(self, record_best = False, cl_mode = cl_mode, cl_device = cl_device)
+        self.inference_mode = inference_mode
+        self.compress_patterns = compress_patterns and not cl_mode
 
         if cl_mode:
             program_str = open(pkg_dir + 'MPBNP/crp/kernels/crp_categorical_cl.c', 'r').read()
@@ -32,9 +49,15 @@ class CollapsedGibbs(BaseSampler):
         BaseSampler.read_csv(self, filepath, header)
         # get the discrete support for each dimension
         self.obs = np.array(self.obs)
+        # code the observations as indices into the support of each dimension
+        self.codes = np.empty(self.obs.shape, dtype=np.int32)
         for i in xrange(self.obs.shape[1]):
             self.support.append(np.unique(self.obs[:,i]))
             self.support_size.append(len(self.support[i]))
+            self.codes[:,i] = np.searchsorted(self.support[i], self.obs[:,i])
+        # collapse identical observations into unique patterns with multiplicities
+        self.pattern_codes, self.pattern_index, self.pattern_weight = \
+            np.unique(self.codes, axis = 0, return_inverse = True, return_counts = True)
         return
 
     def do_inference(self, init_labels = None, output_file = None):
@@ -50,6 +73,8 @@ class CollapsedGibbs(BaseSampler):
 
         if self.cl_mode:
             return self.cl_infer_categorical(init_labels = init_labels, output_file = output_file)
+        elif self.compress_patterns:
+            return self.infer_categorical_patterns(init_labels = init_labels, output_file = output_file)
         else:
             return self.infer_categorical(init_labels = init_labels, output_file = output_file)
 
@@ -59,64 +84,132 @@ class CollapsedGibbs(BaseSampler):
 
     def infer_categorical(self, init_labels, output_file = None):
         """Implementing concurrent sampling of partition labels without OpenCL.
+        The counts of each value in each dimension of each cluster are kept in a
+        dense (cluster, dimension, value) array that is updated by the relabeled
+        observations only, and the log posterior is a gather from log tables.
         """
-        try: dim = self.obs.shape[1]
-        except IndexError: dim = 1
-        
-        data_size = self.obs.shape[0]
-        cluster_labels = init_labels
+        a_time = time()
+        dim = self.codes.shape[1]
+        data_size = self.codes.shape[0]
+        num_of_values = max(self.support_size)
+        dims = np.arange(dim)
+        cluster_labels = np.array(init_labels, dtype=np.int64)
 
-        # set some prior hyperparameters
-        beta = 0.1
+        log_count, log_norm = self._log_tables(data_size)
+
+        # counts indexed by label value; new labels are always the smallest unused ones
+        size = cluster_labels.max() + 2
+        counts = category_counts(cluster_labels, self.codes, size, num_of_values)
+        n = np.bincount(cluster_labels, minlength = size)
 
         if output_file is not None: print(*xrange(data_size), file = output_file, sep = ',')
 
         # run
         for i in xrange(self.niter):
-            if output_file is not None and i >= burnin: 
+            if output_file is not None and i >= self.burnin: 
                 print(*cluster_labels, file = output_file, sep = ',')            
 
             uniq_labels = np.unique(cluster_labels)
             _, _, new_cluster_label = smallest_unused_label(uniq_labels)
             uniq_labels = np.hstack((new_cluster_label, uniq_labels))
-            num_of_clusters = uniq_labels.shape[0]
-
-            # compute the sufficient statistics of each cluster
-            n = {}
-            counts = {}
-            logpost = np.zeros((data_size, num_of_clusters))
-
-            for label in uniq_labels:
-                label_index = np.where(uniq_labels == label)[0]
-                # set up the dictionary for storing counts
-                counts[label] = {}
-                if label == new_cluster_label:
-                    n[label] = 0
-                    # loop over all dimensions
-                    for d in xrange(dim):
-                        counts[label][d] = Counter()
-                else:
-                    cluster_obs = self.obs[np.where(cluster_labels == label)]
-                    n[label] = cluster_obs.shape[0]
-                    for d in xrange(dim):
-                        counts[label][d] = Counter(cluster_obs[:,d])
-
-                for o_index in xrange(len(self.obs)):
-                    o = self.obs[o_index]
-                    for d in xrange(dim):
-                        logpost[o_index, label_index] += np.log((beta + counts[label][d][o[d]]) / (self.support_size[d] * beta + n[label]))
-
-                logpost[:,label_index] += np.log(n[label]) if n[label] > 0 else np.log(self.alpha)
+            if new_cluster_label >= size:
+                counts = np.concatenate((counts, np.zeros_like(counts)))
+                n = np.concatenate((n, np.zeros_like(n)))
+                size = counts.shape[0]
 
             # resample the labels and implement the changes
-            for j in xrange(data_size):
-                target_cluster = sample(a = uniq_labels, p = lognormalize(logpost[j]))
-                cluster_labels[j] = target_cluster
+            logpost = self._logpost(self.codes, counts[uniq_labels], n[uniq_labels], log_count, log_norm)
+            new_labels = sample_rows(uniq_labels, logpost)
+            changed = np.where(new_labels != cluster_labels)[0]
+            np.add.at(counts, (cluster_labels[changed][:,np.newaxis], dims, self.codes[changed]), -1)
+            np.add.at(counts, (new_labels[changed][:,np.newaxis], dims, self.codes[changed]), 1)
+            n += np.bincount(new_labels[changed], minlength = size) - np.bincount(cluster_labels[changed], minlength = size)
+            cluster_labels = new_labels
+
+        self.total_time += time() - a_time
+        return self.gpu_time, self.total_time, Counter(cluster_labels).most_common()
+
+    def infer_categorical_patterns(self, init_labels, output_file = None):
+        """Implementing concurrent sampling of partition labels without OpenCL,
+        where identical observations are handled as one pattern. The state is
+        the number of observations of each pattern in each cluster; the log
+        posterior is computed once per pattern and the observations of a
+        pattern are redistributed over clusters by a multinomial draw.
+        """
+        a_time = time()
+        data_size = self.codes.shape[0]
+        num_of_patterns = self.pattern_codes.shape[0]
+        num_of_values = max(self.support_size)
+        log_count, log_norm = self._log_tables(data_size)
+        # observations grouped by pattern, to turn the state back into labels
+        pattern_order = np.argsort(self.pattern_index, kind = 'mergesort')
+
+        size = int(np.max(init_labels)) + 2
+        occupancy = np.bincount(self.pattern_index * size + init_labels,
+                                minlength = num_of_patterns * size).reshape((num_of_patterns, size))
+        cluster_labels = np.array(init_labels, dtype=np.int64)
+
+        if output_file is not None: print(*xrange(data_size), file = output_file, sep = ',')
+
+        # run
+        for i in xrange(self.niter):
+            if output_file is not None and i >= self.burnin: 
+                print(*cluster_labels, file = output_file, sep = ',')
 
-        return Counter(cluster_labels).most_common()
+            n = occupancy.sum(axis = 0)
+            uniq_labels = np.where(n > 0)[0]
+            _, _, new_cluster_label = smallest_unused_label(uniq_labels)
+            uniq_labels = np.hstack((new_cluster_label, uniq_labels))
+            if new_cluster_label >= size:
+                occupancy = np.hstack((occupancy, np.zeros_like(occupancy)))
+                n = np.concatenate((n, np.zeros_like(n)))
+                size = occupancy.shape[1]
+
+            # counts of the clusters from the (pattern, cluster) pairs in use
+            pattern_nz, label_nz = np.nonzero(occupancy)
+            counts = category_counts(label_nz, self.pattern_codes[pattern_nz], size, num_of_values,
+                                     weights = occupancy[pattern_nz, label_nz])
+
+            # redistribute the observations of each pattern over the clusters
+            logpost = self._logpost(self.pattern_codes, counts[uniq_labels], n[uniq_labels], log_count, log_norm)
+            p = np.exp(logpost - logpost.max(axis = 1)[:,np.newaxis])
+            draws = multinomial_rows(self.pattern_weight, p / p.sum(axis = 1)[:,np.newaxis])
+            occupancy = np.zeros_like(occupancy)
+            occupancy[:,uniq_labels] = draws
+
+            if output_file is not None or i == self.niter - 1:
+                cluster_labels[pattern_order] = np.repeat(np.tile(np.arange(size), num_of_patterns), occupancy.ravel())
+
+        self.total_time += time() - a_time
+        return self.gpu_time, self.total_time, Counter(cluster_labels).most_common()
+
+    def _log_tables(self, data_size, beta = 0.1):
+        """Tabulate log(beta + count) and, for each dimension, log(V * beta + n)
+        for all counts up to data_size, where V is the support size.
+        """
+        log_count = np.log(beta + np.arange(data_size + 1))
+        log_norm = np.log(np.array(self.support_size)[:,np.newaxis] * beta + np.arange(data_size + 1))
+        return log_count, log_norm
+
+    def _logpost(self, codes, cluster_counts, cluster_n, log_count, log_norm):
+        """Compute the log posterior of each coded observation joining each cluster,
+        given the (cluster, dimension, value) counts and sizes of the clusters.
+        """
+        dim = codes.shape[1]
+        logpost = np.zeros((codes.shape[0], cluster_counts.shape[0]))
+        for d in xrange(dim):
+            logpost += log_count[cluster_counts[:, d, codes[:,d]]].T
+        logpost -= log_norm[np.arange(dim)[:,np.newaxis], cluster_n].sum(axis = 0)
+        logpost += np.where(cluster_n > 0, np.log(np.maximum(cluster_n, 1)), np.log(self.alpha))
+        return logpost
 
     def cl_infer_categorical(self, init_labels, output_file = None):
         """Implementing concurrent sampling of class labels with OpenCL.
+        Data, labels and the sufficient statistics stay on the device between
+        sweeps, and random numbers are generated there; the statistics buffers
+        only grow when the number of clusters exceeds their capacity. The host
+        reads back the size of each cluster every sweep, to drop the clusters
+        that emptied, and the labels only when they are written out.
         """
         if not self.inference_mode: 
             print("Sorry. This function is only callable when the sampler is intialized in a inference mode")
@@ -137,66 +230,241 @@ class CollapsedGibbs(BaseSampler):
         beta = np.float32(0.1)
         # set up cluster labels
         cluster_labels = init_labels.astype(np.int32)
-        # get unique outcome types
-        uniq_outcomes = np.unique(self.support[0])
         num_of_outcomes = np.int32(self.support_size[0])
 
         # push data and initial labels onto the openCL device
         # data won't change, labels are modified on the device
-        # To make it easier to process in OpenCL C, data are converted to array indices according to uniq_outcomes
-        d_data = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
-                           hostbuf = np.where(uniq_outcomes == self.obs)[1].astype(np.int32))
+        # To make it easier to process in OpenCL C, data are coded as indices into the support
+        d_data = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = self.codes.astype(np.int32))
         d_labels = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = cluster_labels)
+        capacity = 0
 
         if output_file is not None: print(*xrange(data_size), file = output_file, sep = ',')
 
-        
+        # the labels on the device always take values in uniq_labels: the
+        # clusters of the previous sweep and the new cluster it could open
+        uniq_labels = np.unique(cluster_labels).astype(np.int32)
+        width = int(dim * num_of_outcomes)
         for i in xrange(self.niter):
-            if output_file is not None and i >= self.burnin: 
-                print(*cluster_labels, file = output_file, sep = ',')            
-            # at the beginning of each iteration, identity the unique cluster labels
-            uniq_labels = np.unique(cluster_labels)
-            _, _, new_cluster_label = smallest_unused_label(uniq_labels)
-            uniq_labels = np.hstack((new_cluster_label, uniq_labels)).astype(np.int32)
-            num_of_clusters = np.int32(uniq_labels.shape[0])
+            if output_file is not None and i >= self.burnin:
+                if i > 0: cl.enqueue_copy(self.queue, cluster_labels, d_labels)
+                print(*cluster_labels, file = output_file, sep = ',')
 
             # using OpenCL to compute the log posterior of each item and perform resampling
-            a_time = time()
-
-            # compute the sufficient statistics of each cluster
-            d_count = cl.array.empty(self.queue, (uniq_labels.shape[0], uniq_outcomes.shape[0]), np.int32)
-            d_n = cl.array.empty(self.queue, uniq_labels.shape, np.int32)
-            d_uniq_label = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = uniq_labels)
-
-            self.prg.compute_suff_stats(self.queue, (uniq_labels.shape[0],), None,
-                                        d_uniq_label, d_labels, d_data, d_count.data, d_n.data,
-                                        data_size, num_of_outcomes)
-
-            d_rand = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = np.random.random(data_size).astype(np.float32))
-            d_logpost = cl.array.empty(self.queue, (data_size, uniq_labels.shape[0]), np.float32)
-            
-            # if the OpenCL device is CPU, use the kernel with loops over clusters
-            if self.device_type == cl.device_type.CPU:
-                self.prg.cat_logpost_loopy(self.queue, (self.obs.shape[0],), None,
-                                           d_labels, d_data, d_uniq_label, d_count.data, d_n.data,
-                                           num_of_clusters, num_of_outcomes, np.float32(self.alpha),
-                                           beta, d_logpost.data, d_rand)
-            # otherwise, use the kernel that fully unrolls data points and clusters
-            else:
-                self.prg.cat_logpost(self.queue, (self.obs.shape[0], uniq_labels.shape[0]), None, 
-                                     d_labels, d_data, d_uniq_label, d_count.data, d_n.data, 
-                                     num_of_clusters, num_of_outcomes, np.float32(self.alpha),
-                                     beta, d_logpost.data, d_rand)
-                self.prg.resample_labels(self.queue, (self.obs.shape[0],), None,
-                                         d_labels, d_uniq_label, num_of_clusters,
-                                         d_rand, d_logpost.data)
-                
-            cl.enqueue_copy(self.queue, cluster_labels, d_labels)
-            gpu_time += time() - a_time
-            
+            a_time = self.device_clock()
+
+            # (re)allocate the device-resident statistics when the clusters outgrow them
+            label_index = np.zeros(uniq_labels.max() + 1, dtype=np.int32)
+            label_index[uniq_labels] = np.arange(uniq_labels.shape[0])
+            if uniq_labels.shape[0] + 1 > capacity or label_index.shape[0] > capacity:
+                capacity = 2 * max(uniq_labels.shape[0] + 1, label_index.shape[0])
+                d_count = cl.array.empty(self.queue, (capacity, dim, num_of_outcomes), np.int32, allocator = self.mem_pool)
+                d_n = cl.array.empty(self.queue, (capacity,), np.int32, allocator = self.mem_pool)
+                d_count_used = cl.array.empty(self.queue, (capacity, dim, num_of_outcomes), np.int32, allocator = self.mem_pool)
+                d_n_used = cl.array.empty(self.queue, (capacity,), np.int32, allocator = self.mem_pool)
+                d_order = cl.array.empty(self.queue, (capacity,), np.int32, allocator = self.mem_pool)
+                d_uniq_label = cl.array.empty(self.queue, (capacity,), np.int32, allocator = self.mem_pool)
+                d_label_index = cl.array.empty(self.queue, (capacity,), np.int32, allocator = self.mem_pool)
+                d_logpost = cl.array.empty(self.queue, (data_size, capacity), np.float32, allocator = self.mem_pool)
+            cl.enqueue_copy(self.queue, d_label_index.data, label_index)
+
+            # compute the sufficient statistics of each cluster, and read back
+            # only the cluster sizes to find the clusters that are still in use
+            self._cl_suff_stats(data_size, dim, num_of_outcomes, np.int32(uniq_labels.shape[0]),
+                                d_labels, d_data, d_label_index.data, d_count, d_n)
+            h_n = d_n[:uniq_labels.shape[0]].get()
+            in_use = np.where(h_n > 0)[0]
+            in_use = in_use[np.argsort(uniq_labels[in_use])]
+            _, _, new_cluster_label = smallest_unused_label(uniq_labels[in_use])
+            uniq_labels = np.hstack((new_cluster_label, uniq_labels[in_use])).astype(np.int32)
+            num_of_clusters = np.int32(uniq_labels.shape[0])
+
+            # move the statistics of the clusters in use behind the new one
+            cl.enqueue_copy(self.queue, d_order.data, np.hstack((-1, in_use)).astype(np.int32))
+            self.prg.gather_clusters(self.queue, (int(num_of_clusters), width), None,
+                                     d_count.data, d_n.data, d_order.data, d_count_used.data, d_n_used.data,
+                                     np.int32(width))
+            cl.enqueue_copy(self.queue, d_uniq_label.data, uniq_labels)
+            d_rand = cl.clrandom.rand(self.queue, (data_size,), np.float32)
+
+            def launch(variant, d_lab):
+                args = (d_lab, d_data, d_uniq_label.data, d_count_used.data, d_n_used.data,
+                        num_of_clusters, num_of_outcomes, np.float32(self.alpha), beta, d_logpost.data, d_rand.data)
+                # the loopy kernel loops over clusters and resamples labels itself
+                if variant == 'loopy':
+                    return [self.prg.cat_logpost_loopy(self.queue, (self.obs.shape[0],), None, *args)]
+                # the unrolled kernel fully unrolls data points and clusters
+                return [self.prg.cat_logpost(self.queue, (self.obs.shape[0], uniq_labels.shape[0]), None, *args),
+                        self.prg.resample_labels(self.queue, (self.obs.shape[0],), None,
+                                                 d_lab, d_uniq_label.data, num_of_clusters, d_rand.data, d_logpost.data)]
+            launch(self._choose_logpost_variant(data_size, num_of_clusters, d_labels, launch), d_labels)
+            gpu_time += self.device_clock() - a_time
+
+        cl.enqueue_copy(self.queue, cluster_labels, d_labels)
         total_time += time() - total_a_time
         return gpu_time, total_time, Counter(cluster_labels).most_common()
 
+    def _cl_suff_stats(self, data_size, dim, num_of_outcomes, num_of_clusters,
+                       d_labels, d_data, d_label_index, d_count, d_n):
+        """Compute the (cluster, dimension, outcome) counts and the size of each
+        cluster with a data-parallel histogram. Work groups keep private
+        histograms in local memory if they fit, otherwise atomics go straight
+        to global memory.
+        """
+        bin_num = int(num_of_clusters * dim * num_of_outcomes)
+        wg_size = min(256, self.device.max_work_group_size)
+        wg_num = min(self.device_compute_units * 4, (int(data_size * dim) + wg_size - 1) // wg_size)
+        variants = ['global']
+        if (bin_num + num_of_clusters) * 4 <= self.device.local_mem_size: variants.insert(0, 'local')
+
+        def launch(variant):
+            d_count.fill(0)
+            d_n.fill(0)
+            if variant == 'local':
+                return self.prg.histogram_suff_stats(self.queue, (wg_num * wg_size,), (wg_size,),
+                                                     d_labels, d_data, d_label_index, d_count.data, d_n.data,
+                                                     data_size, dim, num_of_outcomes, num_of_clusters,
+                                                     cl.LocalMemory(bin_num * 4), cl.LocalMemory(int(num_of_clusters) * 4))
+            return self.prg.histogram_suff_stats_global(self.queue, (wg_num * wg_size,), (wg_size,),
+                                                        d_labels, d_data, d_label_index, d_count.data, d_n.data,
+                                                        data_size, dim, num_of_outcomes)
+
+        variant = self.tuner.choose(self.device, 'crp_categorical_suff_stats', (data_size * dim, bin_num), variants,
+                                    lambda v: launch(v).wait(), variants[0])
+        return launch(variant)
+
+    def _choose_logpost_variant(self, data_size, num_of_clusters, d_labels, launch):
+        """Pick the log posterior kernel variant. The rule of thumb is the loopy
+        kernel on CPUs and the unrolled one elsewhere; the tuner replaces it with
+        the variant it has timed to be faster on the device.
+        """
+        default = 'loopy' if self.device_type == cl.device_type.CPU else 'unrolled'
+        scratch = []
+        def run(variant):
+            # labels are resampled in place, so time the kernels on a copy
+            if not scratch: scratch.append(cl.Buffer(self.ctx, self.mf.READ_WRITE, size = int(data_size) * 4))
+            cl.enqueue_copy(self.queue, scratch[0], d_labels)
+            cl.wait_for_events(launch(variant, scratch[0]))
+        return self.tuner.choose(self.device, 'crp_categorical_logpost', (data_size, num_of_clusters),
+                                 ['loopy', 'unrolled'], run, default)
+
+class CollapsedGibbsPredictor(BasePredictor):
+
+    def __init__(self, cl_mode = False, cl_device = None, alpha = 1.0):
+        """Initialize the predictor.
+        """
+        BasePredictor.__init__(self, cl_mode = cl_mode, cl_device = cl_device)
+        self.alpha = alpha
+        self.train = None
+        self.summary = None
+
+    def read_train_csv(self, file_path, header = True):
+        """Read the data that the label samples were drawn for.
+        """
+        self.train = CollapsedGibbs(cl_mode = False, alpha = self.alpha)
+        self.train.read_csv(file_path, header)
+        return
+
+    def read_samples_csv(self, var_name, file_path, header = True):
+        """Read label samples written by the sampler.
+        """
+        BasePredictor.read_samples_csv(self, var_name, file_path, header)
+        self.samples[var_name] = [np.array(_, dtype=np.int64) for _ in self.samples[var_name] if len(_) > 0]
+        return
+
+    def summarize(self, thining = 0, burnin = 0, use_iter = None):
+        """Precompute, for every cluster in the selected label samples plus a new
+        cluster, its mixture log weight and a (dimension, value) table of log
+        predictive probabilities. The last column of each table is for values
+        that do not occur in the training data.
+        """
+        train = self.train
+        num_of_values = max(train.support_size)
+        samples = self.select_samples('labels', thining, burnin, use_iter)
+        log_count, log_norm = train._log_tables(train.codes.shape[0])
+        summary = dict([(_, []) for _ in ['sample', 'label', 'log_weight', 'log_table']])
+
+        for s, labels in enumerate(samples):
+            n = np.bincount(labels)
+            uniq_labels = np.where(n > 0)[0]
+            _, _, new_cluster_label = smallest_unused_label(uniq_labels)
+            uniq_labels = np.hstack((new_cluster_label, uniq_labels))
+            counts = np.zeros((uniq_labels.shape[0], train.codes.shape[1], num_of_values + 1), dtype=np.int64)
+            counts[1:,:,:-1] = category_counts(labels, train.codes, n.shape[0], num_of_values)[uniq_labels[1:]]
+            n = np.hstack((0, n[uniq_labels[1:]]))
+
+            summary['log_table'].append(log_count[counts] - log_norm.T[n][:,:,np.newaxis])
+            weight = np.where(n > 0, n, self.alpha) / float(labels.shape[0] + self.alpha)
+            summary['log_weight'].append(np.log(weight) - np.log(len(samples)))
+            summary['sample'].append(np.repeat(s, uniq_labels.shape[0]))
+            summary['label'].append(uniq_labels)
+
+        self.summary = dict([(k, np.concatenate(v)) for k, v in summary.items()])
+        self.summary['support'] = np.array(train.support)
+        return self.summary
+
+    def save_summary(self, file_path):
+        """Save the per-cluster summary so that predictions do not need the
+        training data or the label samples.
+        """
+        np.savez(file_path, **self.summary)
+
+    def read_summary(self, file_path):
+        """Read a per-cluster summary written by save_summary.
+        """
+        # the supports of dimensions of different sizes are stored as an object array
+        summary = np.load(file_path, allow_pickle = True)
+        self.summary = dict([(_, summary[_]) for _ in summary.files])
+        return self.summary
+
+    def encode(self, obs):
+        """Code observations as indices into the training support of each
+        dimension; values outside the support point to the last table column.
+        """
+        obs = np.array(obs).reshape((len(obs), -1))
+        codes = np.empty(obs.shape, dtype=np.int64)
+        for d, support in enumerate(self.summary['support']):
+            index = np.minimum(np.searchsorted(support, obs[:,d]), len(support) - 1)
+            codes[:,d] = np.where(support[index] == obs[:,d], index, self.summary['log_table'].shape[2] - 1)
+        return codes
+
+    def cluster_logpost(self, obs):
+        """Compute the log of the mixture weight times the predictive probability
+        of each observation under each summarized cluster.
+        """
+        codes = self.encode(obs)
+        log_table = self.summary['log_table']
+        logpost = np.tile(self.summary['log_weight'], (codes.shape[0], 1))
+        for d in xrange(codes.shape[1]):
+            logpost += log_table[:, d, codes[:,d]].T
+        return logpost
+
+    def score(self, obs = None):
+        """Compute the log posterior predictive probability of each observation,
+        averaged over the summarized samples.
+        """
+        if obs is None: obs = self.obs
+        return logsumexp(self.cluster_logpost(obs), axis = 1)
+
+    def assign(self, obs = None):
+        """Assign each observation to its most probable cluster in the last
+        summarized sample. A new cluster gets the smallest unused label.
+        """
+        if obs is None: obs = self.obs
+        last = self.summary['sample'] == self.summary['sample'].max()
+        return self.summary['label'][last][self.cluster_logpost(obs)[:,last].argmax(axis = 1)]
+
+    def predict(self, thining = 0, burnin = 0, use_iter = None, output_file = None):
+        """Predict the test cases: the log predictive probability of each test
+        case and its cluster assignment.
+        """
+        if self.summary is None: self.summarize(thining, burnin, use_iter)
+        logprob, labels = self.score(), self.assign()
+        if output_file is not None:
+            print('logprob', 'label', file = output_file, sep = ',')
+            for row in zip(logprob, labels): print(*row, file = output_file, sep = ',')
+        return logprob, labels
+
 if __name__ == '__main__':
 
     argv = sys.argv
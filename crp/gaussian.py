@@ -7,17 +7,36 @@ pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
 sys.path.append(pkg_dir)
 
 from scipy.stats import t
+from scipy.special import logsumexp
 from collections import Counter
 from MPBNP import *
 
 np.set_printoptions(suppress=True)
 
+def label_suff_stats(labels, obs, size):
+    """Compute, for every label value below size, the number of observations
+    with that label, their sum and the sum of their outer products.
+    """
+    dim = obs.shape[1]
+    n = np.bincount(labels, minlength = size)
+    s1 = np.empty((size, dim))
+    s2 = np.empty((size, dim, dim))
+    for d1 in xrange(dim):
+        s1[:,d1] = np.bincount(labels, weights = obs[:,d1], minlength = size)
+        for d2 in xrange(d1, dim):
+            s2[:,d1,d2] = np.bincount(labels, weights = obs[:,d1] * obs[:,d2], minlength = size)
+            s2[:,d2,d1] = s2[:,d1,d2]
+    return n, s1, s2
+
 class CollapsedGibbs(BaseSampler):
 
-    def __init__(self, cl_mode = True, alpha = 1.0, cl_device = None, record_best = True):
+    def __init__(self, cl_mode = True, alpha = 1.0, cl_device = None, record_best = True,
+                 multi_device = False):
         """Initialize the class.
+        @param multi_device: Shard the observations across all OpenCL devices in the context
         """
         BaseSampler.__init__(self, record_best, cl_mode, cl_device)
+        self.multi_device = multi_device and cl_mode
         
         if cl_mode:
             program_str = open(pkg_dir + 'MPBNP/crp/kernels/crp_cl.c', 'r').read()
@@ -25,6 +44,7 @@ class CollapsedGibbs(BaseSampler):
 
         # set some prior hyperparameters
         self.alpha = np.float32(alpha)
+        self.resync_interval = 16 # sweeps between recomputing the sharded statistics from the labels
 
     def read_csv(self, filepath, header=True):
         """Read the data from a csv file.
@@ -64,7 +84,9 @@ class CollapsedGibbs(BaseSampler):
         if output_file is not None:
             print(*(['d%d' % _ for _ in xrange(self.N)]), file = output_file, sep=',')
             
-        if self.cl_mode:
+        if self.cl_mode and self.multi_device:
+            timing_stats = self.cl_infer_sharded(init_labels = init_labels, output_file = output_file)
+        elif self.cl_mode:
             if self.dim == 1:
                 timing_stats = self.cl_infer_1dgaussian(init_labels = init_labels, output_file = output_file)
             else:
@@ -145,12 +167,12 @@ class CollapsedGibbs(BaseSampler):
         cluster_labels = init_labels
         if self.record_best: self.auto_save_sample(cluster_labels)
 
-        gpu_a_time = time()
+        gpu_a_time = self.device_clock()
         d_hyper_param = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
                                   hostbuf = np.array([self.gaussian_mu0, self.gaussian_k0, 
                                                       self.gamma_alpha0, self.gamma_beta0, self.alpha]).astype(np.float32))
         d_labels = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cluster_labels)
-        self.gpu_time += time() - gpu_a_time
+        self.gpu_time += self.device_clock() - gpu_a_time
         
         for i in xrange(self.niter):
             uniq_labels = np.unique(cluster_labels)
@@ -168,7 +190,7 @@ class CollapsedGibbs(BaseSampler):
                     cluster_ss = np.var(cluster_obs) * cluster_obs.shape[0]
                     suf_stats[label_index] = (label, cluster_mu, cluster_ss, cluster_obs.shape[0])
 
-            gpu_a_time = time()
+            gpu_a_time = self.device_clock()
             d_uniq_label = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = uniq_labels)
             d_mu = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = suf_stats[:,1].astype(np.float32))
             d_ss = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
@@ -179,23 +201,16 @@ class CollapsedGibbs(BaseSampler):
             d_rand = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
                                hostbuf = np.random.random(self.obs.shape).astype(np.float32))
 
-            if self.device_type == cl.device_type.CPU:
-                self.prg.normal_1d_logpost_loopy(self.queue, self.obs.shape, None,
-                                                 d_labels, self.d_obs, d_uniq_label, d_mu, d_ss, d_n, 
-                                                 np.int32(uniq_labels.shape[0]), d_hyper_param, d_rand,
-                                                 d_logpost.data)
-            else:
-                self.prg.normal_1d_logpost(self.queue, (self.obs.shape[0], uniq_labels.shape[0]), None,
-                                           d_labels, self.d_obs, d_uniq_label, d_mu, d_ss, d_n, 
-                                           np.int32(uniq_labels.shape[0]), d_hyper_param, d_rand,
-                                           d_logpost.data)
-                self.prg.resample_labels(self.queue, (self.obs.shape[0],), None,
-                                         d_labels, d_uniq_label, np.int32(uniq_labels.shape[0]),
-                                         d_rand, d_logpost.data)
+            num_of_clusters = np.int32(uniq_labels.shape[0])
+            launch = lambda variant, d_lab: self._launch_logpost(variant, self.queue, self.N, num_of_clusters,
+                                                                 d_lab, self.d_obs, d_uniq_label,
+                                                                 (d_mu, d_ss, d_n, d_hyper_param), d_rand, d_logpost.data)
+            launch(self._choose_logpost_variant(self.device, self.queue, self.N, num_of_clusters, d_labels, launch),
+                   d_labels)
 
             temp_cluster_labels = np.empty(cluster_labels.shape, dtype=np.int32)
             cl.enqueue_copy(self.queue, temp_cluster_labels, d_labels)
-            self.gpu_time += time() - gpu_a_time
+            self.gpu_time += self.device_clock() - gpu_a_time
 
             if self.record_best:
                 if self.auto_save_sample(temp_cluster_labels):
@@ -316,7 +331,7 @@ class CollapsedGibbs(BaseSampler):
                     h_n[label_index] = cluster_obs.shape[0]
                     
             # using OpenCL to compute the log posterior of each item and perform resampling
-            gpu_time = time()
+            gpu_time = self.device_clock()
 
             d_n = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = h_n)
             d_mu = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = h_mu)
@@ -339,27 +354,16 @@ class CollapsedGibbs(BaseSampler):
             d_rand = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = np.random.random(self.N).astype(np.float32))
             d_logpost = cl.array.empty(self.queue, (self.N, uniq_labels.shape[0]), np.float32, allocator = self.mem_pool)
 
-            # if the OpenCL device is CPU, use the kernel with loops over clusters
-            if self.device_type == cl.device_type.CPU:
-                self.prg.normal_kd_logpost_loopy(self.queue, (self.obs.shape[0],), None,
-                                                 d_labels, self.d_obs, d_uniq_label, 
-                                                 d_mu, d_n, d_determinants, d_inverses,
-                                                 num_of_clusters, self.alpha,
-                                                 self.dim, self.wishart_v0, d_logpost.data, d_rand)
-            # otherwise, use the kernel that fully unrolls data points and clusters
-            else:
-                self.prg.normal_kd_logpost(self.queue, (self.obs.shape[0], uniq_labels.shape[0]), None, 
-                                           d_labels, self.d_obs, d_uniq_label, 
-                                           d_mu, d_n, d_determinants, d_inverses,
-                                           num_of_clusters, self.alpha,
-                                           self.dim, self.wishart_v0, d_logpost.data, d_rand)
-                self.prg.resample_labels(self.queue, (self.obs.shape[0],), None,
-                                         d_labels, d_uniq_label, num_of_clusters,
-                                         d_rand, d_logpost.data)
+            launch = lambda variant, d_lab: self._launch_logpost(variant, self.queue, self.N, num_of_clusters,
+                                                                 d_lab, self.d_obs, d_uniq_label,
+                                                                 (d_mu, d_n, d_determinants, d_inverses),
+                                                                 d_rand, d_logpost.data)
+            launch(self._choose_logpost_variant(self.device, self.queue, self.N, num_of_clusters, d_labels, launch),
+                   d_labels)
 
             temp_cluster_labels = np.empty(cluster_labels.shape, dtype=np.int32)
             cl.enqueue_copy(self.queue, temp_cluster_labels, d_labels)
-            self.gpu_time += time() - gpu_time
+            self.gpu_time += self.device_clock() - gpu_time
 
             if self.record_best:
                 if self.auto_save_sample(temp_cluster_labels):
@@ -372,9 +376,205 @@ class CollapsedGibbs(BaseSampler):
 
         
         self.total_time = time() - total_time
-            
+
         return self.gpu_time, self.total_time, Counter(cluster_labels).most_common()
 
+    def _launch_logpost(self, variant, queue, size, num_of_clusters, d_labels, d_obs, d_uniq_label,
+                        cluster_args, d_rand, d_logpost):
+        """Enqueue the log posterior kernel of the given variant and return the
+        events of the launched kernels. The loopy variant loops over clusters
+        and resamples labels in one kernel; the unrolled variant uses one
+        work-item per data point and cluster followed by a resampling kernel.
+        """
+        if self.dim == 1:
+            d_mu, d_ss, d_n, d_hyper_param = cluster_args
+            args = (d_labels, d_obs, d_uniq_label, d_mu, d_ss, d_n, num_of_clusters, d_hyper_param, d_rand, d_logpost)
+            loopy_kernel, unrolled_kernel = self.prg.normal_1d_logpost_loopy, self.prg.normal_1d_logpost
+        else:
+            d_mu, d_n, d_determinants, d_inverses = cluster_args
+            args = (d_labels, d_obs, d_uniq_label, d_mu, d_n, d_determinants, d_inverses,
+                    num_of_clusters, self.alpha, self.dim, self.wishart_v0, d_logpost, d_rand)
+            loopy_kernel, unrolled_kernel = self.prg.normal_kd_logpost_loopy, self.prg.normal_kd_logpost
+
+        if variant == 'loopy':
+            return [loopy_kernel(queue, (size,), None, *args)]
+        return [unrolled_kernel(queue, (size, num_of_clusters), None, *args),
+                self.prg.resample_labels(queue, (size,), None,
+                                         d_labels, d_uniq_label, num_of_clusters, d_rand, d_logpost)]
+
+    def _choose_logpost_variant(self, device, queue, size, num_of_clusters, d_labels, launch):
+        """Pick the log posterior kernel variant for a device. The rule of thumb
+        is the loopy kernel on CPUs and the unrolled one elsewhere; the tuner
+        replaces it with the variant it has timed to be faster on the device.
+        launch(variant, d_labels) must enqueue the kernels and return their events.
+        """
+        default = 'loopy' if device.type == cl.device_type.CPU else 'unrolled'
+        scratch = []
+        def run(variant):
+            # labels are resampled in place, so time the kernels on a copy
+            if not scratch: scratch.append(cl.Buffer(self.ctx, self.mf.READ_WRITE, size = int(size) * 4))
+            cl.enqueue_copy(queue, scratch[0], d_labels)
+            cl.wait_for_events(launch(variant, scratch[0]))
+        step = 'crp_normal_1d_logpost' if self.dim == 1 else 'crp_normal_kd_logpost'
+        return self.tuner.choose(device, step, (size, num_of_clusters, self.dim),
+                                 ['loopy', 'unrolled'], run, default)
+
+    def _cluster_suff_stats(self, cluster_labels):
+        """Return the labels in use and the number of observations, sum and sum
+        of outer products of each of their clusters, in float64.
+        """
+        labels, label_index = np.unique(cluster_labels, return_inverse = True)
+        return (labels,) + label_suff_stats(label_index, self.obs.reshape((self.N, -1)).astype(np.float64),
+                                            labels.shape[0])
+
+    def cl_infer_sharded(self, init_labels, output_file = None):
+        """Data-parallel sampling of class labels across all OpenCL devices in the
+        context. Each device owns a slice of the observations and their labels,
+        which stay on the device. Every sweep, the host broadcasts the cluster
+        parameters, each device resamples the labels of its own slice and
+        computes the changes in the sufficient statistics of every cluster that
+        its relabeling caused, and the host adds up these changes (an
+        all-reduce). What moves between host and devices every sweep is sized
+        by the number of clusters, not the number of observations, except that
+        the labels are read back when a sample is recorded, and every sweep
+        with record_best, which scores each sample on the host. The deltas are
+        summed in float32 on the devices, so every resync_interval sweeps the
+        statistics are recomputed from the labels to keep rounding errors from
+        building up.
+        """
+        total_a_time = time()
+        cluster_labels = init_labels
+        if self.record_best: self.auto_save_sample(cluster_labels)
+
+        shards = self.init_shards(self.N)
+        d_obs, d_labels, d_old_labels = [], [], []
+        for _, _, start, end in shards:
+            d_obs.append(cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = self.obs[start:end]))
+            d_labels.append(cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR,
+                                      hostbuf = cluster_labels[start:end].astype(np.int32)))
+            d_old_labels.append(cl.Buffer(self.ctx, self.mf.READ_WRITE, size = int(end - start) * 4))
+        if self.dim == 1:
+            d_hyper_param = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR,
+                                      hostbuf = np.array([self.gaussian_mu0, self.gaussian_k0,
+                                                          self.gamma_alpha0, self.gamma_beta0, self.alpha]).astype(np.float32))
+
+        # the labels of the clusters in use and their sufficient statistics,
+        # kept in float64 on the host and changed by the reduced deltas
+        # between resyncs
+        labels, n, s1, s2 = self._cluster_suff_stats(cluster_labels)
+        width = 1 + self.dim + self.dim * self.dim
+        last_resync = 0
+
+        for i in xrange(self.niter):
+            _, _, new_cluster_label = smallest_unused_label(labels)
+            uniq_labels = np.hstack((new_cluster_label, labels)).astype(np.int32)
+            num_of_clusters = np.int32(uniq_labels.shape[0])
+
+            # turn the reduced statistics into cluster parameters; the first
+            # cluster is the new one, which has no observations
+            h_n = np.hstack((0, n)).astype(np.int32)
+            safe_n = np.maximum(h_n, 1)[:,np.newaxis]
+            h_mu = np.vstack((np.zeros((1, self.dim)), s1)) / safe_n
+            h_cov_obs = np.vstack((np.zeros((1, self.dim, self.dim)), s2)) - \
+                safe_n[:,:,np.newaxis] * h_mu[:,:,np.newaxis] * h_mu[:,np.newaxis,:]
+
+            gpu_a_time = self.device_clock()
+            d_uniq_label = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = uniq_labels)
+            d_n = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = h_n)
+            if self.dim == 1:
+                d_mu = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = h_mu[:,0].astype(np.float32))
+                d_ss = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = h_cov_obs[:,0,0].astype(np.float32))
+                cluster_args = (d_mu, d_ss, d_n, d_hyper_param)
+            else:
+                kn = (self.gaussian_k0 + h_n)[:,np.newaxis,np.newaxis]
+                vn = (self.wishart_v0 + h_n)[:,np.newaxis,np.newaxis]
+                mu0_deviance = self.gaussian_mu0 - h_mu
+                h_cov_mu0 = mu0_deviance[:,:,np.newaxis] * mu0_deviance[:,np.newaxis,:]
+                h_sigma = (self.wishart_T0 + h_cov_obs + self.gaussian_k0 * h_n[:,np.newaxis,np.newaxis] / kn * h_cov_mu0) * \
+                    (kn + 1) / (kn * (vn - self.dim + 1))
+                d_mu = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = h_mu.astype(np.float32))
+                d_determinants = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR,
+                                           hostbuf = np.linalg.det(h_sigma).astype(np.float32))
+                d_inverses = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR,
+                                       hostbuf = np.linalg.inv(h_sigma).astype(np.float32))
+                cluster_args = (d_mu, d_n, d_determinants, d_inverses)
+
+            # the labels are read back only when the sample is needed on the host
+            write_sample = output_file is not None and i >= self.burnin and i % self.thining == 0
+            read_labels = self.record_best or write_sample or i + 1 - last_resync >= self.resync_interval
+            temp_cluster_labels = np.empty(self.N, dtype=np.int32)
+
+            # launch every shard before waiting on any of them
+            shard_events, h_deltas = [], []
+            for s, (device, queue, start, end) in enumerate(shards):
+                size = end - start
+                cl.enqueue_copy(queue, d_old_labels[s], d_labels[s])
+                d_logpost = cl.array.empty(queue, (size, uniq_labels.shape[0]), np.float32, allocator = self.mem_pool)
+                d_rand = cl.clrandom.rand(queue, (size,), np.float32)
+                launch = lambda variant, d_lab: self._launch_logpost(variant, queue, size, num_of_clusters,
+                                                                     d_lab, d_obs[s], d_uniq_label, cluster_args,
+                                                                     d_rand.data, d_logpost.data)
+                events = launch(self._choose_logpost_variant(device, queue, size, num_of_clusters, d_labels[s], launch),
+                                d_labels[s])
+
+                # the changes in the statistics of the shard, reduced on the device
+                # over chunks of observations so that the partial sums stay small
+                chunks = int(max(1, min(size, device.max_compute_units * 16, 2 ** 22 // (num_of_clusters * width))))
+                d_partial = cl.array.empty(queue, (chunks, num_of_clusters * width), np.float32, allocator = self.mem_pool)
+                d_delta = cl.array.empty(queue, (num_of_clusters * width,), np.float32, allocator = self.mem_pool)
+                events.append(self.prg.normal_suff_stats_delta(queue, (chunks,), None,
+                                                               d_old_labels[s], d_labels[s], d_obs[s], d_uniq_label,
+                                                               num_of_clusters, np.int32(size), np.int32(self.dim),
+                                                               d_partial.data))
+                events.append(self.prg.sum_chunks(queue, (int(num_of_clusters * width),), None,
+                                                  d_partial.data, np.int32(chunks), d_delta.data))
+                h_deltas.append(np.empty((num_of_clusters, width), dtype=np.float32))
+                cl.enqueue_copy(queue, h_deltas[s], d_delta.data, is_blocking = False)
+                if read_labels:
+                    cl.enqueue_copy(queue, temp_cluster_labels[start:end], d_labels[s], is_blocking = False)
+                shard_events.append(events)
+
+            for s, (_, queue, _, _) in enumerate(shards):
+                queue.finish()
+                self.record_shard_events(s, shard_events[s])
+            self.shard_wall_time += self.device_clock() - gpu_a_time
+            self.gpu_time += self.device_clock() - gpu_a_time
+
+            accept = True
+            if self.record_best:
+                accept = self.auto_save_sample(temp_cluster_labels)
+                if accept:
+                    cluster_labels = temp_cluster_labels
+                else:
+                    # the devices go back to the labels of the best sample
+                    for s, (_, queue, _, _) in enumerate(shards):
+                        cl.enqueue_copy(queue, d_labels[s], d_old_labels[s])
+            elif read_labels:
+                cluster_labels = temp_cluster_labels
+                if write_sample: print(*temp_cluster_labels, file = output_file, sep=',')
+
+            if accept and i + 1 - last_resync >= self.resync_interval:
+                labels, n, s1, s2 = self._cluster_suff_stats(temp_cluster_labels)
+                last_resync = i + 1
+            elif accept:
+                # all-reduce, then drop the clusters that emptied
+                delta = np.sum(h_deltas, axis = 0, dtype = np.float64)
+                n = np.hstack((0, n)) + np.round(delta[:,0]).astype(np.int64)
+                s1 = np.vstack((np.zeros((1, self.dim)), s1)) + delta[:,1:1 + self.dim]
+                s2 = np.vstack((np.zeros((1, self.dim, self.dim)), s2)) + \
+                    delta[:,1 + self.dim:].reshape((-1, self.dim, self.dim))
+                in_use = n > 0
+                labels, n, s1, s2 = uniq_labels[in_use], n[in_use], s1[in_use], s2[in_use]
+
+            if self.record_best and self.no_improvement():
+                break
+
+        for name, size, busy, util in self.shard_utilization():
+            print('Device %s: %d observations, busy %f seconds, utilization %.1f%%' % (name, size, busy, util * 100),
+                  file=sys.stderr)
+
+        self.total_time += time() - total_a_time
+        return self.gpu_time, self.total_time, sorted(zip(labels, n), key = lambda _: -_[1])
 
     def _logprob(self, sample):
         """Calculate the joint log probability of data and model given a sample.
@@ -413,7 +613,7 @@ class CollapsedGibbs(BaseSampler):
                 total_logprob += loglik
 
         if self.dim == 1 and self.cl_mode:
-            gpu_a_time = time()
+            gpu_a_time = self.device_clock()
             d_labels = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = sample)
             d_hyper_param = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
                                       hostbuf = np.array([self.gaussian_mu0, self.gaussian_k0, 
@@ -423,7 +623,7 @@ class CollapsedGibbs(BaseSampler):
                                       d_labels, self.d_obs, d_hyper_param, d_logprob.data)
             
             total_logprob = d_logprob.get().sum()
-            self.gpu_time += time() - gpu_a_time
+            self.gpu_time += self.device_clock() - gpu_a_time
 
         if self.dim > 1:# and self.cl_mode == False:
             cluster_dict = {}
@@ -459,3 +659,146 @@ class CollapsedGibbs(BaseSampler):
                 total_logprob += loglik
 
         return total_logprob
+
+class CollapsedGibbsPredictor(BasePredictor):
+
+    def __init__(self, cl_mode = False, cl_device = None, alpha = 1.0):
+        """Initialize the predictor.
+        """
+        BasePredictor.__init__(self, cl_mode = cl_mode, cl_device = cl_device)
+        self.alpha = alpha
+        self.train = None
+        self.summary = None
+        self.chunk_size = 2 ** 20 # maximum number of (observation, cluster) pairs scored at once
+
+    def read_train_csv(self, file_path, header = True):
+        """Read the data that the label samples were drawn for. The priors are
+        set up the same way as in the sampler.
+        """
+        self.train = CollapsedGibbs(cl_mode = False, alpha = self.alpha)
+        self.train.read_csv(file_path, header)
+        return
+
+    def read_test_csv(self, file_path, header = True):
+        """Read the test cases and convert values to floats.
+        """
+        BasePredictor.read_test_csv(self, file_path, header)
+        self.obs = np.array(self.obs, dtype=np.float64).reshape((len(self.obs), -1))
+        return
+
+    def read_samples_csv(self, var_name, file_path, header = True):
+        """Read label samples written by the sampler.
+        """
+        BasePredictor.read_samples_csv(self, var_name, file_path, header)
+        self.samples[var_name] = [np.array(_, dtype=np.int64) for _ in self.samples[var_name] if len(_) > 0]
+        return
+
+    def summarize(self, thining = 0, burnin = 0, use_iter = None):
+        """Precompute the Student-t predictive of every cluster in the selected
+        label samples, plus that of a new cluster. Each cluster is stored as
+        its mixture log weight, degrees of freedom, location, the inverse of
+        the Cholesky factor of its scale matrix and its log normalizing constant.
+        """
+        train = self.train
+        dim = int(train.dim)
+        samples = self.select_samples('labels', thining, burnin, use_iter)
+        summary = dict([(_, []) for _ in ['sample', 'label', 'log_weight', 'df', 'loc', 'prec_chol', 'const']])
+
+        for s, labels in enumerate(samples):
+            n, s1, s2 = label_suff_stats(labels, train.obs.astype(np.float64), labels.max() + 1)
+            uniq_labels = np.where(n > 0)[0]
+            _, _, new_cluster_label = smallest_unused_label(uniq_labels)
+            uniq_labels = np.hstack((new_cluster_label, uniq_labels))
+            n = np.hstack((0, n[uniq_labels[1:]]))
+            mu = np.vstack((np.zeros((1, dim)), s1[uniq_labels[1:]] / n[1:,np.newaxis]))
+            cov_obs = np.concatenate((np.zeros((1, dim, dim)),
+                                      s2[uniq_labels[1:]] - n[1:,np.newaxis,np.newaxis] * mu[1:,:,np.newaxis] * mu[1:,np.newaxis,:]))
+            kn = train.gaussian_k0 + n
+            loc = (train.gaussian_k0 * train.gaussian_mu0 + n[:,np.newaxis] * mu) / kn[:,np.newaxis]
+
+            if dim == 1:
+                alpha_n = train.gamma_alpha0 + n / 2.
+                beta_n = train.gamma_beta0 + 0.5 * cov_obs[:,0,0] + \
+                    train.gaussian_k0 * n * (mu[:,0] - train.gaussian_mu0) ** 2 / (2 * kn)
+                df = 2 * alpha_n
+                scale = (beta_n * (kn + 1) / (alpha_n * kn)).reshape((-1, 1, 1))
+            else:
+                vn = train.wishart_v0 + n
+                mu0_deviance = train.gaussian_mu0 - mu
+                cov_mu0 = mu0_deviance[:,:,np.newaxis] * mu0_deviance[:,np.newaxis,:]
+                df = vn - dim + 1
+                scale = (train.wishart_T0 + cov_obs + (train.gaussian_k0 * n / kn)[:,np.newaxis,np.newaxis] * cov_mu0) * \
+                    ((kn + 1) / (kn * df))[:,np.newaxis,np.newaxis]
+
+            chol = np.linalg.cholesky(scale)
+            summary['prec_chol'].append(np.linalg.inv(chol))
+            summary['const'].append(np.array([math.lgamma((_ + dim) / 2.) - math.lgamma(_ / 2.) for _ in df]) - \
+                                    0.5 * dim * np.log(df * math.pi) - np.log(np.diagonal(chol, axis1 = 1, axis2 = 2)).sum(axis = 1))
+            weight = np.where(n > 0, n, self.alpha) / (labels.shape[0] + self.alpha)
+            summary['log_weight'].append(np.log(weight) - np.log(len(samples)))
+            summary['sample'].append(np.repeat(s, uniq_labels.shape[0]))
+            summary['label'].append(uniq_labels)
+            summary['df'].append(df)
+            summary['loc'].append(loc)
+
+        self.summary = dict([(k, np.concatenate(v)) for k, v in summary.items()])
+        return self.summary
+
+    def save_summary(self, file_path):
+        """Save the per-cluster summary so that predictions do not need the
+        training data or the label samples.
+        """
+        np.savez(file_path, **self.summary)
+
+    def read_summary(self, file_path):
+        """Read a per-cluster summary written by save_summary.
+        """
+        summary = np.load(file_path)
+        self.summary = dict([(_, summary[_]) for _ in summary.files])
+        return self.summary
+
+    def cluster_logpost(self, obs):
+        """Compute the log of the mixture weight times the predictive density of
+        each observation under each summarized cluster, in chunks of observations.
+        """
+        obs = np.asarray(obs, dtype=np.float64).reshape((len(obs), -1))
+        summary = self.summary
+        num_clusters, dim = summary['loc'].shape
+        # whiten observations for all clusters with one matrix product
+        prec_chol = summary['prec_chol'].reshape((num_clusters * dim, dim)).T
+        prec_loc = np.einsum('kij,kj->ki', summary['prec_chol'], summary['loc']).ravel()
+        log_base = summary['log_weight'] + summary['const']
+        half_df = 0.5 * (summary['df'] + dim)
+        logpost = np.empty((obs.shape[0], num_clusters))
+        step = max(1, self.chunk_size // num_clusters)
+        for start in xrange(0, obs.shape[0], step):
+            whitened = np.dot(obs[start:start+step], prec_chol) - prec_loc
+            maha = (whitened ** 2).reshape((-1, num_clusters, dim)).sum(axis = 2)
+            logpost[start:start+step] = log_base - half_df * np.log1p(maha / summary['df'])
+        return logpost
+
+    def score(self, obs = None):
+        """Compute the log posterior predictive density of each observation,
+        averaged over the summarized samples.
+        """
+        if obs is None: obs = self.obs
+        return logsumexp(self.cluster_logpost(obs), axis = 1)
+
+    def assign(self, obs = None):
+        """Assign each observation to its most probable cluster in the last
+        summarized sample. A new cluster gets the smallest unused label.
+        """
+        if obs is None: obs = self.obs
+        last = self.summary['sample'] == self.summary['sample'].max()
+        return self.summary['label'][last][self.cluster_logpost(obs)[:,last].argmax(axis = 1)]
+
+    def predict(self, thining = 0, burnin = 0, use_iter = None, output_file = None):
+        """Predict the test cases: the log predictive density of each test case
+        and its cluster assignment.
+        """
+        if self.summary is None: self.summarize(thining, burnin, use_iter)
+        logprob, labels = self.score(), self.assign()
+        if output_file is not None:
+            print('logprob', 'label', file = output_file, sep = ',')
+            for row in zip(logprob, labels): print(*row, file = output_file, sep = ',')
+        return logprob, labels
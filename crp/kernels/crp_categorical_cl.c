@@ -45,7 +45,7 @@ int sample(uint a_size, global uint *a, global float *p, int start, float rand)
   return a[a_size - 1];
 }
 
-__kernel void cat_logpost(global uint *labels, global uint *data, global uint *uniq_label, global float *count, global uint *n,  uint cluster_num, uint outcome_num, float alpha, float beta, global float *logpost, global float *rand) {
+__kernel void cat_logpost(global uint *labels, global uint *data, global uint *uniq_label, global uint *count, global uint *n,  uint cluster_num, uint outcome_num, float alpha, float beta, global float *logpost, global float *rand) {
   
   uint data_size = get_global_size(0);
   uint i = get_global_id(0);
@@ -56,8 +56,8 @@ __kernel void cat_logpost(global uint *labels, global uint *data, global uint *u
   uint original_cluster = old_label == new_label;
   float loglik;
 
-  loglik = (beta + count[outcome_num * c + data[i]] - original_cluster) / 
-    (outcome_num * beta + new_size - original_cluster);
+  loglik = log((beta + count[outcome_num * c + data[i]] - original_cluster) / 
+               (outcome_num * beta + new_size - original_cluster));
  
   loglik += (new_size > 0) ? log(new_size/(alpha + data_size)) : log(alpha/(alpha + data_size));
   logpost[i * cluster_num + c] = loglik;
@@ -88,8 +88,8 @@ __kernel void cat_logpost_loopy(global uint *labels, global int *data, global ui
     empty_n += (old_label == new_label && new_size == 1); // discounting for the slim chance that 
     original_cluster = old_label == new_label;
 
-    logpost[i * cluster_num + c] = (beta + count[outcome_num * c + data[i]] - original_cluster) / 
-      (outcome_num * beta + new_size - original_cluster);
+    logpost[i * cluster_num + c] = log((beta + count[outcome_num * c + data[i]] - original_cluster) / 
+                                       (outcome_num * beta + new_size - original_cluster));
     //printf("i: %d c: %d logpost: %f\n", i, c, logpost[i * cluster_num + c]);
     logpost[i * cluster_num + c] += (new_size > original_cluster) ? 
       log((new_size - original_cluster) / (alpha + data_size-1)) : log(alpha / empty_n / (alpha + data_size-1));
@@ -100,16 +100,62 @@ __kernel void cat_logpost_loopy(global uint *labels, global int *data, global ui
   //printf("Data %d After: %d\n", i, labels[i]);
 }
 
-__kernel void compute_suff_stats(global uint *uniq_label, global int *labels, global uint *data, global uint *count, global uint *n, uint data_size, uint outcome_num) {
-  
-  uint c = get_global_id(0);
-  n[c] = 0;
-  for (int i = 0; i < outcome_num; i++) {
-    count[outcome_num * c + i] = 0;
+/* Histogram of the sufficient statistics over (observation, dimension) pairs.
+   count is laid out as (cluster, dimension, outcome) and must be zeroed before
+   the launch; label_index maps a label value to its cluster index. Each work
+   group accumulates a private histogram in local memory and merges it into
+   the global one with atomics, so the global histogram sees at most one
+   atomic per bin per work group. */
+__kernel void histogram_suff_stats(global uint *labels, global uint *data, global uint *label_index,
+				   global uint *count, global uint *n, uint data_size, uint dim,
+				   uint outcome_num, uint cluster_num, local uint *local_count, local uint *local_n) {
+
+  uint lid = get_local_id(0);
+  uint local_size = get_local_size(0);
+  uint bin_num = cluster_num * dim * outcome_num;
+
+  for (uint j = lid; j < bin_num; j += local_size) local_count[j] = 0;
+  for (uint j = lid; j < cluster_num; j += local_size) local_n[j] = 0;
+  barrier(CLK_LOCAL_MEM_FENCE);
+
+  for (uint j = get_global_id(0); j < data_size * dim; j += get_global_size(0)) {
+    uint d = j % dim;
+    uint c = label_index[labels[j / dim]];
+    atomic_inc(&local_count[(c * dim + d) * outcome_num + data[j]]);
+    if (d == 0) atomic_inc(&local_n[c]);
   }
+  barrier(CLK_LOCAL_MEM_FENCE);
 
-  for (int i = 0; i < data_size; i++) {
-    n[c] += (uniq_label[c] == labels[i]);
-    count[outcome_num * c + (uniq_label[c] == labels[i]) * data[i]] += (uniq_label[c] == labels[i]);
+  for (uint j = lid; j < bin_num; j += local_size) {
+    if (local_count[j] > 0) atomic_add(&count[j], local_count[j]);
+  }
+  for (uint j = lid; j < cluster_num; j += local_size) {
+    if (local_n[j] > 0) atomic_add(&n[j], local_n[j]);
   }
 }
+
+/* The same histogram with atomics straight into global memory, for when the
+   histogram does not fit in the local memory of a work group. */
+__kernel void histogram_suff_stats_global(global uint *labels, global uint *data, global uint *label_index,
+					  global uint *count, global uint *n, uint data_size, uint dim,
+					  uint outcome_num) {
+
+  for (uint j = get_global_id(0); j < data_size * dim; j += get_global_size(0)) {
+    uint d = j % dim;
+    uint c = label_index[labels[j / dim]];
+    atomic_inc(&count[(c * dim + d) * outcome_num + data[j]]);
+    if (d == 0) atomic_inc(&n[c]);
+  }
+}
+
+__kernel void gather_clusters(global uint *src_count, global uint *src_n, global int *order,
+			      global uint *dst_count, global uint *dst_n, uint width) {
+  /* copy the statistics of cluster order[c] to cluster c, or zeros if
+     order[c] is negative, so that the clusters in use come after a new
+     empty one; launched over (clusters, dim * outcome_num) */
+  uint c = get_global_id(0);
+  uint j = get_global_id(1);
+  int src = order[c];
+  dst_count[c * width + j] = src < 0 ? 0 : src_count[src * width + j];
+  if (j == 0) dst_n[c] = src < 0 ? 0 : src_n[src];
+}
@@ -288,11 +288,58 @@ __kernel void normal_kd_logpost_loopy(global uint *labels, global float *data, g
 }
 
 // kernel to compute the joint log probability of data and a given sample (i.e., labels)
-__kernel void joint_logprob_kd(global uint *labels, global float *data, 
+__kernel void joint_logprob_kd(global uint *labels, global float *data,
 			       global float *hyper_param, global float *logprob) {
 
 }
 
+// kernel to compute the changes in the sufficient statistics of every cluster
+// caused by relabeling one chunk of the observations of a shard. Each cluster
+// gets a row of 1 + dim + dim * dim floats: the change in its number of
+// observations, in their sum and in the sum of their outer products. Work item
+// i takes observations i, i + chunks, i + 2 * chunks, ... and writes its own
+// cluster_num rows of partial, so no two work items write the same memory
+__kernel void normal_suff_stats_delta(global uint *old_labels, global uint *labels, global float *data,
+				      global uint *uniq_label, uint cluster_num, uint data_size, uint dim,
+				      global float *partial) {
+
+  uint chunk = get_global_id(0);
+  uint chunks = get_global_size(0);
+  uint width = 1 + dim + dim * dim;
+  global float *row;
+  float sign;
+
+  for (int j = 0; j < cluster_num * width; j++) partial[chunk * cluster_num * width + j] = 0.0f;
+
+  for (uint i = chunk; i < data_size; i += chunks) {
+    if (old_labels[i] == labels[i]) continue;
+    for (int c = 0; c < cluster_num; c++) {
+      sign = (float)(uniq_label[c] == labels[i]) - (float)(uniq_label[c] == old_labels[i]);
+      if (sign == 0.0f) continue;
+      row = partial + (chunk * cluster_num + c) * width;
+      row[0] += sign;
+      for (int d1 = 0; d1 < dim; d1++) {
+	row[1 + d1] += sign * data[i * dim + d1];
+	for (int d2 = 0; d2 < dim; d2++) {
+	  row[1 + dim + d1 * dim + d2] += sign * data[i * dim + d1] * data[i * dim + d2];
+	}
+      }
+    }
+  }
+}
+
+// kernel to add up the partial changes of normal_suff_stats_delta over its chunks
+__kernel void sum_chunks(global float *partial, uint chunks, global float *total) {
+
+  uint j = get_global_id(0);
+  uint size = get_global_size(0);
+  float total_j = 0.0f;
+  for (int chunk = 0; chunk < chunks; chunk++) {
+    total_j += partial[chunk * size + j];
+  }
+  total[j] = total_j;
+}
+
 
 /*
 __kernel void get_mu(global uint *labels, global float *data, gloal uint *uniq_label, 
@@ -1 +1 @@
-import noisyor, noisyortwoy
+import noisyor, noisyortwoy, parallel
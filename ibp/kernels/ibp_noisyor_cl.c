@@ -68,11 +68,12 @@ kernel void sample_y(global int *cur_y,
 		     global int *z_by_y,
 		     global int *obs,
 		     global float *rand, //global float *on_loglik, global float *off_loglik,
-		     uint N, uint D, uint K,
+		     uint N, uint D, uint K, uint K_max,
 		     float lambda, float epislon, float theta) {
   
   uint kth = get_global_id(0); // k is the index of features
   uint dth = get_global_id(1); // d is the index of pixels
+  if (kth >= K) return; // rows past K are unused capacity
   // calculate the prior probability of each cell is 1
   //printf("kth: %d, D: %d, dth: %d\n", kth, D, dth);
   float on_loglik_temp = log(theta); 
@@ -83,7 +84,7 @@ kernel void sample_y(global int *cur_y,
   for (int n = 0; n < N; n++) {
     z_by_y_nth = z_by_y[n * D + dth];
     // if the nth object has the kth feature
-    if (cur_z[n * K + kth] == 1) {
+    if (cur_z[n * K_max + kth] == 1) {
       // if the observed pixel at dth is on
       if (obs[n * D + dth] == 1) {
 	// if the feature image previously has this pixel on
@@ -113,15 +114,16 @@ kernel void sample_z(global int *cur_y,
 		     global int *z_col_sum,
 		     global int *obs,
 		     global float *rand, 
-		     uint N, uint D, uint K,
+		     uint N, uint D, uint K, uint K_max,
 		     float lambda, float epislon, float theta) {
   
   uint nth = get_global_id(0); // n is the index of data
   uint kth = get_global_id(1); // k is the index of features
+  if (kth >= K) return; // columns past K are unused capacity
   
   // calculate the prior probability of each cell is 1
-  float on_prob_temp = (z_col_sum[kth] - cur_z[nth * K + kth]) / (float)N; 
-  float off_prob_temp = 1 - (z_col_sum[kth] - cur_z[nth * K + kth]) / (float)N;
+  float on_prob_temp = (z_col_sum[kth] - cur_z[nth * K_max + kth]) / (float)N; 
+  float off_prob_temp = 1 - (z_col_sum[kth] - cur_z[nth * K_max + kth]) / (float)N;
 
   int z_by_y_dth;
   // extremely hackish way to calculate the probelihood
@@ -132,7 +134,7 @@ kernel void sample_z(global int *cur_y,
       // if the observed pixel at dth is on
       if (obs[nth * D + d] == 1) {
 	// if the nth object previously has the kth feature
-	if (cur_z[nth * K + kth] == 1) {
+	if (cur_z[nth * K_max + kth] == 1) {
 	  on_prob_temp *= 1 - pow(1 - lambda, z_by_y_dth) * (1 - epislon);
 	  off_prob_temp *= 1 - pow(1 - lambda, z_by_y_dth - 1) * (1 - epislon);
 	} else {
@@ -150,9 +152,7 @@ kernel void sample_z(global int *cur_y,
   float post[2] = {on_prob_temp, off_prob_temp};
   uint labels[2] = {1, 0};
   pnormalize(post, 0, 2);
-  //printf("before index: %d %f %f %d \n", nth * K + kth, post[0], post[1], cur_z[nth * K + kth]);
-  cur_z[nth * K + kth] = sample(2, labels, post, 0, rand[nth * K + kth]);
-  //printf("after index: %d %f %f %d \n", nth * K + kth, post[0], post[1], cur_z[nth * K + kth]);
+  cur_z[nth * K_max + kth] = sample(2, labels, post, 0, rand[nth * K_max + kth]);
 }
 
      
@@ -160,7 +160,7 @@ kernel void logprob_z_data(global int *cur_z,
 			   global int *cur_y,
 			   global int *obs,
 			   global float *logprob,
-			   uint N, uint D, uint K,
+			   uint N, uint D, uint K, uint K_max,
 			   float alpha, float lambda, float epislon) {
 
   uint nth = get_global_id(0); // n is the index of data
@@ -175,9 +175,9 @@ kernel void logprob_z_data(global int *cur_z,
    */
   for (int k = 0; k < K; k++) {
     m = 0;
-    cur_z_nth = cur_z[nth * K + k];
+    cur_z_nth = cur_z[nth * K_max + k];
     for (int n = 0; n < nth; n++) {
-      m += cur_z[n * K + k];
+      m += cur_z[n * K_max + k];
     }
     if (m > 0) { // if other objects have had this feature
       if (cur_z_nth == 1) {
@@ -198,7 +198,7 @@ kernel void logprob_z_data(global int *cur_z,
   for (int d = 0; d < D; d++) {
     weight = 0;
     for (int k = 0; k < K; k++) {
-      weight += cur_y[k * D + d] * cur_z[nth * K + k];
+      weight += cur_y[k * D + d] * cur_z[nth * K_max + k];
     }
     if (obs[nth * D + d] == 1) {
       logprob_temp += log(1 - pow(1 - lambda, weight) * (1 - epislon));
@@ -208,3 +208,105 @@ kernel void logprob_z_data(global int *cur_z,
   }
   logprob[nth] = logprob_temp;
 }
+
+kernel void compute_z_by_y(global int *cur_z,
+			   global int *cur_y,
+			   global int *z_by_y,
+			   uint N, uint D, uint K, uint K_max) {
+  /* the number of features of the nth object that have pixel d on,
+     computed the same way as dotProd in kernels/utilities_cl.c
+  */
+  uint nth = get_global_id(0); // n is the index of data
+  uint dth = get_global_id(1); // d is the index of pixels
+  int count = 0;
+  for (int k = 0; k < K; k++) {
+    count += cur_z[nth * K_max + k] * cur_y[k * D + dth];
+  }
+  z_by_y[nth * D + dth] = count;
+}
+
+kernel void feature_summary(global int *cur_y,
+			    global int *cur_z,
+			    global int *z_col_sum,
+			    global int *y_row_sum,
+			    global int *active,
+			    uint N, uint D, uint K, uint K_max) {
+  /* the number of owners and the number of pixels that are on
+     of the kth feature, and whether it is active, i.e. neither
+     null nor empty; launched over the whole capacity K_max
+  */
+  uint kth = get_global_id(0); // k is the index of features
+  int owners = 0, pixels = 0;
+  if (kth < K) {
+    for (int n = 0; n < N; n++) {
+      owners += cur_z[n * K_max + kth];
+    }
+    for (int d = 0; d < D; d++) {
+      pixels += cur_y[kth * D + d];
+    }
+  }
+  z_col_sum[kth] = owners;
+  y_row_sum[kth] = pixels;
+  active[kth] = owners > 0 && pixels > 0;
+}
+
+kernel void count_histogram(global int *obs,
+			    global int *z_by_y,
+			    global int *hist,
+			    uint width) {
+  /* count the pixels by observed value and the number of features
+     that have them on; hist has one row of width counts per value
+  */
+  uint i = get_global_id(0);
+  atomic_inc(&hist[obs[i] * width + z_by_y[i]]);
+}
+
+kernel void birth_features(global int *cur_y,
+			   global int *cur_z,
+			   global float *rand,
+			   uint N, uint D, uint K, uint K_new, uint K_max,
+			   float theta) {
+  /* give K_new new features, stored after the K in use, random owners
+     and random images; work item i < N fills row i of Z, the others
+     fill column i - N of Y
+  */
+  uint i = get_global_id(0);
+  if (i < N) {
+    for (int j = 0; j < K_new; j++) {
+      cur_z[i * K_max + K + j] = rand[i * K_new + j] < 0.5f;
+    }
+  } else {
+    uint dth = i - N;
+    for (int j = 0; j < K_new; j++) {
+      cur_y[(K + j) * D + dth] = rand[N * K_new + j * D + dth] < theta;
+    }
+  }
+}
+
+kernel void compact_features(global int *src_y,
+			     global int *src_z,
+			     global int *dst_y,
+			     global int *dst_z,
+			     global int *active,
+			     uint N, uint D, uint K,
+			     uint src_K_max, uint dst_K_max) {
+  /* move the active features among the first K to the front, keeping
+     their order, and zero the rest; work item i < N moves row i of Z,
+     the others column i - N of Y. Every work item reads only what it
+     writes, so src and dst can be the same buffers
+  */
+  uint i = get_global_id(0);
+  uint j = 0;
+  if (i < N) {
+    for (int k = 0; k < K; k++) {
+      if (active[k]) dst_z[i * dst_K_max + j++] = src_z[i * src_K_max + k];
+    }
+    for (; j < K; j++) dst_z[i * dst_K_max + j] = 0;
+  } else {
+    uint dth = i - N;
+    for (int k = 0; k < K; k++) {
+      if (active[k]) dst_y[j++ * D + dth] = src_y[k * D + dth];
+    }
+    for (; j < K; j++) dst_y[j * D + dth] = 0;
+  }
+}
@@ -0,0 +1,212 @@
+/* Kernels of the two-Y noisy-or IBP samplers. Y holds the two feature
+   images of every feature, as two K_max x D planes, and F picks for
+   each object which image of each feature it uses (0 for neither, so Z
+   is F > 0). counts holds, for every object and pixel, the number of
+   features that have the pixel on in the images the object uses.
+*/
+
+float pixel_loglik(int obs, int count, float lambda, float epislon) {
+  /* the loglikelihood of a pixel that count features have on */
+  if (obs == 1) return log(1 - pow(1 - lambda, count) * (1 - epislon));
+  return count * log(1 - lambda) + log(1 - epislon);
+}
+
+kernel void compute_counts(global int *cur_y,
+			   global int *cur_f,
+			   global int *counts,
+			   uint N, uint D, uint K, uint K_max) {
+  /* the number of features of the nth object that have pixel d on in
+     the image F picks for them */
+  uint nth = get_global_id(0); // n is the index of data
+  uint dth = get_global_id(1); // d is the index of pixels
+  int count = 0;
+  int f;
+  for (int k = 0; k < K; k++) {
+    f = cur_f[nth * K_max + k];
+    if (f > 0) count += cur_y[((f - 1) * K_max + k) * D + dth];
+  }
+  counts[nth * D + dth] = count;
+}
+
+kernel void sample_y(global int *cur_y,
+		     global int *cur_f,
+		     global int *counts,
+		     global int *obs,
+		     global float *rand,
+		     uint N, uint D, uint K, uint K_max,
+		     float lambda, float epislon, float theta) {
+  /* resample pixel d of image i of feature k given the counts at the
+     start of the step, from the objects that use that image; launched
+     over (2 * K_max, D) */
+  uint ith = get_global_id(0) / K_max; // i is the index of images
+  uint kth = get_global_id(0) % K_max; // k is the index of features
+  uint dth = get_global_id(1); // d is the index of pixels
+  if (kth >= K) return; // rows past K are unused capacity
+
+  uint cell = (ith * K_max + kth) * D + dth;
+  float on_loglik = log(theta);
+  float off_loglik = log(1 - theta);
+  int other_count;
+  for (int n = 0; n < N; n++) {
+    if (cur_f[n * K_max + kth] == ith + 1) {
+      other_count = counts[n * D + dth] - cur_y[cell];
+      on_loglik += pixel_loglik(obs[n * D + dth], other_count + 1, lambda, epislon);
+      off_loglik += pixel_loglik(obs[n * D + dth], other_count, lambda, epislon);
+    }
+  }
+  cur_y[cell] = rand[cell] < 1 / (1 + exp(off_loglik - on_loglik));
+}
+
+kernel void sample_f(global int *cur_y,
+		     global int *cur_f,
+		     global int *counts,
+		     global int *z_col_sum,
+		     global int *obs,
+		     global float *rand,
+		     uint N, uint D, uint K, uint K_max,
+		     uint num_f1, uint num_f2, float f_prior_1, float f_prior_2,
+		     float lambda, float epislon) {
+  /* resample the features of the nth object one after another, keeping
+     its row of counts up to date. The numbers of owners of the features
+     and of cells of F that pick either image are those at the start of
+     the step, without the object's own cells. The image priors follow
+     them unless f_prior_1 is not negative */
+  uint nth = get_global_id(0); // n is the index of data
+  int old_f, new_f, base, y1, y2;
+  float loglik[3];
+  float m_minus, p1, p2, total;
+  for (int k = 0; k < K; k++) {
+    old_f = cur_f[nth * K_max + k];
+
+    // the prior of the three choices
+    m_minus = (z_col_sum[k] - (old_f > 0)) / (float)N;
+    if (f_prior_1 < 0) {
+      total = num_f1 + num_f2 - (old_f > 0) + .0002f;
+      p1 = (num_f1 - (old_f == 1) + .0001f) / total;
+      p2 = (num_f2 - (old_f == 2) + .0001f) / total;
+    } else {
+      p1 = f_prior_1;
+      p2 = f_prior_2;
+    }
+    loglik[0] = log(1 - m_minus);
+    loglik[1] = log(m_minus * p1);
+    loglik[2] = log(m_minus * p2);
+
+    // pixels that neither image has on contribute the same to all choices
+    for (int d = 0; d < D; d++) {
+      y1 = cur_y[k * D + d];
+      y2 = cur_y[(K_max + k) * D + d];
+      if (y1 == 0 && y2 == 0) continue;
+      base = counts[nth * D + d] - (old_f == 1 ? y1 : (old_f == 2 ? y2 : 0));
+      loglik[0] += pixel_loglik(obs[nth * D + d], base, lambda, epislon);
+      loglik[1] += pixel_loglik(obs[nth * D + d], base + y1, lambda, epislon);
+      loglik[2] += pixel_loglik(obs[nth * D + d], base + y2, lambda, epislon);
+    }
+
+    // normalize and sample
+    float m = fmax(loglik[0], fmax(loglik[1], loglik[2]));
+    float p[3];
+    total = 0;
+    for (int i = 0; i < 3; i++) {
+      p[i] = exp(loglik[i] - m);
+      total += p[i];
+    }
+    float r = rand[nth * K_max + k] * total;
+    new_f = r < p[0] ? 0 : (r < p[0] + p[1] ? 1 : 2);
+    cur_f[nth * K_max + k] = new_f;
+
+    if (new_f != old_f) {
+      for (int d = 0; d < D; d++) {
+	y1 = cur_y[k * D + d];
+	y2 = cur_y[(K_max + k) * D + d];
+	counts[nth * D + d] += (new_f == 1 ? y1 : (new_f == 2 ? y2 : 0)) - (old_f == 1 ? y1 : (old_f == 2 ? y2 : 0));
+      }
+    }
+  }
+}
+
+kernel void feature_summary(global int *cur_f,
+			    global int *z_col_sum,
+			    global int *f1_col_sum,
+			    global int *f2_col_sum,
+			    global int *active,
+			    uint N, uint K, uint K_max) {
+  /* the number of owners of the kth feature, the numbers of them that
+     use either image, and whether it is active, i.e. not null; launched
+     over the whole capacity K_max */
+  uint kth = get_global_id(0); // k is the index of features
+  int ones = 0, twos = 0;
+  if (kth < K) {
+    for (int n = 0; n < N; n++) {
+      ones += cur_f[n * K_max + kth] == 1;
+      twos += cur_f[n * K_max + kth] == 2;
+    }
+  }
+  z_col_sum[kth] = ones + twos;
+  f1_col_sum[kth] = ones;
+  f2_col_sum[kth] = twos;
+  active[kth] = ones + twos > 0;
+}
+
+kernel void count_histogram(global int *obs,
+			    global int *counts,
+			    global int *hist,
+			    uint width) {
+  /* count the pixels by observed value and the number of features
+     that have them on; hist has one row of width counts per value
+  */
+  uint i = get_global_id(0);
+  atomic_inc(&hist[obs[i] * width + counts[i]]);
+}
+
+kernel void add_features(global int *cur_y,
+			 global int *cur_f,
+			 global int *counts,
+			 global int *new_y,
+			 global int *new_f,
+			 uint nth, uint D, uint K, uint K_new, uint K_max) {
+  /* store K_new new features owned by the nth object only after the K
+     in use, and add the images it uses to its counts; launched over D */
+  uint dth = get_global_id(0); // d is the index of pixels
+  for (int j = 0; j < K_new; j++) {
+    cur_y[(K + j) * D + dth] = new_y[j * D + dth];
+    cur_y[(K_max + K + j) * D + dth] = new_y[(K_new + j) * D + dth];
+    counts[nth * D + dth] += new_y[((new_f[j] - 1) * K_new + j) * D + dth];
+    if (dth == 0) cur_f[nth * K_max + K + j] = new_f[j];
+  }
+}
+
+kernel void compact_features(global int *src_y,
+			     global int *src_f,
+			     global int *dst_y,
+			     global int *dst_f,
+			     global int *active,
+			     uint N, uint D, uint K,
+			     uint src_K_max, uint dst_K_max) {
+  /* move the active features among the first K to the front, keeping
+     their order, and zero the rest; work item i < N moves row i of F,
+     the others column i - N of both images. Every work item reads only
+     what it writes, so src and dst can be the same buffers
+  */
+  uint i = get_global_id(0);
+  uint j = 0;
+  if (i < N) {
+    for (int k = 0; k < K; k++) {
+      if (active[k]) dst_f[i * dst_K_max + j++] = src_f[i * src_K_max + k];
+    }
+    for (; j < K; j++) dst_f[i * dst_K_max + j] = 0;
+  } else {
+    uint dth = i - N;
+    for (int k = 0; k < K; k++) {
+      if (active[k]) {
+	dst_y[j * D + dth] = src_y[k * D + dth];
+	dst_y[(dst_K_max + j) * D + dth] = src_y[(src_K_max + k) * D + dth];
+	j++;
+      }
+    }
+    for (; j < K; j++) {
+      dst_y[j * D + dth] = 0;
+      dst_y[(dst_K_max + j) * D + dth] = 0;
+    }
+  }
+}
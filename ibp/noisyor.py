@@ -6,20 +6,23 @@ import sys, os.path, itertools, cPickle
 pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
 sys.path.append(pkg_dir)
 
-from fractions import gcd
 from scipy.stats import poisson
+import scipy.sparse
 from MPBNP import *
 from MPBNP import BaseSampler, BasePredictor
 
 np.set_printoptions(suppress=True)
 
-class Gibbs(BaseSampler):
+class Gibbs(BaseSampler, NoisyOrSampler):
 
     def __init__(self, cl_mode = True, cl_device = None, record_best = True,
-                 alpha = None, lam = 0.98, theta = 0.10, epislon = 0.02, init_k = 10):
+                 alpha = None, lam = 0.98, theta = 0.10, epislon = 0.02, init_k = 10,
+                 compact = False):
         """Initialize the class.
+        @param compact: Keep the images bit-packed and Y and Z as uint8 (without OpenCL only)
         """
         BaseSampler.__init__(self, cl_mode = cl_mode, cl_device = cl_device, record_best = record_best)
+        self.compact = compact and not cl_mode
 
         if cl_mode:
             program_str = open(pkg_dir + 'MPBNP/ibp/kernels/ibp_noisyor_cl.c', 'r').read()
@@ -31,6 +34,8 @@ class Gibbs(BaseSampler):
                         get_work_group_info(cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, self.device)
             self.p_mul_sample_z = cl.Kernel(self.prg, 'sample_z').\
                         get_work_group_info(cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, self.device)
+            self.p_mul_compute_z_by_y = cl.Kernel(self.prg, 'compute_z_by_y').\
+                        get_work_group_info(cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, self.device)
 
             
         self.alpha = alpha # tendency to generate new features
@@ -39,22 +44,19 @@ class Gibbs(BaseSampler):
         self.lam = lam # effecacy of a feature
         self.epislon = epislon # probability that a pixel is on by change in an actual image
         self.samples = {'z': [], 'y': []} # sample storage, to be pickled
-
-    def read_csv(self, filepath, header=True):
+        self.chunk_size = 2 ** 22 # maximum number of (row, feature, pixel) cells evaluated at once
+        self.sparse_z = None # Z in CSR form while the compact host loop runs, rebuilt only when Z changes
+        self.noisyor = NoisyOrLikelihood()
+        self.sample_lam_epislon = False # resample lambda and epislon every iteration
+        self.sampled_params = ['lam', 'epislon'] # kept with the samples and the best sample
+        self.k_max = 32 # capacity of the feature arrays on the device; doubles as needed
+
+    def read_csv(self, filepath, header=True, rows = None):
         """Read the data from a csv file.
+        @param rows: Indices of the images to read; all of them by default
         """
-        BaseSampler.read_csv(self, filepath, header)
-        # convert the data to floats
-        self.new_obs = []
-        self.img_w, self.img_h = None, None
-        for row in self.obs:
-            if self.img_w is None:
-                self.img_w = int(row[0])
-                if self.img_w == 0 or (len(row)-1) % self.img_w != 0:
-                    raise Exception('The sampler does not understand the format of the data. Did you forget to specify image width in the data file?')
-            self.new_obs.append([int(_) for _ in row])
-
-            self.obs = np.array(self.new_obs)[:,1:]
+        self.obs, self.img_w = read_images(filepath, header, rows = rows, packed = self.compact)
+        self.N = len(self.obs)
         if self.cl_mode:
             self.d_obs = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf=self.obs.astype(np.int32))
 
@@ -84,6 +86,8 @@ class Gibbs(BaseSampler):
         else:
             assert(type(init_z) is np.ndarray)
             assert(init_z.shape == (len(self.obs), self.k))
+        if self.compact:
+            init_y, init_z = init_y.astype(np.uint8), init_z.astype(np.uint8)
 
         if self.cl_mode:
             timing_stats = self._cl_infer_yz(init_y, init_z, output_file)
@@ -136,8 +140,10 @@ class Gibbs(BaseSampler):
                       'epislon,%f' % self.epislon,
                       'gpu_time,%f' % timing_stats[0], 'total_time,%f' % timing_stats[1],
                       file = gzip.open(output_file + 'parameters.csv.gz', 'w'), sep = '\n')
-                np.savez_compressed(output_file + 'feature_ownership.npz', self.samples['z'])
-                np.savez_compressed(output_file + 'feature_images.npz', self.samples['y'])
+                save_samples(output_file + 'feature_ownership.npz', self.samples['z'], dtype=np.uint8)
+                save_samples(output_file + 'feature_images.npz', self.samples['y'], dtype=np.uint8)
+                save_samples(output_file + 'lambda.npz', self.samples.get('lam', []))
+                save_samples(output_file + 'epislon.npz', self.samples.get('epislon', []))
 
         return timing_stats
                 
@@ -147,50 +153,77 @@ class Gibbs(BaseSampler):
         @param init_y: Passed in from do_inference()
         @param init_z: Passed in from do_inference()
         """
-        cur_y = init_y
-        cur_z = init_z
+        state = FeatureState([('y', init_y, 0), ('z', init_z, 1)])
 
         a_time = time()
-        self.auto_save_sample(sample = (cur_y, cur_z))
+        self._update_sparse_z(state['z'])
+        self.auto_save_sample(sample = state.copy('y', 'z'))
         for i in xrange(self.niter):
-            temp_cur_y = self._infer_y(cur_y, cur_z)
-            temp_cur_y, temp_cur_z = self._infer_z(temp_cur_y, cur_z)
-            #self._sample_lam(cur_y, cur_z)
+            state['y'][:] = self._infer_y(state['y'], state['z'])
+            self._infer_z(state)
+            if self.sample_lam_epislon:
+                hist = self._count_histogram(state['y'], state['z'])
+                self._sample_lam(hist)
+                self._sample_epislon(hist)
 
             if self.record_best:
-                if self.auto_save_sample(sample = (temp_cur_y, temp_cur_z)):
-                    cur_y, cur_z = temp_cur_y, temp_cur_z
+                # only a new best sample is copied out of the state
+                logprob = self._logprob((state['y'], state['z']))
+                sample = None
+                if logprob > self.best_sample[1]: sample = state.copy('y', 'z')
+                if not self.auto_save_sample(sample = sample, logprob = logprob):
+                    # go back to the last accepted sample
+                    best_y, best_z = self.best_sample[0]
+                    state.load(y = best_y, z = best_z)
+                    self._update_sparse_z(state['z'])
+                    self.restore_best_params()
                 if self.no_improvement():
                     break                    
                 
             elif i >= self.burnin:
-                cur_y, cur_z = temp_cur_y, temp_cur_z
+                cur_y, cur_z = state.copy('y', 'z')
                 self.samples['z'].append(cur_z)
                 self.samples['y'].append(cur_y)
+                self.record_params()
 
+        self.sparse_z = None
         self.total_time += time() - a_time
         return self.gpu_time, self.total_time, None
 
     def _infer_y(self, cur_y, cur_z):
         """Infer feature images
         """
+        on_loglik, off_loglik = self._y_loglik(self.obs, cur_y, cur_z)
+        return self._sample_y(cur_y, on_loglik, off_loglik)
+
+    def _y_loglik(self, obs, cur_y, cur_z):
+        """Return the loglikelihoods of obs with each pixel of each feature image
+        turned on and off. Both are sums over the rows of obs, so the values for
+        disjoint sets of rows add up to the values for all of them.
+        """
+        # Turning pixel d of feature k on or off only changes column d of the
+        # Z*Y counts, and only for the rows owning feature k, so all pixels of
+        # a feature are evaluated at once
+        n_by_d = self._feature_counts(cur_y, cur_z)
+        on_loglik = np.zeros(cur_y.shape)
+        off_loglik = np.zeros(cur_y.shape)
+        for row in xrange(cur_y.shape[0]):
+            affected_data_index = np.where(cur_z[:,row] == 1)[0]
+            if affected_data_index.shape[0] == 0: continue
+            off_counts = n_by_d[affected_data_index] - cur_y[row]
+            affected_obs = obs[affected_data_index]
+            on_loglik[row] = self._pixel_loglik(affected_obs, off_counts + 1).sum(axis = 0)
+            off_loglik[row] = self._pixel_loglik(affected_obs, off_counts).sum(axis = 0)
+        return on_loglik, off_loglik
+
+    def _sample_y(self, cur_y, on_loglik, off_loglik):
+        """Sample feature images given the loglikelihoods of the data with each
+        of their pixels turned on and off.
+        """
         # calculate the prior probability that a pixel is on
         y_on_log_prob = np.log(self.theta) * np.ones(cur_y.shape)
         y_off_log_prob = np.log(1. - self.theta) * np.ones(cur_y.shape)
 
-        # calculate the likelihood
-        on_loglik = np.empty(cur_y.shape)
-        off_loglik = np.empty(cur_y.shape)
-        for row in xrange(cur_y.shape[0]):
-            affected_data_index = np.where(cur_z[:,row] == 1)
-            for col in xrange(cur_y.shape[1]):
-                old_value = cur_y[row, col]
-                cur_y[row, col] = 1
-                on_loglik[row, col] = self._loglik_nth(cur_y, cur_z, n = affected_data_index)
-                cur_y[row, col] = 0
-                off_loglik[row, col] = self._loglik_nth(cur_y, cur_z, n = affected_data_index)
-                cur_y[row, col] = old_value
-
         # add to the prior
         y_on_log_prob += on_loglik
         y_off_log_prob += off_loglik
@@ -202,58 +235,58 @@ class Gibbs(BaseSampler):
         # normalize
         y_on_prob = np.exp(y_on_log_prob) / (np.exp(y_on_log_prob) + np.exp(y_off_log_prob))
         cur_y = np.random.binomial(1, y_on_prob)
+        if self.compact: cur_y = cur_y.astype(np.uint8)
 
         return cur_y
 
-    def _infer_z(self, cur_y, cur_z):
-        """Infer feature ownership
+    def _infer_z(self, state):
+        """Infer feature ownership, updating the FeatureState of Y and Z in place
         """
-        N = float(len(self.obs))
-        z_col_sum = cur_z.sum(axis = 0)
+        cur_z = state['z']
+        cur_z[:] = self._sample_z(self.obs, state['y'], cur_z, cur_z.sum(axis = 0), len(self.obs))
+
+        # sample new features use importance sampling
+        k_new = self._sample_k_new(state['y'], state['z'])
+        if k_new:
+            new_y, new_z = k_new
+            state.append(new_y.shape[0], y = new_y, z = new_z)
+        
+        # delete empty feature images and null features
+        state.remove((state['y'].sum(axis = 1) == 0) | (state['z'].sum(axis = 0) == 0))
+        
+        # update self.k
+        self.k = state.k
+        self._update_sparse_z(state['z'])
+
+    def _sample_z(self, obs, cur_y, cur_z, z_col_sum, N):
+        """Sample the ownership of existing features for the rows of obs, where
+        z_col_sum is the number of owners of each feature among all N data points.
+        """
+        N = float(N)
 
         # calculate the IBP prior on feature ownership for existing features
         m_minus = z_col_sum - cur_z
-        on_prob = m_minus / N
-        off_prob = 1 - m_minus / N
+        with np.errstate(divide = 'ignore'):
+            on_log_prob = np.log(m_minus / N)
+            off_log_prob = np.log(1 - m_minus / N)
         
-        # add loglikelihood of data
-        for row in xrange(cur_z.shape[0]):
-            for col in xrange(cur_z.shape[1]):
-                old_value = cur_z[row, col]
-                cur_z[row, col] = 1
-                on_prob[row, col] = on_prob[row, col] * np.exp(self._loglik_nth(cur_y, cur_z, n = row))
-                cur_z[row, col] = 0
-                off_prob[row, col] = off_prob[row, col] * np.exp(self._loglik_nth(cur_y, cur_z, n = row))
-                cur_z[row, col] = old_value
+        # add loglikelihood of data. Turning feature k of row n on or off adds
+        # or removes Y[k] from the Z*Y counts of row n, so the on/off
+        # loglikelihoods of all (row, feature) pairs are one broadcasted
+        # operation over a (row, feature, pixel) block, done in chunks of rows
+        for rows in self._row_chunks(cur_z.shape[0], cur_y.size):
+            n_by_d = self._feature_counts(cur_y, cur_z, rows)
+            off_counts = n_by_d[:,np.newaxis,:] - cur_z[rows,:,np.newaxis] * cur_y
+            chunk_obs = obs[rows][:,np.newaxis,:]
+            on_log_prob[rows] += self._pixel_loglik(chunk_obs, off_counts + cur_y).sum(axis = 2)
+            off_log_prob[rows] += self._pixel_loglik(chunk_obs, off_counts).sum(axis = 2)
 
         # normalize the probability
-        on_prob = on_prob / (on_prob + off_prob)
+        with np.errstate(over = 'ignore'):
+            on_prob = 1. / (1. + np.exp(off_log_prob - on_log_prob))
 
         # sample the values
-        cur_z = np.random.binomial(1, on_prob)
-
-        # sample new features use importance sampling
-        k_new = self._sample_k_new(cur_y, cur_z)
-        if k_new:
-            cur_y, cur_z = k_new
-        
-        # delete empty feature images
-        non_empty_feat_img = np.where(cur_y.sum(axis = 1) > 0)
-        cur_y = cur_y[non_empty_feat_img[0],:]
-        cur_z = cur_z[:,non_empty_feat_img[0]]
-
-        # delete null features
-        active_feat_col = np.where(cur_z.sum(axis = 0) > 0)
-        cur_z = cur_z[:,active_feat_col[0]]
-        cur_y = cur_y[active_feat_col[0],:]
-
-        # the above two steps need to be done before sampling new features
-        # because new features are initialized randomly
-        
-        # update self.k
-        self.k = cur_z.shape[1]
-        
-        return cur_y, cur_z
+        return np.random.binomial(1, on_prob)
 
     def _sample_k_new(self, cur_y, cur_z):
         """Sample new features for all rows using Metropolis hastings.
@@ -263,6 +296,7 @@ class Gibbs(BaseSampler):
         this frozen snapshot of Z. In a more correct procedure, we should
         go through the rows and sample k new for each row given all previously
         sampled new ks.)
+        @return: The images and the ownership of the new features, or False
         """
         N = float(len(self.obs))
         #old_loglik = self._loglik(cur_y, cur_z)
@@ -270,43 +304,53 @@ class Gibbs(BaseSampler):
         k_new_count = np.random.poisson(self.alpha / N)
         if k_new_count == 0: return False
             
-        # modify the feature ownership matrix
-        cur_z_new = np.hstack((cur_z, np.random.randint(0, 2, size = (cur_z.shape[0], k_new_count))))
-        #cur_z_new[:, [xrange(-k_new_count,0)]] = 1
+        # the ownership of the new features
+        new_z = np.random.randint(0, 2, size = (cur_z.shape[0], k_new_count))
         # propose feature images by sampling from the prior distribution
-        cur_y_new = np.vstack((cur_y, np.random.binomial(1, self.theta, (k_new_count, self.d))))
+        new_y = np.random.binomial(1, self.theta, (k_new_count, self.d))
         
-        return cur_y_new.astype(np.int32), cur_z_new.astype(np.int32)
+        return new_y, new_z
 
-    def _sample_lam(self, cur_y, cur_z):
-        """Resample the value of lambda.
+    def _count_histogram(self, cur_y, cur_z, obs = None):
+        """Return the (observed value, count) histogram of the data given Y and Z,
+        which is all that the loglikelihood needs for resampling lambda and epislon.
+        @param obs: The rows of the data Z belongs to; all of them by default
         """
-        old_loglik = self._loglik(cur_y, cur_z)
-        old_lam = self.lam
-    
-        # modify the feature ownership matrix
-        self.lam = np.random.beta(1,1)
-        new_loglik = self._loglik(cur_y, cur_z)
-        move_prob = 1 / (1 + np.exp(old_loglik - new_loglik));
-        if random.random() < move_prob:
-            pass
-        else:
-            self.lam = old_lam
+        if obs is None: obs = self.obs
+        hist = np.zeros((2, cur_y.shape[0] + 1), dtype=np.int64)
+        for rows in self._row_chunks(cur_z.shape[0], cur_y.shape[1]):
+            hist += self.noisyor.count_histogram(obs[rows], self._feature_counts(cur_y, cur_z, rows),
+                                                 width = hist.shape[1])
+        return hist
+
+    def _row_chunks(self, num_rows, row_cells):
+        """Return slices of rows of which each covers at most chunk_size cells,
+        so that packed images are unpacked and counted a chunk at a time.
+        @param row_cells: The number of cells evaluated for each row
+        """
+        chunk_rows = max(1, self.chunk_size // max(1, row_cells))
+        return [slice(_, _ + chunk_rows) for _ in xrange(0, num_rows, chunk_rows)]
 
-    def _sample_epislon(self, cur_y, cur_z):
-        """Resample the value of epislon
+    def _update_sparse_z(self, cur_z):
+        """Keep the CSR form of Z in step with the state after Z changes.
         """
-        old_loglik = self._loglik(cur_y, cur_z)
-        old_epislon = self.epislon
-    
-        # modify the feature ownership matrix
-        self.epislon = np.random.beta(1,1)
-        new_loglik = self._loglik(cur_y, cur_z)
-        move_prob = 1 / (1 + np.exp(old_loglik - new_loglik));
-        if random.random() < move_prob:
-            pass
-        else:
-            self.epislon = old_epislon
+        if self.compact: self.sparse_z = scipy.sparse.csr_matrix(cur_z)
+
+    def _feature_counts(self, cur_y, cur_z, rows = slice(None)):
+        """Return the number of active features that have each pixel of each
+        data point on, as a sparse-dense product if the state is compact.
+        @param rows: The rows of Z to count for; all of them by default
+        """
+        if not self.compact: return np.dot(cur_z[rows], cur_y)
+        if self.sparse_z is not None and self.sparse_z.shape == cur_z.shape:
+            return feature_counts(self.sparse_z[rows], cur_y)
+        return feature_counts(cur_z[rows], cur_y)
+
+    def _pixel_loglik(self, obs, n_by_d):
+        """Calculate the loglikelihood of each pixel of obs given the number
+        of active features that have that pixel on.
+        """
+        return self.noisyor.loglik(obs, n_by_d, self.lam, self.epislon)
 
     def _loglik_nth(self, cur_y, cur_z, n):
         """Calculate the loglikelihood of the nth data point
@@ -314,8 +358,7 @@ class Gibbs(BaseSampler):
         """
         assert(cur_z.shape[1] == cur_y.shape[0])
                 
-        not_on_p = np.power(1. - self.lam, np.dot(cur_z[n], cur_y)) * (1. - self.epislon)
-        loglik = np.log(np.abs(self.obs[n] - not_on_p)).sum()
+        loglik = self._pixel_loglik(self.obs[n], np.dot(cur_z[n], cur_y)).sum()
         return loglik
 
     def _loglik(self, cur_y, cur_z):
@@ -323,117 +366,211 @@ class Gibbs(BaseSampler):
         """
         assert(cur_z.shape[1] == cur_y.shape[0])
 
-        n_by_d = np.dot(cur_z, cur_y)
-        not_on_p = np.power(1. - self.lam, n_by_d) * (1. - self.epislon)
-        loglik_mat = np.log(np.abs(self.obs - not_on_p))
-        return loglik_mat.sum()
+        return sum(self._pixel_loglik(self.obs[rows], self._feature_counts(cur_y, cur_z, rows)).sum()
+                   for rows in self._row_chunks(cur_z.shape[0], cur_y.shape[1]))
 
     def _cl_infer_yz(self, init_y, init_z, output_file = None):
         """Wrapper function to start the inference on y and z.
         This function is not supposed to directly invoked by an end user.
+        Y, Z and their Z*Y counts stay on the device between iterations. Only
+        the number of features in use and the samples that are kept are
+        copied back.
         @param init_y: Passed in from do_inference()
         @param init_z: Passed in from do_inference()
         """
-        cur_y = init_y.astype(np.int32)
-        cur_z = init_z.astype(np.int32)
-
-        self.auto_save_sample(sample = (cur_y, cur_z))
+        self._cl_set_state(init_y.astype(np.int32), init_z.astype(np.int32))
+        if self.record_best:
+            best_state = (self.d_cur_y.copy(), self.d_cur_z.copy(), self.k)
+            self.auto_save_sample(sample = (init_y.astype(np.int32), init_z.astype(np.int32)),
+                                  logprob = self._cl_logprob(self.d_cur_y, self.d_cur_z, self.k))
         for i in xrange(self.niter):
             a_time = time()
-            temp_cur_y = self._cl_infer_y(cur_y, cur_z)
-            temp_cur_z = self._cl_infer_z(temp_cur_y, cur_z)
-            self.gpu_time += time() - a_time
-            temp_cur_y, temp_cur_z = self._cl_infer_k_new(temp_cur_y, temp_cur_z)
+            b_time = self.device_clock()
+            self._cl_infer_y()
+            self._cl_infer_z()
+            self.gpu_time += self.device_clock() - b_time
+            self._cl_infer_k_new()
+            if self.sample_lam_epislon:
+                hist = self._cl_count_histogram()
+                self._sample_lam(hist)
+                self._sample_epislon(hist)
 
             if self.record_best:
-                if self.auto_save_sample(sample = (temp_cur_y, temp_cur_z)):
-                    cur_y, cur_z = temp_cur_y, temp_cur_z
+                logprob = self._cl_logprob(self.d_cur_y, self.d_cur_z, self.k)
+                # only a new best sample is copied back to the host
+                sample = None
+                if logprob > self.best_sample[1]: sample = self._cl_get_state()
+                if self.auto_save_sample(sample = sample, logprob = logprob):
+                    best_state = (self.d_cur_y.copy(), self.d_cur_z.copy(), self.k)
+                else:
+                    self._cl_set_state(best_state[0].copy(), best_state[1].copy(), best_state[2])
+                    self.restore_best_params()
                 if self.no_improvement(1000):
                     break                    
             elif i >= self.burnin:
-                cur_y, cur_z = temp_cur_y, temp_cur_z
+                cur_y, cur_z = self._cl_get_state()
                 self.samples['z'].append(cur_z)
                 self.samples['y'].append(cur_y)
+                self.record_params()
             
             self.total_time += time() - a_time
 
         return self.gpu_time, self.total_time, None
 
-    def _cl_infer_y(self, cur_y, cur_z):
-        """Infer feature images
+    def _cl_get_state(self):
+        """Copy the K features in use of the device-resident state to the host.
+        """
+        if self.k == 0:
+            return np.empty((0, self.d), dtype=np.int32), np.empty((self.N, 0), dtype=np.int32)
+        return self.d_cur_y[:self.k].get(), self.d_cur_z.get()[:,:self.k]
+
+    def _cl_set_state(self, cur_y, cur_z, k = None):
+        """Make Y and Z the device-resident state and compute their Z*Y counts
+        on the device. The device arrays have room for k_max features, of
+        which the first k are in use and the rest are zero, so features can be
+        added and deleted without reallocating them.
+        @param cur_y, cur_z: Host arrays of the features in use, or device
+                             arrays padded to a capacity as made here
+        @param k: The number of features in use in padded device arrays
         """
-        d_cur_y = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = cur_y.astype(np.int32))
-        d_cur_z = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_z.astype(np.int32))
-        d_z_by_y = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
-                             hostbuf = np.dot(cur_z, cur_y).astype(np.int32))
-        d_rand = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
-                           hostbuf=np.random.random(size = cur_y.shape).astype(np.float32))
+        if isinstance(cur_y, np.ndarray):
+            k = cur_z.shape[1]
+            self.k_max = max(self.k_max, k)
+            padded_y = np.zeros((self.k_max, self.d), dtype=np.int32)
+            padded_z = np.zeros((self.N, self.k_max), dtype=np.int32)
+            padded_y[:k], padded_z[:,:k] = cur_y, cur_z
+            cur_y = cl.array.to_device(self.queue, padded_y, allocator=self.mem_pool)
+            cur_z = cl.array.to_device(self.queue, padded_z, allocator=self.mem_pool)
+        self.d_cur_y, self.d_cur_z = cur_y, cur_z
+        self.k, self.k_max = k, cur_z.shape[1]
+        self.d_z_by_y = cl.array.zeros(self.queue, (self.N, self.d), np.int32, allocator=self.mem_pool)
+        self._cl_compute_z_by_y()
+
+    def _cl_reserve(self, k):
+        """Make room for k features on the device, at least doubling the
+        capacity when it runs out so that growing to K features takes
+        O(log K) reallocations.
+        """
+        if k <= self.k_max: return
+        k_max = max(k, 2 * self.k_max)
+        d_new_y = cl.array.zeros(self.queue, (k_max, self.d), np.int32, allocator=self.mem_pool)
+        d_new_z = cl.array.zeros(self.queue, (self.N, k_max), np.int32, allocator=self.mem_pool)
+        if self.k > 0:
+            d_active = cl.array.empty(self.queue, (self.k,), np.int32, allocator=self.mem_pool).fill(1)
+            self._cl_compact(self.d_cur_y, self.d_cur_z, d_new_y, d_new_z, d_active)
+        self.d_cur_y, self.d_cur_z, self.k_max = d_new_y, d_new_z, k_max
+
+    def _cl_compact(self, d_src_y, d_src_z, d_dst_y, d_dst_z, d_active):
+        """Copy the features in use marked in d_active to the front of the
+        destination arrays, which may be the source arrays themselves.
+        """
+        self.prg.compact_features(self.queue, (self.N + self.d,), None,
+                                  d_src_y.data, d_src_z.data, d_dst_y.data, d_dst_z.data, d_active.data,
+                                  np.int32(self.N), np.int32(self.d), np.int32(self.k),
+                                  np.int32(d_src_z.shape[1]), np.int32(d_dst_z.shape[1]))
 
-        wgx = gcd(cur_y.shape[0], self.p_mul_sample_y)
-        wgy = gcd(cur_y.shape[1], self.p_mul_sample_y)
+    def _cl_compute_z_by_y(self):
+        """Compute the Z*Y counts of the device-resident state on the device.
+        """
+        if self.k == 0:
+            self.d_z_by_y.fill(0)
+            return
+        launch = lambda local_size: \
+            self.prg.compute_z_by_y(self.queue, (self.N, self.d), local_size,
+                                    self.d_cur_z.data, self.d_cur_y.data, self.d_z_by_y.data,
+                                    np.int32(self.N), np.int32(self.d), np.int32(self.k), np.int32(self.k_max))
+        launch(self.tuned_local_size('ibp_compute_z_by_y', (self.N, self.d), self.p_mul_compute_z_by_y, launch))
+
+    def _cl_feature_summary(self):
+        """Return the number of owners and the number of pixels that are on of
+        each feature, and whether the feature is active (neither null nor
+        empty), as device arrays over the whole capacity.
+        """
+        d_z_col_sum = cl.array.empty(self.queue, (self.k_max,), np.int32, allocator=self.mem_pool)
+        d_y_row_sum = cl.array.empty(self.queue, (self.k_max,), np.int32, allocator=self.mem_pool)
+        d_active = cl.array.empty(self.queue, (self.k_max,), np.int32, allocator=self.mem_pool)
+        self.prg.feature_summary(self.queue, (self.k_max,), None,
+                                 self.d_cur_y.data, self.d_cur_z.data,
+                                 d_z_col_sum.data, d_y_row_sum.data, d_active.data,
+                                 np.int32(self.N), np.int32(self.d), np.int32(self.k), np.int32(self.k_max))
+        return d_z_col_sum, d_y_row_sum, d_active
+
+    def _cl_count_histogram(self):
+        """Return the (observed value, count) histogram of the device-resident
+        state, computed on the device.
+        """
+        width = self.k + 1
+        d_hist = cl.array.zeros(self.queue, (2, width), np.int32, allocator=self.mem_pool)
+        self.prg.count_histogram(self.queue, (self.N * self.d,), None,
+                                 self.d_obs, self.d_z_by_y.data, d_hist.data, np.int32(width))
+        return d_hist.get()
+
+    def _cl_infer_y(self):
+        """Infer feature images on the device
+        """
+        if self.k == 0: return
+        d_rand = cl.clrandom.rand(self.queue, self.d_cur_y.shape, np.float32)
+        scratch = []
+
+        def launch(local_size, d_cur_y = None):
+            # y is resampled in place, so tuning launches work on a scratch copy
+            if d_cur_y is None:
+                if not scratch: scratch.append(self.d_cur_y.copy())
+                d_cur_y = scratch[0]
+            return self.prg.sample_y(self.queue, self.d_cur_y.shape, local_size,
+                                     d_cur_y.data, self.d_cur_z.data, self.d_z_by_y.data, self.d_obs, d_rand.data, 
+                                     np.int32(self.N), np.int32(self.d), np.int32(self.k), np.int32(self.k_max),
+                                     np.float32(self.lam), np.float32(self.epislon), np.float32(self.theta))
         
-        # calculate the prior probability that a pixel is on
-        self.prg.sample_y(self.queue, cur_y.shape, (wgx, wgy),
-                          d_cur_y, d_cur_z, d_z_by_y, self.d_obs, d_rand, 
-                          np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                          np.float32(self.lam), np.float32(self.epislon), np.float32(self.theta))
+        launch(self.tuned_local_size('ibp_sample_y', self.d_cur_y.shape, self.p_mul_sample_y, launch), self.d_cur_y)
+        self._cl_compute_z_by_y()
 
-        cl.enqueue_copy(self.queue, cur_y, d_cur_y)
-        return cur_y
-
-    def _cl_infer_z(self, cur_y, cur_z):
-        """Infer feature ownership
+    def _cl_infer_z(self):
+        """Infer feature ownership on the device
         """
-        d_cur_y = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_y.astype(np.int32))
-        d_cur_z = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = cur_z.astype(np.int32))
-        d_z_by_y = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
-                             hostbuf = np.dot(cur_z, cur_y).astype(np.int32))
-        d_z_col_sum = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, 
-                                hostbuf = cur_z.sum(axis = 0).astype(np.int32))
-        d_rand = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
-                           hostbuf=np.random.random(size = cur_z.shape).astype(np.float32))
-
-        wgx = gcd(cur_z.shape[0], self.p_mul_sample_z)
-        wgy = gcd(cur_z.shape[1], self.p_mul_sample_z)
+        if self.k == 0: return
+        d_z_col_sum, _, _ = self._cl_feature_summary()
+        d_rand = cl.clrandom.rand(self.queue, self.d_cur_z.shape, np.float32)
+        scratch = []
+
+        def launch(local_size, d_cur_z = None):
+            # z is resampled in place, so tuning launches work on a scratch copy
+            if d_cur_z is None:
+                if not scratch: scratch.append(self.d_cur_z.copy())
+                d_cur_z = scratch[0]
+            return self.prg.sample_z(self.queue, self.d_cur_z.shape, local_size,
+                                     self.d_cur_y.data, d_cur_z.data, self.d_z_by_y.data, d_z_col_sum.data, self.d_obs, d_rand.data, 
+                                     np.int32(self.N), np.int32(self.d), np.int32(self.k), np.int32(self.k_max),
+                                     np.float32(self.lam), np.float32(self.epislon), np.float32(self.theta))
         
-        # calculate the prior probability that a pixel is on
-        self.prg.sample_z(self.queue, cur_z.shape, (wgx, wgy),
-                          d_cur_y, d_cur_z, d_z_by_y, d_z_col_sum, self.d_obs, d_rand, 
-                          np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_z.shape[1]),
-                          np.float32(self.lam), np.float32(self.epislon), np.float32(self.theta))
-
-        cl.enqueue_copy(self.queue, cur_z, d_cur_z)
-        return cur_z
+        launch(self.tuned_local_size('ibp_sample_z', self.d_cur_z.shape, self.p_mul_sample_z, launch), self.d_cur_z)
+        self._cl_compute_z_by_y()
         
-    def _cl_infer_k_new(self, cur_y, cur_z):
-
+    def _cl_infer_k_new(self):
+        """Sample new features and delete empty and null ones on the device.
+        New features are written after the ones in use, then the active ones
+        are compacted to the front in place. Only the number of active
+        features is copied back.
+        """
         # sample new features use importance sampling
-        k_new = self._sample_k_new(cur_y, cur_z)
-        if k_new:
-            cur_y, cur_z = k_new
-
-        # delete empty feature images
-        non_empty_feat_img = np.where(cur_y.sum(axis = 1) > 0)
-        cur_y = cur_y[non_empty_feat_img[0],:].astype(np.int32)
-        cur_z = cur_z[:,non_empty_feat_img[0]].astype(np.int32)
-            
-        # delete null features
-        inactive_feat_col = np.where(cur_z.sum(axis = 0) == 0)
-        cur_z = np.delete(cur_z, inactive_feat_col[0], axis=1).astype(np.int32)
-        cur_y = np.delete(cur_y, inactive_feat_col[0], axis=0).astype(np.int32)
-            
-        z_s0, z_s1 = cur_z.shape
-        cur_z = cur_z.reshape((z_s0 * z_s1, 1))
-        cur_z = cur_z.reshape((z_s0, z_s1))
-
-        y_s0, y_s1 = cur_y.shape
-        cur_y = cur_y.reshape((y_s0 * y_s1, 1))
-        cur_y = cur_y.reshape((y_s0, y_s1))
-
-        # update self.k
-        self.k = cur_z.shape[1]
-        
-        return cur_y, cur_z
+        k_new_count = np.random.poisson(self.alpha / self.N)
+        if k_new_count > 0:
+            self._cl_reserve(self.k + k_new_count)
+            d_rand = cl.clrandom.rand(self.queue, ((self.N + self.d) * k_new_count,), np.float32)
+            self.prg.birth_features(self.queue, (self.N + self.d,), None,
+                                    self.d_cur_y.data, self.d_cur_z.data, d_rand.data,
+                                    np.int32(self.N), np.int32(self.d), np.int32(self.k),
+                                    np.int32(k_new_count), np.int32(self.k_max), np.float32(self.theta))
+            self.k += k_new_count
+            self._cl_compute_z_by_y()
+        if self.k == 0: return
+
+        # delete empty feature images and null features, which leaves Z*Y as it is
+        _, _, d_active = self._cl_feature_summary()
+        num_active = int(cl.array.sum(d_active).get())
+        if num_active < self.k:
+            self._cl_compact(self.d_cur_y, self.d_cur_z, self.d_cur_y, self.d_cur_z, d_active)
+            self.k = num_active
 
     def _logprob(self, sample):
         """Calculate the joint log probability of data and model given a sample.
@@ -444,39 +581,13 @@ class Gibbs(BaseSampler):
         if cur_z.shape[1] == 0: return -99999999.9
     
         if self.cl_mode:
-            a_time = time()
-            d_cur_z = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_z.astype(np.int32))
-            d_cur_y = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_y.astype(np.int32))
-            d_logprob = cl.array.empty(self.queue, (cur_z.shape[0],), np.float32, allocator=self.mem_pool)
-
-            if cur_z.shape[0] % self.p_mul_logprob_z_data == 0: wg = (self.p_mul_logprob_z_data,)
-            else: wg = None
-            
-            self.prg.logprob_z_data(self.queue, (cur_z.shape[0],), wg,
-                                    d_cur_z, d_cur_y, self.d_obs, d_logprob.data, #d_novel_f.data,
-                                    np.int32(self.N), np.int32(cur_y.shape[1]), np.int32(cur_z.shape[1]), 
-                                    np.float32(self.alpha), np.float32(self.lam), np.float32(self.epislon))
-            log_lik = d_logprob.get().sum()
-            self.gpu_time += time() - a_time
-
-            # calculate the prior probability of Y
-            num_on = (cur_y == 1).sum()
-            num_off = (cur_y == 0).sum()
-            log_prior = num_on * np.log(self.theta) + num_off * np.log(1 - self.theta)
+            return self._cl_logprob(cl.array.to_device(self.queue, cur_y.astype(np.int32), allocator=self.mem_pool),
+                                    cl.array.to_device(self.queue, cur_z.astype(np.int32), allocator=self.mem_pool),
+                                    cur_z.shape[1])
 
         else:
             # calculate the prior probability of Z
-            for n in xrange(cur_z.shape[0]):
-                num_novel = 0
-                for k in xrange(cur_z.shape[1]):
-                    m = cur_z[:n,k].sum()
-                    if m > 0:
-                        if cur_z[n,k] == 1: log_prior += np.log(m / (n+1.0))
-                        else: log_prior += np.log(1 - m / (n + 1.0))
-                    else: 
-                        if cur_z[n,k] == 1: num_novel += 1
-                if num_novel > 0:
-                    log_prior += poisson.logpmf(num_novel, self.alpha / (n+1.0))
+            log_prior += ibp_logprior_z(cur_z, self.alpha)
             # calculate the prior probability of Y
             num_on = (cur_y == 1).sum()
             num_off = (cur_y == 0).sum()
@@ -484,6 +595,31 @@ class Gibbs(BaseSampler):
             # calculate the logliklihood
             log_lik = self._loglik(cur_y = cur_y, cur_z = cur_z)
         return log_prior + log_lik
+
+    def _cl_logprob(self, d_cur_y, d_cur_z, k):
+        """Calculate the joint log probability of data and model given Y and Z
+        on the device, of which the first k features are in use. Only the
+        per-object log probabilities and the number of pixels that are on in Y
+        are copied back.
+        """
+        if k == 0: return -99999999.9
+        a_time = self.device_clock()
+        d_logprob = cl.array.empty(self.queue, (self.N,), np.float32, allocator=self.mem_pool)
+
+        launch = lambda local_size: \
+            self.prg.logprob_z_data(self.queue, (self.N,), local_size,
+                                    d_cur_z.data, d_cur_y.data, self.d_obs, d_logprob.data, #d_novel_f.data,
+                                    np.int32(self.N), np.int32(self.d), np.int32(k), np.int32(d_cur_z.shape[1]),
+                                    np.float32(self.alpha), np.float32(self.lam), np.float32(self.epislon))
+        launch(self.tuned_local_size('ibp_logprob_z_data', (self.N,), self.p_mul_logprob_z_data, launch))
+        log_lik = d_logprob.get().sum()
+        num_on = cl.array.sum(d_cur_y).get()
+        self.gpu_time += self.device_clock() - a_time
+
+        # calculate the prior probability of Y
+        num_off = k * self.d - num_on
+        log_prior = num_on * np.log(self.theta) + num_off * np.log(1 - self.theta)
+        return log_prior + log_lik
             
     
 class GibbsPredictor(BasePredictor):
@@ -497,6 +633,7 @@ class GibbsPredictor(BasePredictor):
         self.lam = lam
         self.theta = theta
         self.epislon = epislon
+        self.noisyor = NoisyOrLikelihood()
 
     def read_test_csv(self, file_path, header=True):
         """Read the test cases and convert values to integer.
@@ -517,69 +654,25 @@ class GibbsPredictor(BasePredictor):
                 new_samples.append(sample)
         self.samples[var_name] = new_samples
 
+    def score(self, thining = 0, burnin = 0, use_iter = None, obs = None):
+        """Compute the log score of each test case under each selected sample:
+        the log of the sum of its likelihood over all ownership patterns of
+        the sample's features. Samples are scored by num_workers processes.
+        """
+        if obs is None: obs = self.obs
+        samples_y = self.select_samples('y', thining, burnin, use_iter)
+        params = self.select_params(['lam', 'epislon'], len(samples_y), thining, burnin, use_iter)
+        return np.array(self.map_samples(score_sample, [(y,) + p for y, p in zip(samples_y, params)],
+                                         (self.noisyor, obs))).reshape((-1, len(obs)))
+
     def predict(self, thining = 0, burnin = 0, use_iter=None, output_file = None):
-        """Predict the test cases
+        """Predict the test cases: the largest log score of each test case over
+        the selected samples, and the standard deviation of its log scores.
         """
         assert('y' in self.samples and 'z' in self.samples)
         assert(len(self.samples['y']) == len(self.samples['z']))
         
-        num_sample = len(self.samples['y'])
-        num_obs = len(self.obs)
-        logprob_result = np.empty((num_sample, num_obs))
-
-        for i in xrange(num_sample):
-            cur_y = self.samples['y'][i]
-            cur_z = self.samples['z'][i]
-            
-            # generate all possible Zs
-            num_feature = cur_z.shape[1]
-            all_z = []
-            for n in xrange(num_feature+1):
-                base = [1] * n + [0] * (num_feature - n)
-                all_z.extend(list(set(itertools.permutations(base))))
-            all_z = np.array(all_z, dtype=np.int32)
-            
-            # BEGIN p(z|z_inferred) calculation
-
-            # the following lines of code may be a bit tricky to parse
-            # first, calculate the probability of features that already exist
-            # since features are additive within an image, we can just prod them
-            prior_off_prob = 1.0 - cur_z.sum(axis = 0) / float(cur_z.shape[0])
-            prior_prob = np.abs(all_z - prior_off_prob)
-
-            # then, locate the novel features in all_z
-            mask = np.ones(all_z.shape)
-            mask[:,np.where(cur_z.sum(axis = 0) > 0)] = 0
-            novel_all_z = all_z * mask
-            
-            # temporarily mark those cells to have probability 1
-            prior_prob[novel_all_z==1] = 1
-
-            # we can safely do row product now, still ignoring new features
-            prior_prob = prior_prob.prod(axis = 1)
-
-            # let's count the number of new features for each row
-            num_novel = novel_all_z.sum(axis = 1)
-            # calculate the probability
-            novel_prob = poisson.pmf(num_novel, self.alpha / float(cur_z.shape[0]))
-            # ignore the novel == 0 special case
-            novel_prob[num_novel==0] = 1.
-
-            # multiply it by prior prob
-            prior_prob = prior_prob * novel_prob
-            
-            # END p(z|z_inferred) calculation
-
-            # BEGIN p(x|z, y_inferred)
-            n_by_d = np.dot(all_z, cur_y)
-            not_on_p = np.power(1. - self.lam, n_by_d) * (1. - self.epislon)
-            for j in xrange(len(self.obs)):
-                prob = np.abs(self.obs[j] - not_on_p).prod(axis=1) 
-                prob = prob #* prior_prob
-                prob = prob.sum()
-                logprob_result[i,j] = prob
-            # END
-                
+        logprob_result = self.score(thining, burnin, use_iter)
         return logprob_result.max(axis=0), logprob_result.std(axis=0)
         
         
@@ -9,23 +9,29 @@ sys.path.append(pkg_dir)
 import cPickle, itertools
 import pyopencl.array
 from scipy.stats import poisson
+from scipy.special import logsumexp
 from MPBNP import *
 
 np.set_printoptions(suppress=True)
 
-class BiasedGibbs(BaseSampler):
+class BiasedGibbs(BaseSampler, NoisyOrSampler):
 
     def __init__(self, cl_mode = True, cl_device = None,
                  alpha = 1.0, lam = 0.95, theta = 0.25, epislon = 0.05, init_k = 2):
         """Initialize the class.
         """
-        BaseSampler.__init__(self, cl_mode, cl_device)
+        BaseSampler.__init__(self, record_best = False, cl_mode = cl_mode, cl_device = cl_device)
 
         if cl_mode:
-            program_str = open(pkg_dir + './kernels/ibp_noisyor_cl.c', 'r').read()
-            #utilities_str = open('kernels/utilities_cl.c', 'r').read()
+            program_str = open(pkg_dir + 'MPBNP/ibp/kernels/ibp_noisyortwoy_cl.c', 'r').read()
             self.prg = cl.Program(self.ctx, program_str).build()
-            #self.util = cl.Program(self.ctx, utilities_str).build()
+
+            self.p_mul_sample_y = cl.Kernel(self.prg, 'sample_y').\
+                        get_work_group_info(cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, self.device)
+            self.p_mul_sample_f = cl.Kernel(self.prg, 'sample_f').\
+                        get_work_group_info(cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, self.device)
+            self.p_mul_compute_counts = cl.Kernel(self.prg, 'compute_counts').\
+                        get_work_group_info(cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, self.device)
 
         self.alpha = alpha # tendency to generate new features
         self.k = init_k    # initial number of features
@@ -33,18 +39,19 @@ class BiasedGibbs(BaseSampler):
         self.lam = lam # effecacy of a feature
         self.epislon = epislon # probability that a pixel is on by change in an actual image
         self.samples = {'z': [], 'f': [], 'y': []}
+        self.noisyor = NoisyOrLikelihood()
+        self.sample_lam_epislon = False # resample lambda and epislon every iteration
+        self.sampled_params = ['lam', 'epislon'] # kept with the samples and the best sample
+        self.k_max = 32 # capacity of the feature arrays on the device; doubles as needed
 
     def read_csv(self, filepath, header=True):
         """Read the data from a csv file.
         """
-        BaseSampler.read_csv(self, filepath, header)
-        # convert the data to floats
-        self.new_obs = []
-        for row in self.obs:
-            self.new_obs.append([int(_) for _ in row])
-        self.obs = np.array(self.new_obs)
-        self.d = len(self.obs[0])
-        self.n = len(self.obs)
+        self.obs, self.img_w = read_images(filepath, header)
+        self.N = self.n = len(self.obs)
+        self.d = self.obs.shape[1]
+        if self.cl_mode:
+            self.d_obs = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf=self.obs.astype(np.int32))
         return
 
     def direct_read_obs(self, obs):
@@ -65,7 +72,7 @@ class BiasedGibbs(BaseSampler):
             init_y = np.random.randint(0, 2, (2, self.k, self.d))
         else:
             assert(type(init_y) is np.ndarray)
-            assert(init_y.shape == (self.k, self.d))
+            assert(init_y.shape == (2, self.k, self.d))
         if init_f is None:
             init_f = np.random.randint(0, 3, (self.n, self.k))
         else:
@@ -97,19 +104,24 @@ class BiasedGibbs(BaseSampler):
         @param init_z: Passed in from do_inference()
         @param init_f: Passed in from do_inference()
         """
-        cur_y, cur_z, cur_f = init_y, init_z, init_f
+        state = FeatureState([('y', init_y, 1), ('z', init_z, 1), ('f', init_f, 1)])
 
         a_time = time()
         for i in xrange(self.niter):
-            cur_y, cur_z, cur_f = self._infer_f(cur_y, cur_z, cur_f)
-            cur_y = self._infer_y(cur_y, cur_z, cur_f)
-            cur_y, cur_z, cur_f = self._infer_z(cur_y, cur_z, cur_f)
+            self._infer_f(state)
+            state['y'][:] = self._infer_y(state['y'], state['z'], state['f'])
+            self._infer_z(state)
+            if self.sample_lam_epislon:
+                hist = self._count_histogram(state['y'], state['z'], state['f'])
+                self._sample_lam(hist)
+                self._sample_epislon(hist)
 
-            #self._sample_lam(cur_y, cur_z)
             if i >= self.burnin: 
+                cur_y, cur_z, cur_f = state.copy('y', 'z', 'f')
                 self.samples['z'].append(cur_z)
                 self.samples['f'].append(cur_f)
                 self.samples['y'].append(cur_y)
+                self.record_params()
                 
         if output_file is not None:
             cPickle.dump(self.samples, open(output_file, 'w'))       
@@ -117,29 +129,29 @@ class BiasedGibbs(BaseSampler):
         return -1, time() - a_time, None
 
     def _infer_y(self, cur_y, cur_z, cur_f):
-        """Infer feature image matrices Y
+        """Infer feature image matrices Y. Every pixel of every image is
+        resampled given the others as they were at the start of the step,
+        from the loglikelihoods of the data points that use the image for the
+        feature with the pixel turned on and off; both come from their counts
+        without the pixel, for all pixels of a feature image at once.
         """
         cur_zf = cur_z * cur_f
+        counts = self._n_by_d(cur_y, cur_z, cur_f)
         # calculate the prior probability that a pixel is on
         y_on_log_prob = np.log(self.theta) * np.ones(cur_y.shape)
         y_off_log_prob = np.log(1. - self.theta) * np.ones(cur_y.shape)
 
         # calculate the likelihood
-        on_loglik = np.empty(cur_y.shape)
-        off_loglik = np.empty(cur_y.shape)
-    
+        on_loglik = np.zeros(cur_y.shape)
+        off_loglik = np.zeros(cur_y.shape)
         for y_idx in xrange(cur_y.shape[0]):
             for row in xrange(cur_y[y_idx].shape[0]):
-                affected_data_index = np.where(cur_zf[:,row] == y_idx+1)
-                for col in xrange(cur_y[y_idx].shape[1]):
-                    old_value = cur_y[y_idx, row, col]
-                    cur_y[y_idx, row, col] = 1
-                    on_loglik[y_idx, row, col] = self._loglik_nth(cur_y, cur_z, cur_f,
-                                                                  n = affected_data_index)
-                    cur_y[y_idx, row, col] = 0
-                    off_loglik[y_idx, row, col] = self._loglik_nth(cur_y, cur_z, cur_f,
-                                                                   n = affected_data_index)
-                    cur_y[y_idx, row, col] = old_value
+                affected_data_index = np.where(cur_zf[:,row] == y_idx+1)[0]
+                if affected_data_index.shape[0] == 0: continue
+                obs = self.obs[affected_data_index]
+                other_counts = counts[affected_data_index] - cur_y[y_idx, row]
+                on_loglik[y_idx, row] = self.noisyor.loglik(obs, other_counts + 1, self.lam, self.epislon).sum(axis = 0)
+                off_loglik[y_idx, row] = self.noisyor.loglik(obs, other_counts, self.lam, self.epislon).sum(axis = 0)
 
         # add to the prior
         y_on_log_prob += on_loglik
@@ -155,56 +167,79 @@ class BiasedGibbs(BaseSampler):
 
         return cur_y
 
-    def _infer_f(self, cur_y, cur_z, cur_f, f_prior=None):
-        """Infer feature ownership matrix Z.
+    def _infer_f(self, state, f_prior=None):
+        """Infer feature ownership matrix Z, updating the FeatureState of Y, Z
+        and F in place.
+
+        The counts of active features that have each pixel on are kept for
+        all rows through the sweep and updated by the difference of the two
+        feature images whenever a cell of F changes, so the three choices of
+        a cell are scored with one table lookup over the pixels of its row.
+        The number of owners of each feature and the numbers of cells of F
+        that pick either image are kept the same way, so the priors of a cell
+        come from counters rather than sums over F. New features are proposed
+        for each row right after its cells are resampled, so later rows of
+        the same sweep may take them; on the device, they are proposed for
+        all rows after the whole sweep instead (see _cl_infer_k_new()).
+        @param f_prior: Fixed probabilities of picking either image; by default
+                        they follow the other cells of F
         """
-        # add loglikelihood of data
+        counts = self._n_by_d(state['y'], state['z'], state['f'])
+        z_col_sum = state['z'].sum(axis = 0)
+        f_counts = np.array([(state['f'] == 1).sum(), (state['f'] == 2).sum()], dtype=np.float64)
         for row in xrange(self.n):
-            z_col_sum = cur_z.sum(axis = 0)
-
-            # calculate the IBP prior on feature ownership for existing features
-            m_minus = z_col_sum - cur_z
-            active_prob = m_minus / float(self.n)
-            inactive_prob = 1 - m_minus / float(self.n)
-            
-            #print(cur_y, cur_z, cur_f, sep='\n-----\n')
+            # features born at earlier rows are appended to the state
+            cur_y, cur_z, cur_f = state['y'], state['z'], state['f']
 
             for col in xrange(cur_f.shape[1]):
-                #print('row:', row, 'col:', col)
+                # take the cell out of the counts
+                old_f = cur_f[row, col]
+                if old_f > 0:
+                    counts[row] -= cur_y[old_f - 1, col]
+                    z_col_sum[col] -= 1
+                    f_counts[old_f - 1] -= 1
+
+                # calculate the IBP prior on feature ownership, and the prior
+                # on picking either image
+                active_prob = z_col_sum[col] / float(self.n)
                 if f_prior is None:
-                    f_prior = [((cur_f == 1).sum() - int(cur_f[row,col] == 1) + .0001) / ((cur_f > 0).sum() - int(cur_f[row,col] > 0) + .0002),
-                               ((cur_f == 2).sum() - int(cur_f[row,col] == 2) + .0001) / ((cur_f > 0).sum() - int(cur_f[row,col] > 0) + .0002)]
-
-                prob_grid = np.array([inactive_prob[row, col], 
-                                      active_prob[row, col] * f_prior[0], 
-                                      active_prob[row, col] * f_prior[1]]) # a uniform prior on choosing either 1 or 2 in F
-
-                #print('priors:', prob_grid)
-                lik_grid = np.empty(3)
-                for i in xrange(3):
-                    cur_f[row, col] = i
-                    cur_z[row, col] = int(i > 0)
-                    lik_grid[i] = np.exp(self._loglik_nth(cur_y, cur_z, cur_f, n = row))
-                    prob_grid[i] = prob_grid[i] * lik_grid[i]
-                    #print(i, np.exp(self._loglik_nth(cur_y, cur_z, cur_f, n = row)), file=sys.stderr)
-
+                    cell_f_prior = (f_counts + .0001) / (f_counts.sum() + .0002)
+                else:
+                    cell_f_prior = f_prior
+                prob_grid = np.array([1 - active_prob,
+                                      active_prob * cell_f_prior[0],
+                                      active_prob * cell_f_prior[1]])
+
+                # the counts of the row with the feature off, and with it on
+                # using either of its images
+                grid_counts = np.vstack((counts[row], counts[row] + cur_y[0, col], counts[row] + cur_y[1, col]))
+                loglik_grid = self.noisyor.loglik(self.obs[row], grid_counts, self.lam, self.epislon).sum(axis = 1)
+                with np.errstate(divide = 'ignore'):
+                    loglik_grid += np.log(prob_grid)
 
                 # normalize the probability
+                prob_grid = np.exp(loglik_grid - loglik_grid.max())
                 prob_grid = prob_grid / prob_grid.sum()
-                #print('likelihoods:', lik_grid)
-                #print('posteriors:', prob_grid)
-                #raw_input()
-                cur_f[row, col] = np.random.choice(a = 3, p = prob_grid)
+                new_f = np.random.choice(a = 3, p = prob_grid)
+                cur_f[row, col] = new_f
                 # set z accordingly
-                cur_z[row, col] = int(cur_f[row, col] > 0)
-
-            # sample new features
-            cur_y, cur_z, cur_f = self._sample_k_new(cur_y, cur_z, cur_f, row)
-
-            #raw_input()
-        return cur_y, cur_z, cur_f
-
-    def _infer_z(self, cur_y, cur_z, cur_f):
+                cur_z[row, col] = int(new_f > 0)
+                counts[row] = grid_counts[new_f]
+                if new_f > 0:
+                    z_col_sum[col] += 1
+                    f_counts[new_f - 1] += 1
+
+            # sample new features, which only this row owns
+            k_new = self._sample_k_new(self.obs[row], counts[row], f_counts)
+            if k_new:
+                new_y, new_f, counts[row] = k_new
+                new = state.append(new_f.shape[0], y = new_y)
+                state['f'][row, new] = new_f
+                state['z'][row, new] = 1
+                z_col_sum = np.hstack((z_col_sum, np.ones(new_f.shape[0], dtype=z_col_sum.dtype)))
+                f_counts += [(new_f == 1).sum(), (new_f == 2).sum()]
+
+    def _infer_z(self, state):
         """Sample new features use MH.
 
         Note: In this particular model, performing inference on existing features
@@ -214,44 +249,38 @@ class BiasedGibbs(BaseSampler):
         Therefore, _infer_z() is devoted to the sampling of new features.
         """
         # delete null features
-        inactive_feat_col = np.where(cur_z.sum(axis = 0) == 0)
-        cur_z = np.delete(cur_z, inactive_feat_col[0], axis=1)
-        cur_f = np.delete(cur_f, inactive_feat_col[0], axis=1)
-        cur_y = np.array([np.delete(cur_y[0], inactive_feat_col[0], axis=0),
-                          np.delete(cur_y[1], inactive_feat_col[0], axis=0)])
+        state.remove(state['z'].sum(axis = 0) == 0)
 
         # update self.k
-        self.k = cur_z.shape[1]
-        
-        return cur_y, cur_z, cur_f
-
-    def _sample_k_new(self, cur_y, cur_z, cur_f, n):
-        """Sample new features for the nth row of F (and Z)
+        self.k = state.k
+
+    def _sample_k_new(self, obs, old_counts, f_counts, k_new_count = None):
+        """Propose new features for one row of F (and Z). The new features
+        are owned by that row only, so the proposal is evaluated on that row
+        alone.
+        @param obs: The data point of the row
+        @param old_counts: Its counts from _n_by_d()
+        @param f_counts: The numbers of cells of F that pick either image
+        @param k_new_count: The number of new features; drawn from the prior by default
+        @return: The (2, k_new, D) images, the row's entries of F and its new
+                 counts of the accepted features, or None
         """
-        k_new_count = np.random.poisson(self.alpha / self.n)
-        if k_new_count == 0: return cur_y, cur_z, cur_f
+        if k_new_count is None: k_new_count = np.random.poisson(self.alpha / self.n)
+        if k_new_count == 0: return
 
         # calculate the old logliklihood
-        old_loglik = self._loglik_nth(cur_y, cur_z, cur_f, n)
+        old_loglik = self.noisyor.loglik(obs, old_counts, self.lam, self.epislon).sum()
             
-        f_prior = [((cur_f == 1).sum() + .01) / ((cur_f > 0).sum() + .02),
-                   ((cur_f == 2).sum() + .01) / ((cur_f > 0).sum() + .02)]
-
-        # create the new F vector
-        new_f = np.zeros((self.n, k_new_count), dtype = np.int32)
-        new_f[n, :k_new_count] = np.random.choice(a = [1, 2], p = f_prior, size = k_new_count)
-        cur_f_new = np.hstack((cur_f, new_f))
-        # create the new Z vector
-        cur_z_new = np.empty(cur_f_new.shape, dtype=np.int32)
-        cur_z_new[np.where(cur_f_new > 0)] = 1
-        cur_z_new[np.where(cur_f_new == 0)] = 0
+        f_prior = (np.asarray(f_counts, dtype=np.float64) + .01) / (np.sum(f_counts) + .02)
+
+        # create the new entries of the row of F
+        new_f = np.random.choice(a = [1, 2], p = f_prior, size = k_new_count)
         # propose feature images by sampling from the prior distribution
-        cur_y_new = np.array([
-                np.vstack((cur_y[0], np.random.binomial(1, self.theta, (k_new_count, self.d)))),
-                np.vstack((cur_y[1], np.random.binomial(1, self.theta, (k_new_count, self.d))))
-                ])
+        new_y = np.array([np.random.binomial(1, self.theta, (k_new_count, self.d)),
+                          np.random.binomial(1, self.theta, (k_new_count, self.d))])
     
-        new_loglik = self._loglik_nth(cur_y_new, cur_z_new, cur_f_new, n)
+        new_counts = old_counts + new_y[new_f - 1, np.arange(k_new_count)].sum(axis = 0)
+        new_loglik = self.noisyor.loglik(obs, new_counts, self.lam, self.epislon).sum()
 
         # normalization
         max_loglik = max(new_loglik, old_loglik)
@@ -260,179 +289,283 @@ class BiasedGibbs(BaseSampler):
         # sampling
         move_prob = 1 / (1 + np.exp(old_loglik - new_loglik))
         if random.random() < move_prob:
-            cur_y = cur_y_new
-            cur_z = cur_z_new
-            cur_f = cur_f_new
-
-        return cur_y, cur_z, cur_f
+            return new_y, new_f, new_counts
         
-    def _sample_lam(self, cur_y, cur_z):
-        """Resample the value of lambda.
-        """
-        old_loglik = self._loglik(cur_y, cur_z)
-        old_lam = self.lam
-    
-        # modify the feature ownership matrix
-        self.lam = np.random.beta(1,1)
-        new_loglik = self._loglik(cur_y, cur_z)
-        move_prob = 1 / (1 + np.exp(old_loglik - new_loglik));
-        if random.random() < move_prob:
-            pass
-        else:
-            self.lam = old_lam
-
-    def _sample_epislon(self, cur_y, cur_z):
-        """Resample the value of epislon
-        """
-        old_loglik = self._loglik(cur_y, cur_z)
-        old_epislon = self.epislon
-    
-        # modify the feature ownership matrix
-        self.epislon = np.random.beta(1,1)
-        new_loglik = self._loglik(cur_y, cur_z)
-        move_prob = 1 / (1 + np.exp(old_loglik - new_loglik));
-        if random.random() < move_prob:
-            pass
-        else:
-            self.epislon = old_epislon
-
     def _loglik_nth(self, cur_y, cur_z, cur_f, n):
         """Calculate the loglikelihood of the nth data point
         given Y and Z.
         """
         assert(cur_y.shape[0] == 2 and cur_z.shape[1] == cur_y.shape[1])
 
-        loglik = 0
-
         if type(n) is int: n = ([n],)
-
-        for each_n in n[0]:
-            y_comb = np.zeros(cur_y[0].shape, dtype=np.int32)
-            y_comb[np.where(cur_f[each_n] == 1)] = cur_y[0][np.where(cur_f[each_n] == 1)]
-            y_comb[np.where(cur_f[each_n] == 2)] = cur_y[1][np.where(cur_f[each_n] == 2)]
-            
-            not_on_p = np.power(1. - self.lam, np.dot(cur_z[each_n], y_comb)) * (1. - self.epislon)
-
-            loglik += np.log(np.abs(self.obs[each_n] - not_on_p)).sum()
-
-        return loglik
+        rows = n[0]
+        counts = self._n_by_d(cur_y, cur_z[rows], cur_f[rows])
+        return self.noisyor.loglik(self.obs[rows], counts, self.lam, self.epislon).sum()
+
+    def _n_by_d(self, cur_y, cur_z, cur_f):
+        """Return the number of active features that have each pixel of each
+        data point on, where F picks the feature image of every pixel: the
+        product of the ownership of features through their first image with
+        Y1, plus that through their second image with Y2.
+        """
+        owned = cur_z > 0
+        return (np.dot((owned & (cur_f == 1)).astype(np.int32), cur_y[0]) +
+                np.dot((owned & (cur_f == 2)).astype(np.int32), cur_y[1])).astype(np.int32)
+
+    def _count_histogram(self, cur_y, cur_z, cur_f):
+        """Return the (observed value, count) histogram of the data given Y, Z
+        and F, which is all that the loglikelihood needs for resampling lambda
+        and epislon.
+        """
+        return self.noisyor.count_histogram(self.obs, self._n_by_d(cur_y, cur_z, cur_f))
 
     def _loglik(self, cur_y, cur_z, cur_f):
         """Calculate the loglikelihood of data given Y and Z.
         """
         assert(cur_y.shape[0] == 2 and cur_z.shape[1] == cur_y.shape[1])
 
-        n_by_d = np.empty((cur_z.shape[0], cur_y.shape[2]), dtype=np.int32)
-        for row in xrange(cur_z.shape[0]):
-            y_comb = np.zeros(cur_y[0].shape, dtype=np.int32)
-            y_comb[np.where(cur_f[row] == 1)] = cur_y[0][np.where(cur_f[row] == 1)]
-            y_comb[np.where(cur_f[row] == 2)] = cur_y[1][np.where(cur_f[row] == 2)]
-            n_by_d[row] = np.dot(cur_z[row], y_comb)
-
-        not_on_p = np.power(1. - self.lam, n_by_d) * (1. - self.epislon)
-        loglik_mat = np.log(np.abs(self.obs - not_on_p))
+        loglik_mat = self.noisyor.loglik(self.obs, self._n_by_d(cur_y, cur_z, cur_f), self.lam, self.epislon)
 
         return loglik_mat.sum()
 
-    def _cl_infer_yz(self, init_y, init_z, output_y_file = None, output_z_file = None):
-        """Wrapper function to start the inference on y and z.
+    def _cl_infer_yzf(self, init_y, init_z, init_f, output_file):
+        """Wrapper function to start the inference on y, z and f on the device.
         This function is not supposed to directly invoked by an end user.
+        Y, F and their counts stay on the device between iterations. Only
+        the counts of the rows that new features are proposed for and the
+        samples that are kept are copied back.
         @param init_y: Passed in from do_inference()
         @param init_z: Passed in from do_inference()
+        @param init_f: Passed in from do_inference()
         """
-        cur_y = init_y.astype(np.int32)
-        cur_z = init_z.astype(np.int32)
-        d_obs = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf=self.obs.astype(np.int32))
+        self._cl_set_state(init_y, init_f * (init_z > 0))
 
-        gpu_time = 0
-        total_time = 0
+        a_time = time()
         for i in xrange(self.niter):
-            a_time = time()
-            cur_y = self._cl_infer_y(cur_y, cur_z, d_obs)
-            cur_z = self._cl_infer_z(cur_y, cur_z, d_obs)
-            gpu_time += time() - a_time
-            cur_y, cur_z = self._cl_infer_k_new(cur_y, cur_z)
-            if output_y_file is not None and i >= self.burnin: 
-                print_matrix_in_row(cur_y, output_y_file)
-            if output_z_file is not None and i >= self.burnin: 
-                print_matrix_in_row(cur_z, output_z_file)
-            total_time += time() - a_time
-
-        return gpu_time, total_time, None
-
-    def _cl_infer_y(self, cur_y, cur_z, d_obs):
-        """Infer feature images
-        """
-        d_cur_y = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = cur_y.astype(np.int32))
-        d_cur_z = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = cur_z.astype(np.int32))
-        d_z_by_y = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
-                             hostbuf = np.dot(cur_z, cur_y).astype(np.int32))
-        d_rand = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
-                           hostbuf=np.random.random(size = cur_y.shape).astype(np.float32))
-
-        # calculate the prior probability that a pixel is on
-        self.prg.sample_y(self.queue, cur_y.shape, None,
-                          d_cur_y, d_cur_z, d_z_by_y, d_obs,
-                          d_rand, #d_y_on_loglik.data, d_y_off_loglik.data,
-                          np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                          np.float32(self.lam), np.float32(self.epislon), np.float32(self.theta))
-
-        cl.enqueue_copy(self.queue, cur_y, d_cur_y)
-        return cur_y
+            b_time = self.device_clock()
+            self._cl_infer_f()
+            self._cl_infer_k_new()
+            self._cl_infer_y()
+            self._cl_infer_z()
+            self.gpu_time += self.device_clock() - b_time
+            if self.sample_lam_epislon:
+                hist = self._cl_count_histogram()
+                self._sample_lam(hist)
+                self._sample_epislon(hist)
 
-    def _cl_infer_z(self, cur_y, cur_z, d_obs):
-        """Infer feature ownership
-        """
-        d_cur_y = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = cur_y.astype(np.int32))
-        d_cur_z = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = cur_z.astype(np.int32))
-        d_z_by_y = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
-                             hostbuf = np.dot(cur_z, cur_y).astype(np.int32))
-        d_z_col_sum = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, 
-                                hostbuf = cur_z.sum(axis = 0).astype(np.int32))
-        d_rand = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
-                           hostbuf=np.random.random(size = cur_z.shape).astype(np.float32))
-
-        # calculate the prior probability that a pixel is on
-        self.prg.sample_z(self.queue, cur_z.shape, None,
-                          d_cur_y, d_cur_z, d_z_by_y, d_z_col_sum, d_obs,
-                          d_rand, #d_z_on_loglik.data, d_z_off_loglik.data,
-                          np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_z.shape[1]),
-                          np.float32(self.lam), np.float32(self.epislon), np.float32(self.theta))
-
-        cl.enqueue_copy(self.queue, cur_z, d_cur_z)
-        return cur_z
-        
-    def _cl_infer_k_new(self, cur_y, cur_z):
-
-        # sample new features use importance sampling
-        k_new = self._sample_k_new(cur_y, cur_z)
-        if k_new:
-            cur_y, cur_z = k_new
+            if i >= self.burnin: 
+                cur_y, cur_z, cur_f = self._cl_get_state()
+                self.samples['z'].append(cur_z)
+                self.samples['f'].append(cur_f)
+                self.samples['y'].append(cur_y)
+                self.record_params()
 
-        # delete null features
-        inactive_feat_col = np.where(cur_z.sum(axis = 0) == 0)
-        cur_z_new = np.delete(cur_z, inactive_feat_col[0], axis=1).astype(np.int32)
-        cur_y_new = np.delete(cur_y, inactive_feat_col[0], axis=0).astype(np.int32)
+        if output_file is not None:
+            cPickle.dump(self.samples, open(output_file, 'w'))       
 
-        z_new_s0, z_new_s1 = cur_z_new.shape
-        cur_z_new = cur_z_new.reshape((z_new_s0 * z_new_s1, 1))
-        cur_z_new = cur_z_new.reshape((z_new_s0, z_new_s1))
+        self.total_time += time() - a_time
+        return self.gpu_time, self.total_time, None
 
-        y_new_s0, y_new_s1 = cur_y_new.shape
-        cur_y_new = cur_y_new.reshape((y_new_s0 * y_new_s1, 1))
-        cur_y_new = cur_y_new.reshape((y_new_s0, y_new_s1))
+    def _cl_get_state(self):
+        """Copy the K features in use of the device-resident state to the host.
+        """
+        if self.k == 0:
+            return (np.empty((2, 0, self.d), dtype=np.int32), np.empty((self.n, 0), dtype=np.int32),
+                    np.empty((self.n, 0), dtype=np.int32))
+        cur_f = self.d_cur_f.get()[:,:self.k]
+        return self.d_cur_y.get()[:,:self.k], (cur_f > 0).astype(np.int32), cur_f
+
+    def _cl_set_state(self, cur_y, cur_f):
+        """Make Y and F the device-resident state and compute their counts on
+        the device. The device arrays have room for k_max features, of which
+        the first K are in use and the rest are zero, so features can be added
+        and deleted without reallocating them.
+        """
+        k = cur_f.shape[1]
+        self.k_max = max(self.k_max, k)
+        padded_y = np.zeros((2, self.k_max, self.d), dtype=np.int32)
+        padded_f = np.zeros((self.n, self.k_max), dtype=np.int32)
+        padded_y[:,:k], padded_f[:,:k] = cur_y, cur_f
+        self.d_cur_y = cl.array.to_device(self.queue, padded_y, allocator=self.mem_pool)
+        self.d_cur_f = cl.array.to_device(self.queue, padded_f, allocator=self.mem_pool)
+        self.k = k
+        self.d_counts = cl.array.zeros(self.queue, (self.n, self.d), np.int32, allocator=self.mem_pool)
+        self._cl_compute_counts()
+
+    def _cl_reserve(self, k):
+        """Make room for k features on the device, at least doubling the
+        capacity when it runs out.
+        """
+        if k <= self.k_max: return
+        k_max = max(k, 2 * self.k_max)
+        d_new_y = cl.array.zeros(self.queue, (2, k_max, self.d), np.int32, allocator=self.mem_pool)
+        d_new_f = cl.array.zeros(self.queue, (self.n, k_max), np.int32, allocator=self.mem_pool)
+        if self.k > 0:
+            d_active = cl.array.empty(self.queue, (self.k,), np.int32, allocator=self.mem_pool).fill(1)
+            self._cl_compact(self.d_cur_y, self.d_cur_f, d_new_y, d_new_f, d_active)
+        self.d_cur_y, self.d_cur_f, self.k_max = d_new_y, d_new_f, k_max
+
+    def _cl_compact(self, d_src_y, d_src_f, d_dst_y, d_dst_f, d_active):
+        """Copy the features in use marked in d_active to the front of the
+        destination arrays, which may be the source arrays themselves.
+        """
+        self.prg.compact_features(self.queue, (self.n + self.d,), None,
+                                  d_src_y.data, d_src_f.data, d_dst_y.data, d_dst_f.data, d_active.data,
+                                  np.int32(self.n), np.int32(self.d), np.int32(self.k),
+                                  np.int32(d_src_f.shape[1]), np.int32(d_dst_f.shape[1]))
 
-        # update self.k
-        self.k = cur_z_new.shape[1]
-        
-        return cur_y_new, cur_z_new
+    def _cl_compute_counts(self):
+        """Compute the counts of the device-resident state on the device.
+        """
+        if self.k == 0:
+            self.d_counts.fill(0)
+            return
+        launch = lambda local_size: \
+            self.prg.compute_counts(self.queue, (self.n, self.d), local_size,
+                                    self.d_cur_y.data, self.d_cur_f.data, self.d_counts.data,
+                                    np.int32(self.n), np.int32(self.d), np.int32(self.k), np.int32(self.k_max))
+        launch(self.tuned_local_size('ibp_twoy_compute_counts', (self.n, self.d), self.p_mul_compute_counts, launch))
+
+    def _cl_feature_summary(self):
+        """Return the number of owners of each feature, the numbers of them
+        that use either image, and whether the feature is active (not null),
+        as device arrays over the whole capacity.
+        """
+        d_z_col_sum, d_f1_col_sum, d_f2_col_sum, d_active = \
+            [cl.array.empty(self.queue, (self.k_max,), np.int32, allocator=self.mem_pool) for _ in xrange(4)]
+        self.prg.feature_summary(self.queue, (self.k_max,), None,
+                                 self.d_cur_f.data, d_z_col_sum.data, d_f1_col_sum.data, d_f2_col_sum.data, d_active.data,
+                                 np.int32(self.n), np.int32(self.k), np.int32(self.k_max))
+        return d_z_col_sum, d_f1_col_sum, d_f2_col_sum, d_active
+
+    def _cl_count_histogram(self):
+        """Return the (observed value, count) histogram of the device-resident
+        state, computed on the device.
+        """
+        width = self.k + 1
+        d_hist = cl.array.zeros(self.queue, (2, width), np.int32, allocator=self.mem_pool)
+        self.prg.count_histogram(self.queue, (self.n * self.d,), None,
+                                 self.d_obs, self.d_counts.data, d_hist.data, np.int32(width))
+        return d_hist.get()
+
+    def _cl_infer_f(self, f_prior = None):
+        """Infer F, and with it Z, on the device. Every row is resampled by its
+        own work item, one feature after another.
+        @param f_prior: Fixed probabilities of picking either image; by default
+                        they follow the other cells of F
+        """
+        if self.k == 0: return
+        d_z_col_sum, d_f1_col_sum, d_f2_col_sum, _ = self._cl_feature_summary()
+        num_f1, num_f2 = int(cl.array.sum(d_f1_col_sum).get()), int(cl.array.sum(d_f2_col_sum).get())
+        if f_prior is None: f_prior = [-1., -1.]
+        d_rand = cl.clrandom.rand(self.queue, self.d_cur_f.shape, np.float32)
+        scratch = []
+
+        def launch(local_size, d_cur_f = None, d_counts = None):
+            # f and the counts are resampled in place, so tuning launches work on scratch copies
+            if d_cur_f is None:
+                if not scratch: scratch.extend([self.d_cur_f.copy(), self.d_counts.copy()])
+                d_cur_f, d_counts = scratch
+            return self.prg.sample_f(self.queue, (self.n,), local_size,
+                                     self.d_cur_y.data, d_cur_f.data, d_counts.data, d_z_col_sum.data,
+                                     self.d_obs, d_rand.data,
+                                     np.int32(self.n), np.int32(self.d), np.int32(self.k), np.int32(self.k_max),
+                                     np.int32(num_f1), np.int32(num_f2), np.float32(f_prior[0]), np.float32(f_prior[1]),
+                                     np.float32(self.lam), np.float32(self.epislon))
+
+        launch(self.tuned_local_size('ibp_twoy_sample_f', (self.n,), self.p_mul_sample_f, launch),
+               self.d_cur_f, self.d_counts)
+
+    def _cl_infer_y(self):
+        """Infer both feature images on the device
+        """
+        if self.k == 0: return
+        d_rand = cl.clrandom.rand(self.queue, self.d_cur_y.shape, np.float32)
+        global_shape = (2 * self.k_max, self.d)
+        scratch = []
+
+        def launch(local_size, d_cur_y = None):
+            # y is resampled in place, so tuning launches work on a scratch copy
+            if d_cur_y is None:
+                if not scratch: scratch.append(self.d_cur_y.copy())
+                d_cur_y = scratch[0]
+            return self.prg.sample_y(self.queue, global_shape, local_size,
+                                     d_cur_y.data, self.d_cur_f.data, self.d_counts.data, self.d_obs, d_rand.data,
+                                     np.int32(self.n), np.int32(self.d), np.int32(self.k), np.int32(self.k_max),
+                                     np.float32(self.lam), np.float32(self.epislon), np.float32(self.theta))
+
+        launch(self.tuned_local_size('ibp_twoy_sample_y', global_shape, self.p_mul_sample_y, launch), self.d_cur_y)
+        self._cl_compute_counts()
+
+    def _cl_infer_z(self):
+        """Delete null features on the device, which leaves the counts as they
+        are. Only the number of features left is copied back.
+        """
+        if self.k == 0: return
+        d_active = self._cl_feature_summary()[3]
+        num_active = int(cl.array.sum(d_active).get())
+        if num_active < self.k:
+            self._cl_compact(self.d_cur_y, self.d_cur_f, self.d_cur_y, self.d_cur_f, d_active)
+            self.k = num_active
+
+    def _cl_infer_k_new(self):
+        """Sample new features for the rows that draw any, each owned by its
+        row only. Only the counts of those rows are copied back, and the
+        accepted features are added on the device.
+
+        Unlike _infer_f() on the host, which proposes new features for every
+        row as soon as its cells are resampled, this runs once after the whole
+        sweep of F, since the rows are resampled in parallel; so no row takes a
+        feature born in the same sweep until the next one.
+        """
+        k_new_counts = np.random.poisson(self.alpha / self.n, size = self.n)
+        rows = np.where(k_new_counts > 0)[0]
+        if rows.shape[0] == 0: return
+        _, d_f1_col_sum, d_f2_col_sum, _ = self._cl_feature_summary()
+        f_counts = np.array([cl.array.sum(d_f1_col_sum).get(), cl.array.sum(d_f2_col_sum).get()], dtype=np.int64)
+        for n in rows:
+            k_new = self._sample_k_new(self.obs[n], self.d_counts[n:n+1].get()[0], f_counts, k_new_counts[n])
+            if not k_new: continue
+            new_y, new_f, _ = k_new
+            self._cl_reserve(self.k + new_f.shape[0])
+            self.prg.add_features(self.queue, (self.d,), None,
+                                  self.d_cur_y.data, self.d_cur_f.data, self.d_counts.data,
+                                  cl.array.to_device(self.queue, new_y.astype(np.int32), allocator=self.mem_pool).data,
+                                  cl.array.to_device(self.queue, new_f.astype(np.int32), allocator=self.mem_pool).data,
+                                  np.int32(n), np.int32(self.d), np.int32(self.k), np.int32(new_f.shape[0]),
+                                  np.int32(self.k_max))
+            self.k += new_f.shape[0]
+            f_counts += [(new_f == 1).sum(), (new_f == 2).sum()]
 
 class UniformGibbs(BiasedGibbs):
 
-    def _infer_f(self, cur_y, cur_z, cur_f, f_prior=None):
+    def _infer_f(self, state, f_prior=None):
         """Infer feature ownership matrix Z.
         """
-        return super(UniformGibbs, self)._infer_f(cur_y, cur_z, cur_f, [0.5, 0.5])    
+        return super(UniformGibbs, self)._infer_f(state, [0.5, 0.5])    
+
+    def _cl_infer_f(self, f_prior=None):
+        """Infer feature ownership matrix Z on the device.
+        """
+        return super(UniformGibbs, self)._cl_infer_f([0.5, 0.5])
+
+def score_uniform_sample(cur_y, lam, epislon, noisyor, obs):
+    """Return the log scores of the test cases obs under one sample of the two
+    sets of feature images and the lambda and epislon that go with it, for
+    UniformGibbsPredictor.score().
+    """
+    return np.logaddexp(noisyor.marginal_logliks(obs, cur_y[0], lam, epislon),
+                        noisyor.marginal_logliks(obs, cur_y[1], lam, epislon))
+
+def score_biased_sample(cur_y, cur_z, cur_f, lam, epislon, noisyor, obs, alpha):
+    """Return the log scores of the test cases obs under one sample of Y, Z and
+    F and the lambda and epislon that go with it, for BiasedGibbsPredictor.score().
+    """
+    prior = ibp_predictive_prior(cur_z, alpha)
+    with np.errstate(divide = 'ignore'):
+        log_f = np.log([(cur_f == 1).sum(), (cur_f == 2).sum()]) - np.log((cur_f > 0).sum())
+    return np.logaddexp(log_f[0] + noisyor.marginal_logliks(obs, cur_y[0], lam, epislon, *prior),
+                        log_f[1] + noisyor.marginal_logliks(obs, cur_y[1], lam, epislon, *prior))
 
 class UniformGibbsPredictor(BasePredictor):
 
@@ -445,6 +578,7 @@ class UniformGibbsPredictor(BasePredictor):
         self.lam = lam
         self.theta = theta
         self.epislon = epislon
+        self.noisyor = NoisyOrLikelihood()
 
     def read_test_csv(self, file_path, header=True):
         """Read the test cases and convert values to integer.
@@ -453,157 +587,53 @@ class UniformGibbsPredictor(BasePredictor):
         self.obs = np.array(self.obs, dtype=np.int32)
         return
 
+    def score(self, thining = 0, burnin = 0, use_iter = None, obs = None):
+        """Compute the log score of each test case under each selected sample:
+        the log of the sum of its likelihood over all ownership patterns of
+        the features, with either set of feature images. Samples are scored
+        by num_workers processes.
+        """
+        if obs is None: obs = self.obs
+        samples_y = self.select_samples('y', thining, burnin, use_iter)
+        params = self.select_params(['lam', 'epislon'], len(samples_y), thining, burnin, use_iter)
+        return np.array(self.map_samples(score_uniform_sample, [(y,) + p for y, p in zip(samples_y, params)],
+                                         (self.noisyor, obs))).reshape((-1, len(obs)))
+
     def predict(self, thining = 0, burnin = 0, use_iter=None, output_file = None):
-        """Predict the test cases
+        """Predict the test cases: the largest log score of each test case over
+        the selected samples, and the standard deviation of its log scores.
         """
         assert('y' in self.samples and 'z' in self.samples and 'f' in self.samples)
         assert(len(self.samples['y']) == len(self.samples['z']) == len(self.samples['f']))
         
-        num_sample = len(self.samples['y'])
-        num_obs = len(self.obs)
-        logprob_result = np.empty((num_sample, num_obs))
-
-        for i in xrange(num_sample):
-            cur_y = self.samples['y'][i]
-            cur_z = self.samples['z'][i]
-            cur_f = self.samples['f'][i]
-            
-            # generate all possible Zs
-            num_feature = cur_z.shape[1]
-            all_z = []
-            for n in xrange(num_feature+1):
-                base = [1] * n + [0] * (num_feature - n)
-                all_z.extend(list(set(itertools.permutations(base))))
-            all_z = np.array(all_z, dtype=np.int32)
-            
-            # BEGIN p(z|z_inferred) calculation
-
-            # the following lines of code may be a bit tricky to parse
-            # first, calculate the probability of on/off features 
-            prior_off_prob = 1.0 - cur_z.sum(axis = 0) / float(cur_z.shape[0])
-            prior_prob = np.abs(all_z - prior_off_prob)
-
-            # then, locate the novel features in all_z
-            mask = np.ones(all_z.shape)
-            mask[:,np.where(cur_z.sum(axis = 0) > 0)] = 0
-            novel_all_z = all_z * mask
-            
-            # temporarily mark those cells to have probability 1
-            prior_prob[novel_all_z==1] = 1
-
-            # we can safely do row product now, still ignoring new features
-            prior_prob = prior_prob.prod(axis = 1)
-
-            # let's count the number of new features for each row
-            num_novel = novel_all_z.sum(axis = 1)
-            # calculate the probability
-            novel_prob = poisson.pmf(num_novel, self.alpha / float(cur_z.shape[0]))
-            # ignore the novel == 0 special case
-            novel_prob[num_novel==0] = 1.
-
-            # multiply it by prior prob
-            prior_prob = prior_prob * novel_prob
-            
-            # END p(z|z_inferred) calculation
-
-            # BEGIN p(x|z, y_inferred)
-            # first deal with cur_y[0]
-            n_by_d0 = np.dot(all_z, cur_y[0])
-            n_by_d1 = np.dot(all_z, cur_y[1])
-            not_on_p0 = np.power(1. - self.lam, n_by_d0) * (1. - self.epislon)
-            not_on_p1 = np.power(1. - self.lam, n_by_d1) * (1. - self.epislon)
-            for j in xrange(len(self.obs)):
-                prob0 = np.abs(self.obs[j] - not_on_p0).prod(axis=1) 
-                prob1 = np.abs(self.obs[j] - not_on_p1).prod(axis=1) 
-                #prob = prob0 * prior_prob + prob1 * prior_prob
-                prob = prob0 + prob1
-                prob = prob.sum()
-                logprob_result[i,j] = prob
-            # END
-                
+        logprob_result = self.score(thining, burnin, use_iter)
         return logprob_result.max(axis=0), logprob_result.std(axis=0)
 
 class BiasedGibbsPredictor(UniformGibbsPredictor):
 
+    def score(self, thining = 0, burnin = 0, use_iter = None, obs = None):
+        """Compute the log score of each test case under each selected sample:
+        the log expectation of its likelihood under the IBP prior of the
+        ownership of the features, with each set of feature images weighted by
+        how often F picks it. Samples are scored by num_workers processes.
+        """
+        if obs is None: obs = self.obs
+        samples = zip(*[self.select_samples(_, thining, burnin, use_iter) for _ in ('y', 'z', 'f')])
+        params = self.select_params(['lam', 'epislon'], len(samples), thining, burnin, use_iter)
+        return np.array(self.map_samples(score_biased_sample, [s + p for s, p in zip(samples, params)],
+                                         (self.noisyor, obs, self.alpha))).reshape((-1, len(obs)))
+
     def predict(self, thining = 0, burnin = 0, use_iter=None, output_file = None):
-        """Predict the test cases
+        """Predict the test cases: the log of the mean score of each test case
+        over the selected samples, and the standard deviation of its log scores.
         """
         assert('y' in self.samples and 'z' in self.samples and 'f' in self.samples)
         assert(len(self.samples['y']) == len(self.samples['z']) == len(self.samples['f']))
         
-        num_sample = len(self.samples['y'])
-        num_obs = len(self.obs)
-        logprob_result = np.empty((num_sample, num_obs))
-
-        for i in xrange(num_sample):
-            cur_y = self.samples['y'][i]
-            cur_z = self.samples['z'][i]
-            cur_f = self.samples['f'][i]
-            
-            # generate all possible Zs
-            num_feature = cur_z.shape[1]
-            all_z = []
-            for n in xrange(num_feature+1):
-                base = [1] * n + [0] * (num_feature - n)
-                all_z.extend(list(set(itertools.permutations(base))))
-            all_z = np.array(all_z, dtype=np.int32)
-            
-            # BEGIN p(z|z_inferred) calculation
-
-            # the following lines of code may be a bit tricky to parse
-            # first, calculate the probability of on/off features 
-            prior_off_prob = 1.0 - cur_z.sum(axis = 0) / float(cur_z.shape[0])
-            prior_prob = np.abs(all_z - prior_off_prob)
-
-            # then, locate the novel features in all_z
-            mask = np.ones(all_z.shape)
-            mask[:,np.where(cur_z.sum(axis = 0) > 0)] = 0
-            novel_all_z = all_z * mask
-            
-            # temporarily mark those cells to have probability 1
-            prior_prob[novel_all_z==1] = 1
-
-            # we can safely do row product now, still ignoring new features
-            prior_prob = prior_prob.prod(axis = 1)
-
-            # let's count the number of new features for each row
-            num_novel = novel_all_z.sum(axis = 1)
-            # calculate the probability
-            novel_prob = poisson.pmf(num_novel, self.alpha / float(cur_z.shape[0]))
-            # ignore the novel == 0 special case
-            novel_prob[num_novel==0] = 1.
-
-            # multiply it by prior prob
-            prior_prob = prior_prob * novel_prob
-            
-            # END p(z|z_inferred) calculation
-
-            # BEGIN p(x|z, y_inferred)
-            # first deal with cur_y[0]
-            n_by_d0 = np.dot(all_z, cur_y[0])
-            n_by_d1 = np.dot(all_z, cur_y[1])
-            not_on_p0 = np.power(1. - self.lam, n_by_d0) * (1. - self.epislon)
-            not_on_p1 = np.power(1. - self.lam, n_by_d1) * (1. - self.epislon)
-            for j in xrange(len(self.obs)):
-                prob0 = np.abs(self.obs[j] - not_on_p0).prod(axis=1) 
-                prob1 = np.abs(self.obs[j] - not_on_p1).prod(axis=1) 
-                prob = float((cur_f == 1).sum()) / float((cur_f > 0).sum()) * prob0 * prior_prob + \
-                    float((cur_f == 2).sum()) / float((cur_f > 0).sum()) * prob1 * prior_prob
-                prob = prob.sum()
-                logprob_result[i,j] = prob
-            # END
-                
-        return logprob_result.mean(axis=0), logprob_result.std(axis=0)
+        logprob_result = self.score(thining, burnin, use_iter)
+        return logsumexp(logprob_result, axis=0) - np.log(logprob_result.shape[0]), logprob_result.std(axis=0)
 
         
-if __name__ == '__main__':
-    
-    p = UniformGibbsPredictor(cl_mode=False)
-    p.read_test_csv('/home/qian/Dropbox/Projects/NegCorr/mturk/training-images-bits/test.csv')
-    p.read_samples('/home/qian/Dropbox/Projects/NegCorr/mturk/training-images-bits/add-1000-noisyortwoy-uniform-chain-1-nocl.pickled')
-    print(p.predict())
-
-
 #if __name__ == '__main__':
 
 #    NITER = 200
@@ -0,0 +1,333 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+from __future__ import print_function, division
+import sys, os, os.path, random, traceback, multiprocessing
+from multiprocessing.connection import Listener, Client
+pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
+sys.path.append(pkg_dir)
+
+from MPBNP import *
+from noisyor import Gibbs
+
+def shared_array(shape, dtype):
+    """Allocate a zeroed array in shared memory. Return the RawArray, which is
+    what worker processes must be given to share the memory, and a NumPy view
+    of it.
+    """
+    dtype = np.dtype(dtype)
+    buf = multiprocessing.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+    return buf, shared_view(buf, shape, dtype)
+
+def shared_view(buf, shape, dtype):
+    """Return a NumPy view of a RawArray from shared_array().
+    """
+    return np.frombuffer(buf, dtype = dtype).reshape(shape)
+
+def add_histograms(hists):
+    """Add up (observed value, count) histograms of different widths.
+    """
+    total = np.zeros((2, max(_.shape[1] for _ in hists)), dtype=np.int64)
+    for hist in hists: total[:,:hist.shape[1]] += hist
+    return total
+
+def shard_worker(sampler, conn, obs_buf, obs_shape, z_buf, start, end, seed):
+    """Entry point of a worker process on this machine, which serves the rows
+    start to end. The images and Z are passed as the RawArrays themselves,
+    not through the sampler, so that they are shared rather than copied on
+    platforms where processes are not forked.
+    @param obs_shape: The shape of the images, or of their packed bits if
+                      sampler.compact is set
+    """
+    obs = shared_view(obs_buf, obs_shape, np.uint8)[start:end]
+    if sampler.compact: obs = PackedRows.from_bits(obs, (end - start, sampler.d))
+    shard_z = shared_view(z_buf, (sampler.N, sampler.max_k), np.uint8)[start:end]
+    serve_shard(sampler, conn, obs, shard_z, seed, send_rows = False)
+
+def remote_worker(address, authkey):
+    """Run a worker for a coordinator on another machine: connect to it at
+    address, receive the sampler and the images and rows of Z of a shard, and
+    serve the shard until the coordinator stops it.
+    """
+    conn = Client(address, authkey = authkey)
+    _, sampler, obs, shard_z, seed = conn.recv()
+    serve_shard(sampler, conn, obs, shard_z, seed, send_rows = True)
+
+def serve_shard(sampler, conn, obs, shard_z, seed, send_rows):
+    """Serve the requests of the coordinator for a shard of rows until told to
+    stop. A request that fails is answered with the exception, carrying the
+    traceback of the worker, and the worker exits.
+    @param shard_z: The rows of Z of the shard, with room for max_k features
+    @param send_rows: Send the rows of Z back after every resize, for a
+                      coordinator that does not share memory with the worker
+    """
+    np.random.seed(seed)
+    random.seed(seed)
+    k = sampler.k # the number of features in use
+    while True:
+        request = conn.recv()
+        if request[0] == 'stop': break
+        try:
+            if request[0] == 'sweep':
+                # resample the rows of Z given Y, then compute the loglikelihoods
+                # of the shard with each pixel of Y turned on and off
+                _, cur_y, others_col_sum, sampler.lam, sampler.epislon = request
+                k = cur_y.shape[0]
+                cur_z = shard_z[:,:k]
+                cur_z[:] = sampler._sample_z(obs, cur_y, cur_z, others_col_sum + cur_z.sum(axis = 0), sampler.N)
+                on_loglik, off_loglik = sampler._y_loglik(obs, cur_y, cur_z)
+                conn.send((cur_z.sum(axis = 0), on_loglik, off_loglik))
+
+            elif request[0] == 'resize':
+                # drop the features that are not kept and give the rows random
+                # ownership of the new ones
+                _, cur_y, keep, k_new = request
+                num_kept = keep.sum()
+                shard_z[:,:num_kept] = shard_z[:,:k][:,keep]
+                shard_z[:,num_kept:num_kept + k_new] = np.random.randint(0, 2, size = (shard_z.shape[0], k_new))
+                k = num_kept + k_new
+                cur_z = shard_z[:,:k]
+                conn.send((cur_z.sum(axis = 0),
+                           sampler._count_histogram(cur_y, cur_z, obs),
+                           cur_z.copy() if send_rows else None))
+
+            elif request[0] == 'restore':
+                # go back to the rows of an earlier sample
+                _, rows = request
+                shard_z[:,:rows.shape[1]] = rows
+                k = rows.shape[1]
+                conn.send(True)
+        except Exception:
+            conn.send(Exception(traceback.format_exc()))
+            break
+    conn.close()
+
+class ParallelGibbs(Gibbs):
+    """The noisy-or IBP sampler run on a row-sharded copy of the data by
+    several worker processes, on this machine and optionally on others, after
+    Doshi-Velez et al. (2009).
+
+    Given Y the rows of Z are conditionally independent, so every worker
+    resamples the rows of its shard, using the number of owners of each feature
+    in the other shards as of the last synchronization. The workers send back
+    the owner counts and the per-pixel loglikelihoods of turning each pixel of
+    Y on and off, summed over their rows. The coordinator adds them up,
+    resamples Y, lambda and epislon, proposes new features and broadcasts the
+    new Y and the features to keep.
+
+    Workers on this machine share the images and Z with the coordinator in
+    shared memory, so only Y and K-sized vectors cross process boundaries.
+    Workers on other machines are started with remote_worker() (or
+    IBPSamplingUtility.py --worker_of) and connect to the coordinator, which
+    waits for num_remote of them at address. They get a copy of the images
+    of their shard once, and send their rows of Z back after every resize.
+    Connections are authenticated with authkey, a random one by default,
+    which the coordinator prints for the remote workers to be given.
+    """
+
+    def __init__(self, num_workers = None, max_k = 256, record_best = True,
+                 alpha = None, lam = 0.98, theta = 0.10, epislon = 0.02, init_k = 10,
+                 compact = False, num_remote = 0, address = ('', 0), authkey = None):
+        """Initialize the class.
+        @param num_workers: The number of worker processes on this machine; one per CPU by default
+        @param max_k: The largest number of features that the shared Z can hold
+        @param num_remote: The number of workers on other machines to wait for
+        @param address: The (host, port) to wait for them at; any free port by default
+        @param authkey: The key they must present; random by default
+        """
+        Gibbs.__init__(self, cl_mode = False, record_best = record_best, alpha = alpha, lam = lam,
+                       theta = theta, epislon = epislon, init_k = init_k, compact = compact)
+        if num_workers is None: num_workers = multiprocessing.cpu_count()
+        self.num_workers = num_workers
+        self.num_remote = num_remote
+        self.address = address
+        self.authkey = authkey or os.urandom(16)
+        self.max_k = max_k
+        self.workers = [] # (process, connection, start, end) per worker; no process for remote ones
+        self.shared_z = None
+        self.hist = None
+
+    def __getstate__(self):
+        # what worker processes get of the sampler: no data, samples or connections
+        state = dict(self.__dict__)
+        for name in ('obs', 'shared_z', 'workers', 'samples', 'best_sample', 'best_diff'):
+            state.pop(name, None)
+        return state
+
+    def shard_obs(self, start, end):
+        """Return the images of the rows start to end.
+        """
+        if isinstance(self.obs, PackedRows):
+            return PackedRows.from_bits(self.obs.packed[start:end], (end - start, self.d))
+        return self.obs[start:end]
+
+    def _start_workers(self, init_z):
+        """Move the images and Z into shared memory, start the local workers and
+        wait for the remote ones.
+        """
+        assert(init_z.shape[1] <= self.max_k)
+        if isinstance(self.obs, PackedRows):
+            obs_buf, packed = shared_array(self.obs.packed.shape, np.uint8)
+            packed[:] = self.obs.packed
+            self.obs = PackedRows.from_bits(packed, self.obs.shape)
+            obs_shape = packed.shape
+        else:
+            obs_buf, obs = shared_array(self.obs.shape, np.uint8)
+            obs[:] = self.obs
+            self.obs = obs
+            obs_shape = obs.shape
+        z_buf, self.shared_z = shared_array((self.N, self.max_k), np.uint8)
+        self.shared_z[:,:init_z.shape[1]] = init_z
+        self.k = init_z.shape[1]
+
+        num_local = min(self.num_workers, self.N)
+        bounds = np.linspace(0, self.N, min(num_local + self.num_remote, self.N) + 1).astype(np.int64)
+        self.workers = []
+        for start, end in zip(bounds[:num_local], bounds[1:num_local + 1]):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target = shard_worker,
+                                              args = (self, child_conn, obs_buf, obs_shape, z_buf, start, end,
+                                                      np.random.randint(2 ** 31)))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self.workers.append((process, conn, start, end))
+
+        remote_bounds = zip(bounds[num_local:-1], bounds[num_local + 1:])
+        if remote_bounds:
+            listener = Listener(self.address, authkey = self.authkey)
+            print('Waiting for %d remote workers at %s:%d with authkey %s' %
+                  ((len(remote_bounds),) + listener.address + (self.authkey.encode('hex'),)), file=sys.stderr)
+            try:
+                for start, end in remote_bounds:
+                    conn = listener.accept()
+                    conn.send(('init', self, self.shard_obs(start, end), self.shared_z[start:end].copy(),
+                               np.random.randint(2 ** 31)))
+                    self.workers.append((None, conn, start, end))
+            finally:
+                listener.close()
+
+    def _stop_workers(self):
+        """Stop the workers that are still running. Never raises, so that the
+        error that stopped the sampler, if any, is the one reported.
+        """
+        for process, conn, _, _ in self.workers:
+            if process is None or process.is_alive():
+                try: conn.send(('stop',))
+                except (IOError, EOFError): pass
+            conn.close()
+            if process is not None:
+                process.join(10)
+                if process.is_alive(): process.terminate()
+        self.workers = []
+
+    def _scatter(self, requests):
+        """Send one request to each worker and return their replies. If any
+        worker failed or went away, raise the first such error once all the
+        others have replied.
+        """
+        for (_, conn, _, _), request in zip(self.workers, requests):
+            try: conn.send(request)
+            except (IOError, EOFError): pass # reported when its reply is missing
+        replies, errors = [], []
+        for process, conn, start, end in self.workers:
+            try:
+                reply = conn.recv()
+            except (IOError, EOFError):
+                reply = EOFError('the process exited')
+            if isinstance(reply, Exception):
+                errors.append('Worker for rows %d to %d: %s' % (start, end, reply))
+            replies.append(reply)
+        if errors: raise Exception(errors[0])
+        return replies
+
+    def _resize(self, cur_y, keep, k_new):
+        """Keep the features in keep plus k_new new ones in every shard. Return
+        the owner counts of each shard and the histogram of the new state.
+        """
+        replies = self._scatter([('resize', cur_y, keep, k_new)] * len(self.workers))
+        self.k = cur_y.shape[0]
+        for (_, _, start, end), (_, _, rows) in zip(self.workers, replies):
+            if rows is not None: self.shared_z[start:end,:self.k] = rows
+        return [_[0] for _ in replies], add_histograms([_[1] for _ in replies])
+
+    def _restore(self, cur_z):
+        """Go back to the feature ownership of an earlier sample.
+        """
+        self.shared_z[:,:cur_z.shape[1]] = cur_z
+        self.k = cur_z.shape[1]
+        remote = [_ for _ in self.workers if _[0] is None]
+        for _, conn, start, end in remote: conn.send(('restore', cur_z[start:end]))
+        for _, conn, start, end in remote:
+            reply = conn.recv()
+            if isinstance(reply, Exception): raise Exception('Worker for rows %d to %d: %s' % (start, end, reply))
+
+    def _infer_yz(self, init_y, init_z, output_file):
+        """Wrapper function to start the inference on y and z.
+        This function is not supposed to directly invoked by an end user.
+        @param init_y: Passed in from do_inference()
+        @param init_z: Passed in from do_inference()
+        """
+        a_time = time()
+        self._start_workers(init_z)
+        try:
+            cur_y = init_y.astype(np.int32)
+            shard_col_sums, self.hist = self._resize(cur_y, np.ones(cur_y.shape[0], dtype=np.bool_), 0)
+            cur_z = self.shared_z[:,:self.k].copy()
+            cur_state = (shard_col_sums, self.hist)
+            self.auto_save_sample(sample = (cur_y, cur_z))
+
+            for i in xrange(self.niter):
+                if self.sample_lam_epislon:
+                    self._sample_lam(self.hist)
+                    self._sample_epislon(self.hist)
+
+                # sweep the rows of Z in every shard and resample Y
+                col_sum = np.sum(shard_col_sums, axis = 0)
+                replies = self._scatter([('sweep', cur_y, col_sum - _, self.lam, self.epislon) for _ in shard_col_sums])
+                col_sum = np.sum([_[0] for _ in replies], axis = 0)
+                temp_cur_y = self._sample_y(cur_y, np.sum([_[1] for _ in replies], axis = 0),
+                                            np.sum([_[2] for _ in replies], axis = 0))
+
+                # delete empty and null features and propose new ones
+                keep = (temp_cur_y.sum(axis = 1) > 0) & (col_sum > 0)
+                k_new = min(np.random.poisson(self.alpha / self.N), self.max_k - keep.sum())
+                temp_cur_y = np.vstack((temp_cur_y[keep],
+                                        np.random.binomial(1, self.theta, (k_new, self.d)))).astype(np.int32)
+                shard_col_sums, self.hist = self._resize(temp_cur_y, keep, k_new)
+                temp_cur_z = self.shared_z[:,:self.k].copy()
+
+                if self.record_best:
+                    if self.auto_save_sample(sample = (temp_cur_y, temp_cur_z)):
+                        cur_y, cur_z = temp_cur_y, temp_cur_z
+                        cur_state = (shard_col_sums, self.hist)
+                    else:
+                        # go back to the last accepted sample
+                        self._restore(cur_z)
+                        shard_col_sums, self.hist = cur_state
+                        self.restore_best_params()
+                    if self.no_improvement():
+                        break
+                else:
+                    cur_y, cur_z = temp_cur_y, temp_cur_z
+                    if i >= self.burnin:
+                        self.samples['z'].append(cur_z)
+                        self.samples['y'].append(cur_y)
+                        self.record_params()
+        finally:
+            self._stop_workers()
+
+        self.total_time += time() - a_time
+        return self.gpu_time, self.total_time, None
+
+    def _logprob(self, sample):
+        """Calculate the joint log probability of data and model given the
+        sample that the workers hold, whose loglikelihood comes from the
+        histogram they sent back for it.
+        """
+        cur_y, cur_z = sample
+        if cur_z.shape[1] == 0: return -99999999.9
+        num_on = (cur_y == 1).sum()
+        num_off = (cur_y == 0).sum()
+        log_prior = ibp_logprior_z(cur_z, self.alpha) + num_on * np.log(self.theta) + num_off * np.log(1 - self.theta)
+        return log_prior + self.noisyor.count_loglik(self.hist, self.lam, self.epislon)
@@ -295,6 +295,7 @@ kernel void sample_y(global int *cur_y,
 
   uint kth = get_global_id(0); // k is the index of features
   uint dth = get_global_id(1); // d is the index of pixels
+  if (kth >= K) return; // the launch is padded past the K features
 
   uint f_img_height = D / f_img_width;
 
@@ -368,6 +369,7 @@ kernel void sample_z(global int *cur_y,
 
   uint nth = get_global_id(0); // n is the index of data
   uint kth = get_global_id(1); // k is the index of features
+  if (kth >= K) return; // the launch is padded past the K features
 
   uint f_img_height = D / f_img_width;
 
@@ -13,7 +13,7 @@ from transforms import *
 
 np.set_printoptions(suppress=True)
 
-class Gibbs(BaseSampler):
+class Gibbs(BaseSampler, NoisyOrSampler):
 
     V_SCALE = 0
     H_SCALE = 1
@@ -30,6 +30,10 @@ class Gibbs(BaseSampler):
         if cl_mode:
             program_str = open(pkg_dir + 'MPBNP/tibp/kernels/tibp_noisyor_cl.c', 'r').read()
             self.prg = cl.Program(self.ctx, program_str).build() 
+            self.p_mul_sample_y = cl.Kernel(self.prg, 'sample_y').\
+                get_work_group_info(cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, self.device)
+            self.p_mul_sample_z = cl.Kernel(self.prg, 'sample_z').\
+                get_work_group_info(cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, self.device)
 
         self.alpha = alpha # tendency to generate new features
         self.k = init_k    # initial number of features
@@ -38,22 +42,16 @@ class Gibbs(BaseSampler):
         self.epislon = epislon # probability that a pixel is on by change in an actual image
         self.phi = 0.9 # prior probability that no transformation is applied
         self.samples = {'z': [], 'y': [], 'r': []} # sample storage, to be pickled
+        self.noisyor = NoisyOrLikelihood()
+        self.sample_lam_epislon = False # resample lambda and epislon every iteration
+        self.sampled_params = ['lam', 'epislon'] # kept with the samples and the best sample
 
-    def read_csv(self, filepath, header=True):
+    def read_csv(self, filepath, header=True, rows = None):
         """Read the data from a csv file.
+        @param rows: Indices of the images to read; all of them by default
         """
-        BaseSampler.read_csv(self, filepath, header)
-        # convert the data to the appropriate formats
-        self.new_obs = []
-        self.img_w, self.img_h = None, None
-        for row in self.obs:
-            if self.img_w is None:
-                self.img_w = int(row[0])
-                if self.img_w == 0 or (len(row)-1) % self.img_w != 0:
-                    raise Exception('The sampler does not understand the format of the data. Did you forget to specify image width in the data file?')
-            self.new_obs.append([int(_) for _ in row])
-            
-        self.obs = np.array(self.new_obs)[:,1:]
+        self.obs, self.img_w = read_images(filepath, header, rows = rows)
+        self.N = len(self.obs)
         if self.cl_mode:
             self.d_obs = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf=self.obs.astype(np.int32))
 
@@ -160,9 +158,11 @@ class Gibbs(BaseSampler):
                       'epislon,%f' % self.epislon, 'phi,%f' % self.phi,
                       'gpu_time,%f' % timing_stats[0], 'total_time,%f' % timing_stats[1],
                       file = gzip.open(output_file + 'parameters.csv.gz', 'w'), sep = '\n')
-                np.savez_compressed(output_file + 'feature_ownership.npz', self.samples['z'])
-                np.savez_compressed(output_file + 'feature_images.npz', self.samples['y'])
-                np.savez_compressed(output_file + 'transformations.npz', self.samples['r'])
+                save_samples(output_file + 'feature_ownership.npz', self.samples['z'], dtype=np.uint8)
+                save_samples(output_file + 'feature_images.npz', self.samples['y'], dtype=np.uint8)
+                save_samples(output_file + 'transformations.npz', self.samples['r'])
+                save_samples(output_file + 'lambda.npz', self.samples.get('lam', []))
+                save_samples(output_file + 'epislon.npz', self.samples.get('epislon', []))
 
         return timing_stats
 
@@ -173,28 +173,39 @@ class Gibbs(BaseSampler):
         @param init_z: Passed in from do_inference()
         @param init_r: Passed in from do_inference()
         """
-        cur_y = init_y
-        cur_z = init_z
-        cur_r = init_r
+        state = FeatureState([('y', init_y, 0), ('z', init_z, 1), ('r', init_r, 1)])
 
         a_time = time()
-        if self.record_best: self.auto_save_sample(sample = (cur_y, cur_z, cur_r))
+        if self.record_best: self.auto_save_sample(sample = state.copy('y', 'z', 'r'))
         for i in xrange(self.niter):
-            temp_cur_y = self._infer_y(cur_y, cur_z, cur_r)
-            temp_cur_y, temp_cur_z, temp_cur_r = self._infer_z(temp_cur_y, cur_z, cur_r)
-            temp_cur_r = self._infer_r(temp_cur_y, temp_cur_z, temp_cur_r)
+            state['y'][:] = self._infer_y(state['y'], state['z'], state['r'])
+            self._infer_z(state)
+            # R is resampled in place
+            self._infer_r(state['y'], state['z'], state['r'])
+            if self.sample_lam_epislon:
+                hist = self._count_histogram(state['y'], state['z'], state['r'])
+                self._sample_lam(hist)
+                self._sample_epislon(hist)
 
             if self.record_best:
-                if self.auto_save_sample(sample = (temp_cur_y, temp_cur_z, temp_cur_r)):
-                    cur_y, cur_z, cur_r = temp_cur_y, temp_cur_z, temp_cur_r
+                # only a new best sample is copied out of the state
+                logprob = self._logprob((state['y'], state['z'], state['r']))
+                sample = None
+                if logprob > self.best_sample[1]: sample = state.copy('y', 'z', 'r')
+                if not self.auto_save_sample(sample = sample, logprob = logprob):
+                    # go back to the last accepted sample
+                    best_y, best_z, best_r = self.best_sample[0]
+                    state.load(y = best_y, z = best_z, r = best_r)
+                    self.restore_best_params()
                 if self.no_improvement(1000):
                     break                    
                 
             elif i >= self.burnin:
-                cur_y, cur_z, cur_r = temp_cur_y, temp_cur_z, temp_cur_r
+                cur_y, cur_z, cur_r = state.copy('y', 'z', 'r')
                 self.samples['z'].append(cur_z)
                 self.samples['y'].append(cur_y)
                 self.samples['r'].append(cur_r)
+                self.record_params()
 
         self.total_time += time() - a_time
         return self.gpu_time, self.total_time, None
@@ -233,9 +244,10 @@ class Gibbs(BaseSampler):
 
         return cur_y
 
-    def _infer_z(self, cur_y, cur_z, cur_r):
-        """Infer feature ownership
+    def _infer_z(self, state):
+        """Infer feature ownership, updating the FeatureState of Y, Z and R in place
         """
+        cur_y, cur_z, cur_r = state['y'], state['z'], state['r']
         N = float(len(self.obs))
         z_col_sum = cur_z.sum(axis = 0)
 
@@ -258,29 +270,19 @@ class Gibbs(BaseSampler):
         on_prob = on_prob / (on_prob + off_prob)
 
         # sample the values
-        cur_z = np.random.binomial(1, on_prob)
+        cur_z[:] = np.random.binomial(1, on_prob)
 
         # sample new features use importance sampling
         k_new = self._sample_k_new(cur_y, cur_z, cur_r)
         if k_new:
-            cur_y, cur_z, cur_r = k_new
-        
-        # delete empty feature images
-        non_empty_feat_img = np.where(cur_y.sum(axis = 1) > 0)
-        cur_y = cur_y[non_empty_feat_img[0],:]
-        cur_z = cur_z[:,non_empty_feat_img[0]]
-        cur_r = np.array([_[non_empty_feat_img[0],:] for _ in cur_r])
+            new_y, new_z = k_new
+            state.append(new_y.shape[0], y = new_y, z = new_z)
         
-        # delete null features
-        active_feat_col = np.where(cur_z.sum(axis = 0) > 0)
-        cur_z = cur_z[:,active_feat_col[0]]
-        cur_y = cur_y[active_feat_col[0],:]
-        cur_r = np.array([_[active_feat_col[0],:] for _ in cur_r])
+        # delete empty feature images and null features
+        state.remove((state['y'].sum(axis = 1) == 0) | (state['z'].sum(axis = 0) == 0))
 
         # update self.k
-        self.k = cur_z.shape[1]
-        
-        return cur_y, cur_z, cur_r
+        self.k = state.k
 
     def _infer_r(self, cur_y, cur_z, cur_r):
         """Infer transformations.
@@ -362,6 +364,8 @@ class Gibbs(BaseSampler):
         this frozen snapshot of Z. In a more correct procedure, we should
         go through the rows and sample k new for each row given all previously
         sampled new ks.)
+        @return: The images and the ownership of the new features, whose
+                 transformations are all zero, or False
         """
         N = float(len(self.obs))
         #old_loglik = self._loglik(cur_y, cur_z, cur_r)
@@ -369,43 +373,11 @@ class Gibbs(BaseSampler):
         k_new_count = np.random.poisson(self.alpha / N)
         if k_new_count == 0: return False
             
-        # modify the feature ownership matrix
-        cur_z_new = np.hstack((cur_z, np.random.randint(0, 2, size = (cur_z.shape[0], k_new_count))))
-        #cur_z_new[:, [xrange(-k_new_count,0)]] = 1
+        # the ownership of the new features
+        new_z = np.random.randint(0, 2, size = (cur_z.shape[0], k_new_count))
         # propose feature images by sampling from the prior distribution
-        cur_y_new = np.vstack((cur_y, np.random.binomial(1, self.theta, (k_new_count, self.d))))
-        cur_r_new = np.array([np.vstack((_, np.zeros((k_new_count, self.NUM_TRANS)))) for _ in cur_r])
-        return cur_y_new.astype(np.int32), cur_z_new.astype(np.int32), cur_r_new.astype(np.int32)
-
-    def _sample_lam(self, cur_y, cur_z):
-        """Resample the value of lambda.
-        """
-        old_loglik = self._loglik(cur_y, cur_z)
-        old_lam = self.lam
-    
-        # modify the feature ownership matrix
-        self.lam = np.random.beta(1,1)
-        new_loglik = self._loglik(cur_y, cur_z)
-        move_prob = 1 / (1 + np.exp(old_loglik - new_loglik))
-        if random.random() < move_prob:
-            pass
-        else:
-            self.lam = old_lam
-
-    def _sample_epislon(self, cur_y, cur_z):
-        """Resample the value of epislon
-        """
-        old_loglik = self._loglik(cur_y, cur_z)
-        old_epislon = self.epislon
-    
-        # modify the feature ownership matrix
-        self.epislon = np.random.beta(1,1)
-        new_loglik = self._loglik(cur_y, cur_z)
-        move_prob = 1 / (1 + np.exp(old_loglik - new_loglik));
-        if random.random() < move_prob:
-            pass
-        else:
-            self.epislon = old_epislon
+        new_y = np.random.binomial(1, self.theta, (k_new_count, self.d))
+        return new_y.astype(np.int32), new_z.astype(np.int32)
 
     def _loglik_nth(self, cur_y, cur_z, cur_r, n):
         """Calculate the loglikelihood of the nth data point
@@ -415,7 +387,7 @@ class Gibbs(BaseSampler):
 
         if type(n) is int: n = [n]
         else: n = n[0]
-        not_on_p = np.empty((len(n), cur_y.shape[1]))
+        n_by_d = np.empty((len(n), cur_y.shape[1]), dtype=np.int64)
         
         # transform the feature images to obtain the effective y
         # this needs to be done on a per object basis
@@ -430,8 +402,8 @@ class Gibbs(BaseSampler):
                 nth_y[kth_feat] = h_translate(nth_y[kth_feat], self.img_w, r_feat[self.H_TRANS])
                 kth_feat += 1
                 
-            not_on_p[i] = np.power(1. - self.lam, np.dot(cur_z[nth], nth_y)) * (1. - self.epislon)
-        loglik = np.log(np.abs(self.obs[n] - not_on_p)).sum()
+            n_by_d[i] = np.dot(cur_z[nth], nth_y)
+        loglik = self.noisyor.loglik(self.obs[n], n_by_d, self.lam, self.epislon).sum()
         return loglik
 
     def _loglik(self, cur_y, cur_z, cur_r):
@@ -439,7 +411,7 @@ class Gibbs(BaseSampler):
         """
         assert(cur_z.shape[1] == cur_y.shape[0] == cur_r.shape[1])
 
-        not_on_p = np.empty((self.N, self.d))
+        n_by_d = np.empty((self.N, self.d), dtype=np.int64)
 
         # transform the feature images to obtain the effective y
         # this needs to be done on a per object basis
@@ -453,9 +425,9 @@ class Gibbs(BaseSampler):
                 nth_y[kth_feat] = h_translate(nth_y[kth_feat], self.img_w, r_feat[self.H_TRANS])
                 kth_feat += 1
                 
-            not_on_p[nth] = np.power(1. - self.lam, np.dot(cur_z[nth], nth_y)) * (1. - self.epislon)
+            n_by_d[nth] = np.dot(cur_z[nth], nth_y)
         
-        loglik_mat = np.log(np.abs(self.obs - not_on_p))
+        loglik_mat = self.noisyor.loglik(self.obs, n_by_d, self.lam, self.epislon)
         return loglik_mat.sum()
 
     def _z_by_ry(self, cur_y, cur_z, cur_r):
@@ -472,6 +444,13 @@ class Gibbs(BaseSampler):
             z_by_ry[nth,] = np.dot(cur_z[nth], nth_y)
         return z_by_ry
 
+    def _count_histogram(self, cur_y, cur_z, cur_r):
+        """Return the (observed value, count) histogram of the data given Y, Z
+        and R, which is all that the loglikelihood needs for resampling lambda
+        and epislon.
+        """
+        return self.noisyor.count_histogram(self.obs, self._z_by_ry(cur_y, cur_z, cur_r))
+
     def _cl_infer_yzr(self, init_y, init_z, init_r):
         """Wrapper function to start the inference on y and z.
         This function is not supposed to directly invoked by an end user.
@@ -486,45 +465,75 @@ class Gibbs(BaseSampler):
 
         if self.record_best: self.auto_save_sample(sample = (cur_y, cur_z, cur_r))
         for i in xrange(self.niter):
-            a_time = time()
+            a_time = self.device_clock()
             d_cur_z = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = cur_z.astype(np.int32))
             d_cur_y = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = cur_y.astype(np.int32))
             d_cur_r = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = cur_r.astype(np.int32))
-            self.gpu_time += time() - a_time
+            self.gpu_time += self.device_clock() - a_time
 
             d_cur_y = self._cl_infer_y(cur_y, cur_z, cur_r, d_cur_y, d_cur_z, d_cur_r)
             d_cur_z = self._cl_infer_z(cur_y, cur_z, cur_r, d_cur_y, d_cur_z, d_cur_r)
             temp_cur_r = self._cl_infer_r(cur_y, cur_z, cur_r, d_cur_y, d_cur_z, d_cur_r)
 
-            a_time = time()
+            a_time = self.device_clock()
             temp_cur_y = np.empty_like(cur_y)
             cl.enqueue_copy(self.queue, temp_cur_y, d_cur_y)
             temp_cur_z = np.empty_like(cur_z)
             cl.enqueue_copy(self.queue, temp_cur_z, d_cur_z)
-            self.gpu_time += time() - a_time
+            self.gpu_time += self.device_clock() - a_time
             
             temp_cur_y, temp_cur_z, temp_cur_r = self._cl_infer_k_new(temp_cur_y, temp_cur_z, temp_cur_r)
+            if self.sample_lam_epislon:
+                hist = self._count_histogram(temp_cur_y, temp_cur_z, temp_cur_r)
+                self._sample_lam(hist)
+                self._sample_epislon(hist)
 
             if self.record_best:
                 if self.auto_save_sample(sample = (temp_cur_y, temp_cur_z, temp_cur_r)):
                     print('Number of features:', cur_z.shape[1], file=sys.stderr)
                     cur_y, cur_z, cur_r = temp_cur_y, temp_cur_z, temp_cur_r
+                else:
+                    self.restore_best_params()
                 if self.no_improvement(1000):
                     break                    
             elif i >= self.burnin:
                 cur_y, cur_z, cur_r = temp_cur_y, temp_cur_z, temp_cur_r
                 self.samples['z'].append(cur_z)
                 self.samples['y'].append(cur_y)
-                self.samples['y'].append(cur_r)
+                self.samples['r'].append(cur_r)
+                self.record_params()
             
         self.total_time += time() - total_time
 
         return self.gpu_time, self.total_time, None
 
+    def _cl_compute_z_by_ry(self, z_shape, d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry):
+        """Transform the feature images of every object and compute z_by_ry.
+        The 'global' variant keeps the transformed images in global memory; the
+        'local' variant keeps them in local memory, which is only possible if
+        the K feature images fit in the local memory of a work group twice.
+        """
+        N, K = z_shape
+        def launch(variant):
+            if variant == 'local':
+                return self.prg.compute_z_by_ry_local(self.queue, z_shape, (1, K),
+                                                      d_cur_y, d_cur_z, d_cur_r, d_z_by_ry,
+                                                      cl.LocalMemory(K * self.d * 4), cl.LocalMemory(K * self.d * 4),
+                                                      np.int32(N), np.int32(self.d), np.int32(K), np.int32(self.img_w))
+            return self.prg.compute_z_by_ry(self.queue, z_shape, (1, K),
+                                            d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry,
+                                            np.int32(N), np.int32(self.d), np.int32(K), np.int32(self.img_w))
+
+        variants = ['global']
+        if 2 * K * self.d * 4 <= self.device.local_mem_size: variants.append('local')
+        variant = self.tuner.choose(self.device, 'tibp_compute_z_by_ry', (N, K, self.d), variants,
+                                    lambda v: launch(v).wait(), 'global')
+        return launch(variant)
+
     def _cl_infer_y(self, cur_y, cur_z, cur_r, d_cur_y, d_cur_z, d_cur_r):
         """Infer feature images
         """
-        a_time = time()
+        a_time = self.device_clock()
         d_z_by_ry = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, 
                               hostbuf = np.empty(shape = self.obs.shape, dtype = np.int32))
         d_rand = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
@@ -534,24 +543,32 @@ class Gibbs(BaseSampler):
         d_temp_y = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = transformed_y)
 
         # first transform the feature images and calculate z_by_ry
-        self.prg.compute_z_by_ry(self.queue, cur_z.shape, (1, cur_z.shape[1]), 
-                                 d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry,
-                                 np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                                 np.int32(self.img_w))
-
-        # calculate the prior probability that a pixel is on
-        self.prg.sample_y(self.queue, cur_y.shape, None,
-                          d_cur_y, d_cur_z, d_z_by_ry, d_cur_r, self.d_obs, d_rand, 
-                          np.int32(self.N), np.int32(self.d), np.int32(cur_y.shape[0]), np.int32(self.img_w),
-                          np.float32(self.lam), np.float32(self.epislon), np.float32(self.theta))
-
-        self.gpu_time += time() - a_time
+        self._cl_compute_z_by_ry(cur_z.shape, d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry)
+        scratch = []
+
+        def launch(local_size, d_y = None):
+            # y is resampled in place, so tuning launches work on a scratch copy
+            if d_y is None:
+                if not scratch: scratch.append(cl.Buffer(self.ctx, self.mf.READ_WRITE, size = cur_y.shape[0] * cur_y.shape[1] * 4))
+                d_y = scratch[0]
+                cl.enqueue_copy(self.queue, d_y, d_cur_y)
+            return self.prg.sample_y(self.queue, global_shape, local_size,
+                                     d_y, d_cur_z, d_z_by_ry, d_cur_r, self.d_obs, d_rand, 
+                                     np.int32(self.N), np.int32(self.d), np.int32(cur_y.shape[0]), np.int32(self.img_w),
+                                     np.float32(self.lam), np.float32(self.epislon), np.float32(self.theta))
+
+        # the launch covers K rounded up to a power of two, so that a new number
+        # of features seldom means a new work-group shape to tune
+        global_shape = (round_up_pow2(cur_y.shape[0]), cur_y.shape[1])
+        launch(self.tuned_local_size('tibp_sample_y', global_shape, self.p_mul_sample_y, launch), d_cur_y)
+
+        self.gpu_time += self.device_clock() - a_time
         return d_cur_y
 
     def _cl_infer_z(self, cur_y, cur_z, cur_r, d_cur_y, d_cur_z, d_cur_r):
         """Infer feature ownership
         """
-        a_time = time()
+        a_time = self.device_clock()
         d_z_by_ry = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, 
                               hostbuf = np.empty(shape = self.obs.shape, dtype = np.int32))
         d_z_col_sum = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
@@ -564,55 +581,46 @@ class Gibbs(BaseSampler):
 
 
         # first transform the feature images and calculate z_by_ry
-        self.prg.compute_z_by_ry(self.queue, cur_z.shape, (1, cur_z.shape[1]), 
-                                 d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry,
-                                 np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                                 np.int32(self.img_w))
-
-        # calculate the prior probability that a pixel is on
-        self.prg.sample_z(self.queue, cur_z.shape, None,
-                          d_cur_y, d_cur_z, d_cur_r, d_z_by_ry, d_z_col_sum, self.d_obs, d_rand, 
-                          np.int32(self.N), np.int32(self.d), np.int32(cur_y.shape[0]), np.int32(self.img_w),
-                          np.float32(self.lam), np.float32(self.epislon), np.float32(self.theta))
-
-        self.gpu_time += time() - a_time
+        self._cl_compute_z_by_ry(cur_z.shape, d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry)
+        scratch = []
+
+        def launch(local_size, d_z = None):
+            # z is resampled in place, so tuning launches work on a scratch copy
+            if d_z is None:
+                if not scratch: scratch.append(cl.Buffer(self.ctx, self.mf.READ_WRITE, size = cur_z.shape[0] * cur_z.shape[1] * 4))
+                d_z = scratch[0]
+                cl.enqueue_copy(self.queue, d_z, d_cur_z)
+            return self.prg.sample_z(self.queue, global_shape, local_size,
+                                     d_cur_y, d_z, d_cur_r, d_z_by_ry, d_z_col_sum, self.d_obs, d_rand, 
+                                     np.int32(self.N), np.int32(self.d), np.int32(cur_y.shape[0]), np.int32(self.img_w),
+                                     np.float32(self.lam), np.float32(self.epislon), np.float32(self.theta))
+
+        # the launch covers K rounded up to a power of two, as in _cl_infer_y()
+        global_shape = (cur_z.shape[0], round_up_pow2(cur_z.shape[1]))
+        launch(self.tuned_local_size('tibp_sample_z', global_shape, self.p_mul_sample_z, launch), d_cur_z)
+
+        self.gpu_time += self.device_clock() - a_time
         return d_cur_z
         
     def _cl_infer_k_new(self, cur_y, cur_z, cur_r):
-
+        """Sample new features, then delete empty feature images and null
+        features in one pass over an active-feature mask.
+        """
         # sample new features use importance sampling
         k_new = self._sample_k_new(cur_y, cur_z, cur_r)
         if k_new:
-            cur_y, cur_z, cur_r = k_new
+            new_y, new_z = k_new
+            cur_y, cur_z = np.vstack((cur_y, new_y)), np.hstack((cur_z, new_z))
+            cur_r = np.hstack((cur_r, np.zeros((self.N, new_y.shape[0], self.NUM_TRANS), dtype=cur_r.dtype)))
 
-        # delete empty feature images
-        non_empty_feat_img = np.where(cur_y.sum(axis = 1) > 0)
-        cur_y = cur_y[non_empty_feat_img[0],:].astype(np.int32)
-        cur_z = cur_z[:,non_empty_feat_img[0]].astype(np.int32)
-        cur_r = np.array([_[non_empty_feat_img[0],:] for _ in cur_r]).astype(np.int32)
-        
-        # delete null features
-        active_feat_col = np.where(cur_z.sum(axis = 0) > 0)
-        cur_z = cur_z[:,active_feat_col[0]].astype(np.int32)
-        cur_y = cur_y[active_feat_col[0],:].astype(np.int32)
-        cur_r = np.array([_[active_feat_col[0],:] for _ in cur_r]).astype(np.int32)
+        # delete empty feature images and null features
+        active = (cur_y.sum(axis = 1) > 0) & (cur_z.sum(axis = 0) > 0)
+        if not active.all():
+            cur_y, cur_z, cur_r = cur_y[active], cur_z[:,active], cur_r[:,active]
 
         # update self.k
         self.k = cur_z.shape[1]
-
-        z_s0, z_s1 = cur_z.shape
-        cur_z = cur_z.reshape((z_s0 * z_s1, 1))
-        cur_z = cur_z.reshape((z_s0, z_s1))
-
-        y_s0, y_s1 = cur_y.shape
-        cur_y = cur_y.reshape((y_s0 * y_s1, 1))
-        cur_y = cur_y.reshape((y_s0, y_s1))
-
-        r_s0, r_s1, r_s2 = cur_r.shape
-        cur_r = cur_r.reshape((r_s0 * r_s1 * r_s2, 1))
-        cur_r = cur_r.reshape((r_s0, r_s1, r_s2))
-
-        return cur_y, cur_z, cur_r
+        return cur_y.astype(np.int32), cur_z.astype(np.int32), cur_r.astype(np.int32)
 
     def _cl_infer_r(self, cur_y, cur_z, cur_r, d_cur_y, d_cur_z, d_cur_r):
         """Infer transformations using opencl.
@@ -622,7 +630,7 @@ class Gibbs(BaseSampler):
         time, as long as the new values are accepted / rejected independently of
         each other.
         """
-        a_time = time()
+        a_time = self.device_clock()
         d_z_by_ry_old = cl.array.empty(self.queue, self.obs.shape, np.int32, allocator=self.mem_pool)
         d_z_by_ry_new = cl.array.empty(self.queue, self.obs.shape, np.int32, allocator=self.mem_pool)
         d_replace_r = cl.array.empty(self.queue, (self.N,), np.int32, allocator=self.mem_pool)
@@ -636,20 +644,14 @@ class Gibbs(BaseSampler):
         d_cur_r = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_r.astype(np.int32))
 
         # calculate the z_by_ry_old under old transformations
-        self.prg.compute_z_by_ry(self.queue, cur_z.shape, (1, cur_z.shape[1]),
-                                 d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry_old.data, 
-                                 np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                                 np.int32(self.img_w))
+        self._cl_compute_z_by_ry(cur_z.shape, d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry_old.data)
 
         # calculate the z_by_ry_new under new randomly generated transformations
         cur_r_new = np.copy(cur_r)
         cur_r_new[:,:,self.V_TRANS] = np.random.randint(0, self.img_h, size = (cur_r_new.shape[0], cur_r_new.shape[1]))
         d_cur_r_new = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_r_new.astype(np.int32))
         
-        self.prg.compute_z_by_ry(self.queue, cur_z.shape, (1, cur_z.shape[1]),
-                                 d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_new.data, 
-                                 np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                                 np.int32(self.img_w))
+        self._cl_compute_z_by_ry(cur_z.shape, d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_new.data)
 
         # reject or accept newly proposed transformations on a per-object basis
         d_logprior_old = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
@@ -670,20 +672,14 @@ class Gibbs(BaseSampler):
         d_cur_r = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_r.astype(np.int32))
 
         # calculate the z_by_ry_old under old transformations
-        self.prg.compute_z_by_ry(self.queue, cur_z.shape, (1, cur_z.shape[1]),
-                                 d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry_old.data, 
-                                 np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                                 np.int32(self.img_w))
+        self._cl_compute_z_by_ry(cur_z.shape, d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry_old.data)
 
         # calculate the z_by_ry_new under new randomly generated transformations
         cur_r_new = np.copy(cur_r)
         cur_r_new[:,:,self.H_TRANS] = np.random.randint(0, self.img_w, size = (cur_r_new.shape[0], cur_r_new.shape[1]))
         d_cur_r_new = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_r_new.astype(np.int32))
         
-        self.prg.compute_z_by_ry(self.queue, cur_z.shape, (1, cur_z.shape[1]),
-                                 d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_new.data, 
-                                 np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                                 np.int32(self.img_w))
+        self._cl_compute_z_by_ry(cur_z.shape, d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_new.data)
 
         # reject or accept newly proposed transformations on a per-object basis
         d_logprior_old = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
@@ -704,20 +700,14 @@ class Gibbs(BaseSampler):
         d_cur_r = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_r.astype(np.int32))
 
         # calculate the z_by_ry_old under old transformations
-        self.prg.compute_z_by_ry(self.queue, cur_z.shape, (1, cur_z.shape[1]),
-                                 d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_old.data, 
-                                 np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                                 np.int32(self.img_w))
+        self._cl_compute_z_by_ry(cur_z.shape, d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_old.data)
 
         # calculate the z_by_ry_new under new randomly generated transformations
         cur_r_new = np.copy(cur_r)
         cur_r_new[:,:,self.V_SCALE] = np.random.randint(-self.img_h+2, self.img_h, size = (cur_r_new.shape[0], cur_r_new.shape[1]))
         d_cur_r_new = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_r_new.astype(np.int32))
         
-        self.prg.compute_z_by_ry(self.queue, cur_z.shape, (1, cur_z.shape[1]),
-                                 d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_new.data, 
-                                 np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                                 np.int32(self.img_w))
+        self._cl_compute_z_by_ry(cur_z.shape, d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_new.data)
 
         # reject or accept newly proposed transformations on a per-object basis
         d_logprior_old = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
@@ -739,20 +729,14 @@ class Gibbs(BaseSampler):
         d_cur_r = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_r.astype(np.int32))
 
         # calculate the z_by_ry_old under old transformations
-        self.prg.compute_z_by_ry(self.queue, cur_z.shape, (1, cur_z.shape[1]),
-                                 d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_old.data, 
-                                 np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                                 np.int32(self.img_w))
+        self._cl_compute_z_by_ry(cur_z.shape, d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_old.data)
 
         # calculate the z_by_ry_new under new randomly generated transformations
         cur_r_new = np.copy(cur_r)
         cur_r_new[:,:,self.H_SCALE] = np.random.randint(-self.img_w+2, self.img_w, size = (cur_r_new.shape[0], cur_r_new.shape[1]))
         d_cur_r_new = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_r_new.astype(np.int32))
         
-        self.prg.compute_z_by_ry(self.queue, cur_z.shape, (1, cur_z.shape[1]),
-                                 d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_new.data, 
-                                 np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                                 np.int32(self.img_w))
+        self._cl_compute_z_by_ry(cur_z.shape, d_cur_y, d_cur_z, d_cur_r_new, d_transformed_y, d_temp_y, d_z_by_ry_new.data)
 
         # reject or accept newly proposed transformations on a per-object basis
         d_logprior_old = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, 
@@ -768,7 +752,7 @@ class Gibbs(BaseSampler):
         replace_r = d_replace_r.get()
         cur_r[np.where(replace_r == 1)] = cur_r_new[np.where(replace_r == 1)]
 
-        self.gpu_time += time() - a_time
+        self.gpu_time += self.device_clock() - a_time
         return cur_r
 
     
@@ -781,7 +765,7 @@ class Gibbs(BaseSampler):
         if cur_z.shape[1] == 0: return -999999999.9
     
         if self.cl_mode:
-            a_time = time()
+            a_time = self.device_clock()
             d_cur_z = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_z.astype(np.int32))
             d_cur_y = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_y.astype(np.int32))
             d_cur_r = cl.Buffer(self.ctx, self.mf.READ_ONLY | self.mf.COPY_HOST_PTR, hostbuf = cur_r.astype(np.int32))
@@ -803,10 +787,7 @@ class Gibbs(BaseSampler):
 
             # calculate the loglikelihood of data
             # first transform the feature images and calculate z_by_ry
-            self.prg.compute_z_by_ry(self.queue, cur_z.shape, (1, cur_z.shape[1]), 
-                                     d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry,
-                                     np.int32(self.obs.shape[0]), np.int32(self.obs.shape[1]), np.int32(cur_y.shape[0]),
-                                     np.int32(self.img_w))
+            self._cl_compute_z_by_ry(cur_z.shape, d_cur_y, d_cur_z, d_cur_r, d_transformed_y, d_temp_y, d_z_by_ry)
             
             loglik = np.empty(shape = self.obs.shape, dtype = np.float32)
             d_loglik = cl.Buffer(self.ctx, self.mf.READ_WRITE | self.mf.COPY_HOST_PTR, hostbuf = loglik)
@@ -817,7 +798,7 @@ class Gibbs(BaseSampler):
             
             cl.enqueue_copy(self.queue, loglik, d_loglik)
             log_lik = loglik.sum()
-            self.gpu_time += time() - a_time
+            self.gpu_time += self.device_clock() - a_time
 
             # calculate the prior probability of Y
             num_on, num_off = (cur_y == 1).sum(), (cur_y == 0).sum()
@@ -829,18 +810,7 @@ class Gibbs(BaseSampler):
             
         else:
             # calculate the prior probability of Z
-            feat_count = cur_z.cumsum(axis = 0)
-            for n in xrange(cur_z.shape[0]):
-                num_novel = 0
-                for k in xrange(cur_z.shape[1]):
-                    m = feat_count[n,k] - cur_z[n,k]#cur_z[:n,k].sum()
-                    if m > 0:
-                        if cur_z[n,k] == 1: log_prior += np.log(m / (n+1.0))
-                        else: log_prior += np.log(1 - m / (n + 1.0))
-                    else: 
-                        if cur_z[n,k] == 1: num_novel += 1
-                if num_novel > 0:
-                    log_prior += poisson.logpmf(num_novel, self.alpha / (n+1.0))
+            log_prior += ibp_logprior_z(cur_z, self.alpha)
 
             # calculate the prior probability of Y
             num_on = (cur_y == 1).sum()
@@ -867,6 +837,7 @@ class GibbsPredictor(BasePredictor):
         self.lam = lam
         self.theta = theta
         self.epislon = epislon
+        self.noisyor = NoisyOrLikelihood()
 
     def read_test_csv(self, file_path, header=True):
         """Read the test cases and convert values to integer.
@@ -887,67 +858,23 @@ class GibbsPredictor(BasePredictor):
                 new_samples.append(sample)
         self.samples[var_name] = new_samples
 
+    def score(self, thining = 0, burnin = 0, use_iter = None, obs = None):
+        """Compute the log score of each test case under each selected sample:
+        the log of the sum of its likelihood over all ownership patterns of
+        the sample's features. Samples are scored by num_workers processes.
+        """
+        if obs is None: obs = self.obs
+        samples_y = self.select_samples('y', thining, burnin, use_iter)
+        params = self.select_params(['lam', 'epislon'], len(samples_y), thining, burnin, use_iter)
+        return np.array(self.map_samples(score_sample, [(y,) + p for y, p in zip(samples_y, params)],
+                                         (self.noisyor, obs))).reshape((-1, len(obs)))
+
     def predict(self, thining = 0, burnin = 0, use_iter=None, output_file = None):
-        """Predict the test cases
+        """Predict the test cases: the largest log score of each test case over
+        the selected samples, and the standard deviation of its log scores.
         """
         assert('y' in self.samples and 'z' in self.samples)
         assert(len(self.samples['y']) == len(self.samples['z']))
         
-        num_sample = len(self.samples['y'])
-        num_obs = len(self.obs)
-        logprob_result = np.empty((num_sample, num_obs))
-
-        for i in xrange(num_sample):
-            cur_y = self.samples['y'][i]
-            cur_z = self.samples['z'][i]
-            
-            # generate all possible Zs
-            num_feature = cur_z.shape[1]
-            all_z = []
-            for n in xrange(num_feature+1):
-                base = [1] * n + [0] * (num_feature - n)
-                all_z.extend(list(set(itertools.permutations(base))))
-            all_z = np.array(all_z, dtype=np.int32)
-            
-            # BEGIN p(z|z_inferred) calculation
-
-            # the following lines of code may be a bit tricky to parse
-            # first, calculate the probability of features that already exist
-            # since features are additive within an image, we can just prod them
-            prior_off_prob = 1.0 - cur_z.sum(axis = 0) / float(cur_z.shape[0])
-            prior_prob = np.abs(all_z - prior_off_prob)
-
-            # then, locate the novel features in all_z
-            mask = np.ones(all_z.shape)
-            mask[:,np.where(cur_z.sum(axis = 0) > 0)] = 0
-            novel_all_z = all_z * mask
-            
-            # temporarily mark those cells to have probability 1
-            prior_prob[novel_all_z==1] = 1
-
-            # we can safely do row product now, still ignoring new features
-            prior_prob = prior_prob.prod(axis = 1)
-
-            # let's count the number of new features for each row
-            num_novel = novel_all_z.sum(axis = 1)
-            # calculate the probability
-            novel_prob = poisson.pmf(num_novel, self.alpha / float(cur_z.shape[0]))
-            # ignore the novel == 0 special case
-            novel_prob[num_novel==0] = 1.
-
-            # multiply it by prior prob
-            prior_prob = prior_prob * novel_prob
-            
-            # END p(z|z_inferred) calculation
-
-            # BEGIN p(x|z, y_inferred)
-            n_by_d = np.dot(all_z, cur_y)
-            not_on_p = np.power(1. - self.lam, n_by_d) * (1. - self.epislon)
-            for j in xrange(len(self.obs)):
-                prob = np.abs(self.obs[j] - not_on_p).prod(axis=1) 
-                prob = prob #* prior_prob
-                prob = prob.sum()
-                logprob_result[i,j] = prob
-            # END
-                
+        logprob_result = self.score(thining, burnin, use_iter)
         return logprob_result.max(axis=0), logprob_result.std(axis=0)
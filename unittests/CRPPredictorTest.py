@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import unittest
+import sys, os.path, shutil, tempfile
+import numpy as np
+from scipy.stats import t
+from scipy.special import logsumexp
+
+pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
+sys.path.append(pkg_dir)
+
+from MPBNP import crp
+
+class PredictorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, header, rows):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            print(*header, sep=',', file=f)
+            for row in rows: print(*row, sep=',', file=f)
+        return path
+
+class TestGaussianPredictor(PredictorTestCase):
+
+    def setUp(self):
+        PredictorTestCase.setUp(self)
+        rng = np.random.RandomState(0)
+        self.train = np.hstack((rng.normal(-3, 1, 10), rng.normal(4, 0.5, 8)))
+        self.labels = np.array([0] * 10 + [2] * 8)
+        self.predictor = crp.gaussian.CollapsedGibbsPredictor(alpha = 0.5)
+        self.predictor.read_train_csv(self.write('train.csv', ['x'], self.train[:,np.newaxis]))
+        self.predictor.samples['labels'] = [self.labels]
+        self.predictor.summarize()
+
+    def closed_form(self, obs):
+        """The Student-t predictive of the normal-gamma model, mixed over the
+        clusters and a new one.
+        """
+        train, alpha = self.predictor.train, self.predictor.alpha
+        scores = []
+        for members in [self.train[self.labels == 0], self.train[self.labels == 2], self.train[:0]]:
+            n = members.shape[0]
+            mean = members.mean() if n > 0 else 0.
+            kn = train.gaussian_k0 + n
+            alpha_n = train.gamma_alpha0 + n / 2.
+            beta_n = train.gamma_beta0 + 0.5 * ((members - mean) ** 2).sum() + \
+                train.gaussian_k0 * n * (mean - train.gaussian_mu0) ** 2 / (2 * kn)
+            loc = (train.gaussian_k0 * train.gaussian_mu0 + n * mean) / kn
+            scale = np.sqrt(beta_n * (kn + 1) / (alpha_n * kn))
+            weight = (n if n > 0 else alpha) / (self.train.shape[0] + alpha)
+            scores.append(np.log(weight) + t.logpdf(obs, 2 * alpha_n, loc, scale))
+        return logsumexp(scores, axis = 0)
+
+    def test_score_matches_closed_form(self):
+        obs = np.linspace(-6, 6, 25)
+        self.assertTrue(np.allclose(self.predictor.score(obs), self.closed_form(obs)))
+
+    def test_score_in_chunks(self):
+        obs = np.linspace(-6, 6, 25)
+        whole = self.predictor.score(obs)
+        self.predictor.chunk_size = 4
+        self.assertTrue(np.allclose(self.predictor.score(obs), whole))
+
+    def test_assign(self):
+        self.assertEqual(list(self.predictor.assign([-3., 4., 500.])), [0, 2, 1])
+
+    def test_summary_round_trip(self):
+        path = os.path.join(self.dir, 'summary.npz')
+        self.predictor.save_summary(path)
+        predictor = crp.gaussian.CollapsedGibbsPredictor()
+        predictor.read_summary(path)
+        obs = np.linspace(-6, 6, 7)
+        self.assertTrue(np.allclose(predictor.score(obs), self.predictor.score(obs)))
+
+class TestGaussianPredictor2d(PredictorTestCase):
+
+    def test_samples_are_averaged(self):
+        rng = np.random.RandomState(1)
+        train = np.vstack((rng.normal(0, 1, (6, 2)), rng.normal(8, 1, (6, 2))))
+        labels = [np.repeat([0, 1], 6), np.repeat([1, 3], 6), np.zeros(12, dtype=np.int64)]
+        path = self.write('train.csv', ['x', 'y'], train)
+        obs = rng.normal(4, 4, (9, 2))
+
+        scores = []
+        for sample in labels:
+            predictor = crp.gaussian.CollapsedGibbsPredictor()
+            predictor.read_train_csv(path)
+            predictor.samples['labels'] = [sample]
+            predictor.summarize()
+            scores.append(predictor.score(obs))
+        predictor.samples['labels'] = labels
+        predictor.summarize()
+        self.assertTrue(np.allclose(predictor.score(obs), logsumexp(scores, axis = 0) - np.log(len(labels))))
+
+class TestCategoricalPredictor(PredictorTestCase):
+
+    def setUp(self):
+        PredictorTestCase.setUp(self)
+        self.train = [('h', 'a'), ('h', 'a'), ('h', 'b'), ('t', 'b'), ('t', 'c')]
+        self.labels = np.array([0, 0, 0, 1, 1])
+        self.predictor = crp.categorical.CollapsedGibbsPredictor(alpha = 0.5)
+        self.predictor.read_train_csv(self.write('train.csv', ['coin', 'letter'], self.train))
+        self.predictor.samples['labels'] = [self.labels]
+        self.predictor.summarize()
+
+    def closed_form(self, obs, beta = 0.1):
+        """The Dirichlet-multinomial predictive of every dimension, mixed over
+        the clusters and a new one.
+        """
+        alpha, support_size = self.predictor.alpha, [2, 3]
+        scores = []
+        for label in (0, 1, None):
+            members = [row for row, _ in zip(self.train, self.labels) if _ == label]
+            n = len(members)
+            logp = np.log((n if n > 0 else alpha) / (len(self.train) + alpha))
+            for d, value in enumerate(obs):
+                count = sum(row[d] == value for row in members)
+                logp += np.log((beta + count) / (support_size[d] * beta + n))
+            scores.append(logp)
+        return logsumexp(scores)
+
+    def test_score_matches_closed_form(self):
+        obs = [('h', 'a'), ('t', 'c'), ('t', 'a'), ('x', 'b'), ('h', 'z')]
+        scores = self.predictor.score(np.array(obs))
+        self.assertTrue(np.allclose(scores, [self.closed_form(_) for _ in obs]))
+
+    def test_probabilities_sum_to_one(self):
+        obs = np.array([(coin, letter) for coin in 'ht' for letter in 'abc'])
+        self.assertAlmostEqual(np.exp(self.predictor.score(obs)).sum(), 1.)
+
+    def test_assign(self):
+        self.assertEqual(list(self.predictor.assign(np.array([('h', 'a'), ('t', 'c')]))), [0, 1])
+
+if __name__ == '__main__':
+    unittest.main()
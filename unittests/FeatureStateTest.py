@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import unittest
+import sys, os.path
+import numpy as np
+
+pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
+sys.path.append(pkg_dir)
+
+from MPBNP import FeatureState
+
+class TestFeatureState(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.y = rng.randint(0, 2, (4, 6)).astype(np.int32)
+        self.z = rng.randint(0, 2, (5, 4)).astype(np.int32)
+        self.state = FeatureState([('y', self.y, 0), ('z', self.z, 1)])
+
+    def assertSpareZero(self):
+        state = self.state
+        self.assertFalse(state.buffers['y'][state.k:].any())
+        self.assertFalse(state.buffers['z'][:,state.k:].any())
+
+    def test_views_write_through(self):
+        self.state['z'][2, 1] = 7
+        self.assertEqual(self.state.buffers['z'][2, 1], 7)
+        cur_y, = self.state.copy('y')
+        cur_y[:] = 9
+        self.assertTrue(np.array_equal(self.state['y'], self.y))
+
+    def test_append_grows(self):
+        new_y = np.ones((7, 6), dtype=np.int32)
+        new = self.state.append(7, y = new_y)
+        self.assertEqual((new.start, new.stop), (4, 11))
+        self.assertTrue(self.state.capacity >= 11)
+        self.assertTrue(np.array_equal(self.state['y'], np.vstack((self.y, new_y))))
+        self.assertTrue(np.array_equal(self.state['z'][:,:4], self.z))
+        self.assertFalse(self.state['z'][:,4:].any())
+        self.assertSpareZero()
+
+    def test_remove_swaps_last(self):
+        self.state.remove([1])
+        self.assertEqual(self.state.k, 3)
+        self.assertTrue(np.array_equal(self.state['y'], self.y[[0, 3, 2]]))
+        self.assertTrue(np.array_equal(self.state['z'], self.z[:,[0, 3, 2]]))
+        self.assertSpareZero()
+
+    def test_remove_mask_keeps_the_rest(self):
+        self.state.remove(np.array([True, False, True, False]))
+        self.assertEqual(self.state.k, 2)
+        kept = [tuple(_) for _ in self.y[[1, 3]]]
+        self.assertEqual(sorted(tuple(_) for _ in self.state['y']), sorted(kept))
+        # the columns of Z move with their feature images
+        for kth in xrange(2):
+            old = [tuple(_) for _ in self.y].index(tuple(self.state['y'][kth]))
+            self.assertTrue(np.array_equal(self.state['z'][:,kth], self.z[:,old]))
+        self.assertSpareZero()
+
+    def test_remove_all(self):
+        self.state.remove(np.arange(4))
+        self.assertEqual(self.state['y'].shape, (0, 6))
+        self.assertEqual(self.state['z'].shape, (5, 0))
+        self.assertSpareZero()
+
+    def test_load_clears_old_features(self):
+        self.state.load(y = self.y[:2], z = self.z[:,:2])
+        self.assertEqual(self.state.k, 2)
+        self.assertTrue(np.array_equal(self.state['z'], self.z[:,:2]))
+        self.assertSpareZero()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import unittest
+import sys, os.path, shutil, tempfile
+import numpy as np
+
+pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
+sys.path.append(pkg_dir)
+
+from MPBNP import read_images
+
+class TestReadImages(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.images = np.random.RandomState(0).randint(0, 2, (4, 6)).astype(np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, header = True, blank_after = None):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            if header: print('width', *['p%d' % _ for _ in xrange(self.images.shape[1])], sep=',', file=f)
+            for i, image in enumerate(self.images):
+                print(2, *image, sep=',', file=f)
+                if i == blank_after: print('', file=f)
+        return path
+
+    def test_full_read(self):
+        path = self.write('full.csv')
+        for packed in (False, True):
+            images, width = read_images(path, packed = packed, cache = False)
+            self.assertEqual(width, 2)
+            self.assertTrue(np.array_equal(images[:], self.images))
+
+    def test_rows_skip_blank_lines(self):
+        path = self.write('blank.csv', blank_after = 1)
+        uncached, _ = read_images(path, rows = [3, 1], cache = False)
+        self.assertTrue(np.array_equal(uncached, self.images[[3, 1]]))
+        self.assertTrue(np.array_equal(read_images(path, rows = [2, 3], cache = False)[0], self.images[[2, 3]]))
+
+        read_images(path) # writes the cache
+        cached, _ = read_images(path, rows = [3, 1])
+        self.assertTrue(np.array_equal(cached, uncached))
+
+    def test_rows_out_of_range(self):
+        path = self.write('short.csv')
+        self.assertRaises(Exception, read_images, path, rows = [4], cache = False)
+        read_images(path)
+        self.assertRaises(Exception, read_images, path, rows = [4])
+
+    def test_cache_checks_header(self):
+        path = self.write('header.csv', header = False)
+        with_header, _ = read_images(path, header = True)
+        self.assertTrue(np.array_equal(with_header, self.images[1:]))
+        without_header, _ = read_images(path, header = False)
+        self.assertTrue(np.array_equal(without_header, self.images))
+
+    def test_cache_checks_file(self):
+        path = self.write('changed.csv')
+        read_images(path)
+        self.images = self.images[:3]
+        self.write('changed.csv')
+        images, _ = read_images(path)
+        self.assertTrue(np.array_equal(images, self.images))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import unittest
+import sys, os.path
+
+pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
+sys.path.append(pkg_dir)
+
+from MPBNP import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = LRUCache(10)
+        for key in 'abc': self.cache.put(key, key.upper(), 3)
+
+    def test_evicts_least_recently_used(self):
+        self.assertEqual(self.cache.get('a'), 'A') # b is now the oldest
+        self.assertTrue(self.cache.put('d', 'D', 3))
+        self.assertFalse('b' in self.cache)
+        self.assertEqual([self.cache.get(_) for _ in 'acd'], ['A', 'C', 'D'])
+        self.assertEqual(self.cache.nbytes, 9)
+
+    def test_evicts_until_it_fits(self):
+        self.cache.put('d', 'D', 8)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get('d'), 'D')
+        self.assertEqual(self.cache.nbytes, 8)
+
+    def test_replace_updates_size(self):
+        self.cache.put('a', 'AA', 1)
+        self.assertEqual(self.cache.nbytes, 7)
+        self.assertEqual(self.cache.get('a'), 'AA')
+        self.cache.put('d', 'D', 3) # still fits
+        self.assertEqual(len(self.cache), 4)
+
+    def test_too_large(self):
+        self.assertFalse(self.cache.put('d', 'D', 11))
+        self.assertFalse('d' in self.cache)
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.get('d'), None)
+
+    def test_clear(self):
+        self.cache.clear()
+        self.assertEqual((len(self.cache), self.cache.nbytes), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import unittest
+import sys, os.path
+import numpy as np
+
+pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
+sys.path.append(pkg_dir)
+
+from MPBNP import NoisyOrLikelihood
+
+def closed_form(obs, counts, lam, epislon):
+    off_p = np.power(1. - lam, counts) * (1. - epislon)
+    return np.log(np.where(obs == 1, 1. - off_p, off_p))
+
+class TestTables(unittest.TestCase):
+
+    def test_loglik_matches_closed_form(self):
+        rng = np.random.RandomState(0)
+        obs = rng.randint(0, 2, (5, 40))
+        counts = rng.randint(0, 40, (5, 40))
+        likelihood = NoisyOrLikelihood(max_count = 4)
+        for lam, epislon in [(0.9, 0.02), (0.5, 0.3), (0.9, 0.02)]:
+            self.assertTrue(np.allclose(likelihood.loglik(obs, counts, lam, epislon),
+                                        closed_form(obs, counts, lam, epislon)))
+        self.assertTrue(likelihood.max_count >= counts.max())
+
+    def test_loglik_broadcasts(self):
+        obs = np.array([0, 1, 1, 0])
+        counts = np.array([[0, 0, 1, 2], [3, 0, 2, 1]])
+        self.assertTrue(np.allclose(NoisyOrLikelihood().loglik(obs, counts, 0.8, 0.1),
+                                    closed_form(obs, counts, 0.8, 0.1)))
+
+class TestCountHistogram(unittest.TestCase):
+
+    def test_count_loglik_matches_sum(self):
+        rng = np.random.RandomState(1)
+        obs = rng.randint(0, 2, (6, 30))
+        counts = rng.randint(0, 5, (6, 30))
+        likelihood = NoisyOrLikelihood()
+        hist = likelihood.count_histogram(obs, counts)
+        self.assertEqual(hist.sum(), obs.size)
+        self.assertAlmostEqual(likelihood.count_loglik(hist, 0.7, 0.05),
+                               closed_form(obs, counts, 0.7, 0.05).sum())
+
+    def test_count_loglik_certain_pixels(self):
+        # with lambda 1 a pixel with a count is on for sure, which must not give nan
+        likelihood = NoisyOrLikelihood()
+        hist = likelihood.count_histogram(np.array([0, 1, 1]), np.array([0, 2, 0]))
+        self.assertAlmostEqual(likelihood.count_loglik(hist, 1., 0.1), np.log(0.9) + np.log(0.1))
+
+class TestMarginalLoglik(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        np.random.seed(0) # the estimate draws from the global generator
+
+    def sample(self, k, d = 64, density = 0.15, lam = 0.9, epislon = 0.02):
+        """Return random feature images and an image drawn from a few of them.
+        """
+        cur_y = (self.rng.random_sample((k, d)) < density).astype(np.int32)
+        cur_z = self.rng.random_sample(k) < 0.25
+        on_p = 1. - np.power(1. - lam, cur_y[cur_z].sum(axis = 0)) * (1. - epislon)
+        return (self.rng.random_sample(d) < on_p).astype(np.int32), cur_y
+
+    def exact_and_sampled(self, obs, cur_y, *args):
+        likelihood = NoisyOrLikelihood()
+        likelihood.max_exact = cur_y.shape[0]
+        exact = likelihood.marginal_loglik(obs, cur_y, 0.9, 0.02, *args)
+        likelihood.max_exact, likelihood.max_fallback = 0, 0
+        return exact, likelihood.marginal_loglik(obs, cur_y, 0.9, 0.02, *args)
+
+    def test_sampled_matches_exact(self):
+        for k in (18, 19, 20):
+            obs, cur_y = self.sample(k)
+            log_on = np.log(self.rng.uniform(0.05, 0.6, k))
+            novel = np.arange(k) >= k - 3
+            for args in [(), (log_on, np.log1p(-np.exp(log_on))),
+                         (log_on, np.log1p(-np.exp(log_on)), novel, 0.7)]:
+                exact, sampled = self.exact_and_sampled(obs, cur_y, *args)
+                self.assertAlmostEqual(sampled, exact, delta = 0.05)
+
+    def test_sampled_on_dense_features(self):
+        for _ in xrange(3):
+            obs, cur_y = self.sample(18, density = 0.3)
+            exact, sampled = self.exact_and_sampled(obs, cur_y)
+            self.assertAlmostEqual(sampled, exact, delta = 0.05)
+
+    def test_sampled_exact_for_disjoint_features(self):
+        cur_y = np.kron(np.eye(20, dtype=np.int32), np.ones((1, 3), dtype=np.int32))
+        obs = (self.rng.random_sample(60) < 0.5).astype(np.int32)
+        exact, sampled = self.exact_and_sampled(obs, cur_y)
+        self.assertAlmostEqual(sampled, exact, places = 9)
+
+    def test_sampled_error(self):
+        obs, cur_y = self.sample(18)
+        likelihood = NoisyOrLikelihood()
+        likelihood.max_exact = 18
+        exact, error = likelihood.marginal_loglik(obs, cur_y, 0.9, 0.02, return_error = True)
+        self.assertEqual(error, 0.)
+        # runs that cannot reach the tolerance fall back to enumeration
+        likelihood.max_exact, likelihood.mc_tolerance, likelihood.mc_samples = 0, 0., 64
+        self.assertAlmostEqual(likelihood.marginal_loglik(obs, cur_y, 0.9, 0.02), exact, places = 9)
+        likelihood.max_fallback = 0
+        sampled, error = likelihood.marginal_loglik(obs, cur_y, 0.9, 0.02, return_error = True)
+        self.assertTrue(0. < error < np.inf)
+
+if __name__ == '__main__':
+    unittest.main()
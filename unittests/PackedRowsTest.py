@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import unittest
+import sys, os.path
+import numpy as np
+import scipy.sparse
+
+pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
+sys.path.append(pkg_dir)
+
+from MPBNP import PackedRows, feature_counts
+
+class TestPackedRows(unittest.TestCase):
+
+    def setUp(self):
+        self.dense = np.random.RandomState(0).randint(0, 2, (5, 13)).astype(np.uint8)
+        self.rows = PackedRows(self.dense)
+
+    def test_unpacks_rows(self):
+        self.assertEqual(len(self.rows), 5)
+        self.assertEqual(self.rows.nbytes, 5 * 2)
+        self.assertTrue(np.array_equal(self.rows[:], self.dense))
+        self.assertTrue(np.array_equal(self.rows[3], self.dense[3]))
+        self.assertTrue(np.array_equal(self.rows[[4, 0]], self.dense[[4, 0]]))
+        self.assertTrue(np.array_equal(self.rows[1:3], self.dense[1:3]))
+        self.assertEqual(self.rows[:].dtype, np.uint8)
+
+    def test_from_bits(self):
+        rows = PackedRows.from_bits(np.packbits(self.dense, axis = -1), self.dense.shape)
+        self.assertTrue(np.array_equal(rows[:], self.dense))
+
+class TestFeatureCounts(unittest.TestCase):
+
+    def test_matches_product(self):
+        rng = np.random.RandomState(0)
+        for k in (3, 300):
+            cur_z = rng.randint(0, 2, (6, k))
+            cur_y = rng.randint(0, 2, (k, 10))
+            counts = feature_counts(cur_z, cur_y)
+            self.assertTrue(np.array_equal(counts, np.dot(cur_z, cur_y)))
+            self.assertEqual(counts.dtype, np.uint8 if k < 256 else np.uint16)
+
+    def test_sparse_z(self):
+        rng = np.random.RandomState(1)
+        cur_z = rng.randint(0, 2, (6, 4)).astype(np.uint8)
+        cur_y = rng.randint(0, 2, (4, 10)).astype(np.uint8)
+        counts = feature_counts(scipy.sparse.csr_matrix(cur_z)[2:5], cur_y)
+        self.assertTrue(np.array_equal(counts, np.dot(cur_z[2:5], cur_y)))
+
+    def test_no_features(self):
+        counts = feature_counts(np.zeros((4, 0)), np.zeros((0, 7)))
+        self.assertEqual(counts.shape, (4, 7))
+        self.assertFalse(counts.any())
+
+if __name__ == '__main__':
+    unittest.main()
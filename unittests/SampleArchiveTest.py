@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import unittest
+import sys, os.path, shutil, tempfile
+import numpy as np
+
+pkg_dir = os.path.dirname(os.path.realpath(__file__)) + '/../../'
+sys.path.append(pkg_dir)
+
+from MPBNP import SampleArchive, save_samples
+
+class TestSampleArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        # samples of different shapes, including one without features
+        self.samples = [rng.randint(0, 2, (k, 8)) for k in (3, 0, 5, 12, 1)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        path = os.path.join(self.dir, 'y.npz')
+        save_samples(path, self.samples, dtype = np.uint8)
+        archive = SampleArchive(path)
+        self.assertEqual(len(archive), len(self.samples))
+        for sample, read in zip(self.samples, archive):
+            self.assertEqual(read.dtype, np.uint8)
+            self.assertTrue(np.array_equal(read, sample))
+        self.assertTrue(isinstance(archive[0], np.memmap))
+
+    def test_many_members_stay_in_order(self):
+        path = os.path.join(self.dir, 'many.npz')
+        save_samples(path, [np.array([_]) for _ in xrange(12)])
+        self.assertEqual([int(_[0]) for _ in SampleArchive(path)], range(12))
+
+    def test_slices_are_lazy_archives(self):
+        path = os.path.join(self.dir, 'y.npz')
+        save_samples(path, self.samples)
+        selected = SampleArchive(path)[1::2]
+        self.assertTrue(isinstance(selected, SampleArchive))
+        self.assertEqual(len(selected), 2)
+        self.assertTrue(np.array_equal(selected[1], self.samples[3]))
+        self.assertTrue(np.array_equal(selected[-1], self.samples[3]))
+
+    def test_fortran_and_compressed_members(self):
+        path = os.path.join(self.dir, 'fortran.npz')
+        save_samples(path, [np.asfortranarray(self.samples[3])])
+        self.assertTrue(np.array_equal(SampleArchive(path)[0], self.samples[3]))
+        path = os.path.join(self.dir, 'compressed.npz')
+        np.savez_compressed(path, *self.samples)
+        self.assertTrue(np.array_equal(SampleArchive(path)[2], self.samples[2]))
+
+if __name__ == '__main__':
+    unittest.main()